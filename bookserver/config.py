@@ -17,6 +17,7 @@ from enum import Enum
 from functools import lru_cache
 import os
 from pathlib import Path
+from typing import Optional
 
 # Third-party imports
 # -------------------
@@ -44,6 +45,34 @@ class DatabaseType(Enum):
     PostgreSQL = 1
 
 
+# Define when the `write-behind ingestion pipeline <../internal/ingest.py>` acknowledges a logged event. As with ``BookServerConfig``, the values must be strings.
+class IngestAck(Enum):
+    # Don't queue; write each row in its own transaction before responding.
+    direct = "direct"
+    # Respond as soon as the rows are queued. Faster, but queued rows are lost if the worker dies before a flush.
+    enqueue = "enqueue"
+    # Respond only after the batch containing the rows has been committed.
+    flush = "flush"
+
+
+# Select where `literate programming builds <../internal/builder_executor.py>` run.
+class LpBuilderBackend(Enum):
+    # In a Celery worker, through the Redis broker.
+    celery = "celery"
+    # In a pool of processes belonging to this webserver worker.
+    local = "local"
+
+
+# Select how uploads address the S3 bucket; see `botocore's addressing_style <https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html>`_.
+class S3AddressingStyle(Enum):
+    # Let botocore choose.
+    auto = "auto"
+    # Put the bucket in the host name (``bucket.endpoint``).
+    virtual = "virtual"
+    # Put the bucket in the path (``endpoint/bucket``), as S3 stand-ins such as MinIO and LocalStack usually require.
+    path = "path"
+
+
 class Settings(BaseSettings):
     # Pydantic provides a wonderful utility to handle settings.  The beauty of it
     # is that you can specify variables with or without default values, and Pydantic
@@ -74,6 +103,19 @@ class Settings(BaseSettings):
     # The path to store error logs.
     error_path: Path = Path.home() / "Runestone/errors"
 
+    # Configure how `book static assets <../internal/static_assets.py>` are served. ``static_max_age`` is the ``Cache-Control`` max-age, in seconds, for assets whose names don't contain a hash. If ``static_accel_redirect_prefix`` is set (for example, to ``/protected_books``), reply with an ``X-Accel-Redirect`` to this prefix plus the asset's path relative to `book_path`, so that nginx sends the file; nginx must map that prefix to `book_path` using an ``internal`` location.
+    static_max_age: int = 3600
+    static_accel_redirect_prefix: str = ""
+
+    # The path to store compiled book templates, and the number of books whose templates are kept in memory.
+    template_bytecode_cache_path: Path = Path.home() / "Runestone/template_cache"
+    template_cache_size: int = 128
+
+    # Configure `bulk regrading <../internal/regrade.py>`. ``regrade_state_path`` stores the progress of each regrade job, so that an interrupted job can resume. ``regrade_chunk_size`` is the number of answers read, graded and written at a time. ``regrade_processes`` is the number of worker processes used by CPU-bound graders; 0 grades in the server's process instead.
+    regrade_state_path: Path = Path.home() / "Runestone/regrade"
+    regrade_chunk_size: int = 1000
+    regrade_processes: int = 2
+
     # Define the mode of operation for the webserver, taken from ``BookServerConfig```. This looks a bit odd, since the string value will be parsed by Pydantic into a Config.
     #
     # .. admonition:: warning
@@ -113,6 +155,17 @@ class Settings(BaseSettings):
     def database_url(self) -> str:
         return self._sync_to_async_uri(self._sync_database_url)
 
+    # An optional read replica of the database, given as a standard (synchronous) connection like ``dburl``. When it's set, `heavy read-only queries <read replicas>` use the replica. After a request writes to the database, the same client's reads use the primary for ``replica_max_lag`` seconds, so that students see their own answers even though the replica lags behind.
+    replica_dburl: Optional[str] = None
+    replica_max_lag: float = 5
+
+    # Return the async equivalent of ``replica_dburl``, or None if there's no replica.
+    @property
+    def replica_database_url(self) -> Optional[str]:
+        return (
+            self._sync_to_async_uri(self.replica_dburl) if self.replica_dburl else None
+        )
+
     # Determine the database type from the URL.
     @property
     def database_type(self) -> DatabaseType:
@@ -127,12 +180,73 @@ class Settings(BaseSettings):
     # Setting db_echo to True makes for a LOT of sqlalchemy output - it gives you the SQL for every query!
     db_echo = False
 
+    # Configure the database connection pool of each worker process (see `../db.py`); these apply to PostgreSQL. Each worker holds at most ``db_pool_size + db_max_overflow`` connections, so the number of workers times this total must stay below PostgreSQL's ``max_connections``. A request waits at most ``db_pool_timeout`` seconds for a connection. ``db_pool_pre_ping`` tests each connection before use, and connections older than ``db_pool_recycle`` seconds are replaced (-1 never replaces them).
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_pre_ping: bool = False
+    db_pool_recycle: int = -1
+    # When True, the database work of each request shares one session, committed when the response starts; see `request-scoped sessions <../db.py>`. When False, each crud function uses (and commits) a session of its own.
+    db_request_session: bool = True
+
     # The docker-compose.yml file will set the REDIS_URI environment variable
     redis_uri = "redis://localhost:6379/0"
 
+    # Configure the `write-behind ingestion pipeline <../internal/ingest.py>` used by the `log_book_event endpoint`. Rows are flushed when ``ingest_batch_size`` rows are queued or ``ingest_flush_interval`` seconds after the first row of a batch arrives, whichever comes first. Once ``ingest_max_queue`` rows are waiting, new requests wait for room in the queue.
+    ingest_ack: IngestAck = "flush"  # type: ignore
+    ingest_batch_size: int = 200
+    ingest_flush_interval: float = 0.05
+    ingest_max_queue: int = 5000
+
+    # Configure the `cache <../internal/cache.py>` of ``courses`` rows. TTLs are in seconds; ``course_cache_negative_ttl`` applies to lookups of a course which doesn't exist.
+    course_cache_ttl: float = 300
+    course_cache_negative_ttl: float = 10
+    course_cache_size: int = 1000
+
+    # Configure the `book index <../internal/book_index.py>`: the maximum age of an index, in seconds, the number of books indexed, and the minimum time, in seconds, between checks of whether an indexed book was republished.
+    book_index_ttl: float = 3600
+    book_index_size: int = 256
+    book_index_check_interval: float = 5
+
+    # Configure the cache of server-side grading feedback, keyed by (div_id, course).
+    feedback_cache_ttl: float = 600
+    feedback_cache_size: int = 20000
+
+    # Configure the cache of users used when authenticating a request.
+    user_cache_ttl: float = 60
+    user_cache_negative_ttl: float = 5
+    user_cache_size: int = 5000
+
+    # Configure the cache of instructor status, keyed by (user, course).
+    instructor_cache_ttl: float = 60
+    instructor_cache_size: int = 5000
+
+    # When True, caches which support it (the user cache, the `activity tracker <../internal/activity.py>`, the `answer counts <../internal/answer_counts.py>`, the `poll tallies <../internal/poll_tally.py>`, and the `top fill-in-the-blank answers <../internal/fitb_top_answers.py>`) also store entries in Redis (at ``redis_uri``), so that all worker processes share them.
+    redis_cache: bool = False
+    # The longest time, in seconds, that one process may spend loading one of these Redis caches from the database; meanwhile, other processes read the database instead. See ``redis_lock`` in `../internal/redis_client.py`.
+    redis_load_timeout: float = 30
+    # The time, in seconds, before an unused set of a student's interactions expires.
+    activity_cache_ttl: int = 7 * 24 * 60 * 60
+    # The time, in seconds, before a question's answer counts are reloaded from the database, correcting any drift.
+    answer_counts_ttl: int = 60 * 60
+    # The time, in seconds, before a poll's tally is rebuilt from the database.
+    poll_tally_ttl: int = 60 * 60
+    # If not None, push updated poll results to the chat websockets of the poll's course at most once per this many seconds per poll. Pages must handle the ``poll_results`` message for this to help, so it's off by default.
+    poll_push_interval: Optional[float] = None
+    # The time, in seconds, before a fill-in-the-blank question's answer counts are reloaded from the database.
+    fitb_top_answers_ttl: int = 60 * 60
+
     # Select normal mode or a high-stakes assessment mode (for administering a examination). In this mode, answers to supported question types are not shown.
     is_exam: bool = False
 
+    # Configure `literate programming builds <../internal/lp_builds.py>`. Builds time out after ``lp_build_timeout`` seconds. By default, a request waits for its build to finish. If ``lp_build_wait`` is set, a build which doesn't finish within this many seconds continues in the background and the request returns a ``build_id`` instead; only set this once the client polls the ``lp_build`` endpoint for these results. Each worker runs at most ``lp_course_concurrency`` builds per course at a time.
+    lp_build_wait: Optional[float] = None
+    lp_build_timeout: float = 60
+    lp_course_concurrency: int = 4
+    # Select the backend which runs builds; see ``LpBuilderBackend``. ``lp_local_processes`` is the number of build processes per webserver worker used by the ``local`` backend.
+    lp_builder_backend: LpBuilderBackend = "celery"  # type: ignore
+    lp_local_processes: int = 2
+
     # This module provides "/auth/login" but it is super basic
     # For now, logins are meant to be handled by the parallel runestone server.
     # For production usage set the LOGIN_URL to /runestone/default/user
@@ -177,6 +291,13 @@ class Settings(BaseSettings):
     spaces_secret = "secret"
     region = "nyc3"  # this is the DO data center or AWS region
     bucket = "runestonefiles"
+    # Point this at a local S3 stand-in (such as MinIO) for testing; these usually need a ``spaces_addressing_style`` of ``path``.
+    spaces_endpoint_url = "https://nyc3.digitaloceanspaces.com"
+    spaces_addressing_style: S3AddressingStyle = "auto"  # type: ignore
+    # The maximum number of uploads in progress per worker, the maximum number of parts of one multipart upload sent at once, and the part size for multipart uploads, in bytes. The S3 client's connection pool holds ``upload_concurrency * upload_part_concurrency`` connections.
+    upload_concurrency: int = 4
+    upload_part_concurrency: int = 4
+    upload_chunk_size: int = 8 * 1024 * 1024
 
 
 settings = Settings()
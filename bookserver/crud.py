@@ -16,14 +16,14 @@ import datetime
 import hashlib
 import json
 from collections import namedtuple
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Type
 import traceback
 
 # Third-party imports
 # -------------------
 from fastapi.exceptions import HTTPException
 from pydal.validators import CRYPT
-from sqlalchemy import and_, distinct, func, update
+from sqlalchemy import and_, bindparam, distinct, func, insert, update
 from sqlalchemy.sql import select, text, delete
 from starlette.requests import Request
 
@@ -32,8 +32,10 @@ from . import schemas
 # Local application imports
 # -------------------------
 from .applogger import rslogger
-from .config import settings
-from .db import async_session
+from .config import DatabaseType, settings
+from .db import Base, db_replica_session, db_session, db_transaction
+from .internal.cache import AsyncTTLCache, RedisCacheTier, cache_ttl
+from .internal.db_metrics import instrument_module
 from .internal.utils import http_422error_detail
 from .models import (
     Assignment,
@@ -75,6 +77,7 @@ from .models import (
     UserSubChapterProgressValidator,
     UserTopicPractice,
     UserTopicPracticeValidator,
+    RunestoneComponentDict,
     runestone_component_dict,
 )
 
@@ -98,7 +101,7 @@ EVENT2TABLE = {
 # useinfo
 # -------
 async def create_useinfo_entry(log_entry: UseinfoValidation) -> UseinfoValidation:
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         new_entry = Useinfo(**log_entry.dict())
         rslogger.debug(f"timestamp = {log_entry.timestamp} ")
         rslogger.debug(f"New Entry = {new_entry}")
@@ -126,12 +129,40 @@ async def count_useinfo_for(
         )
         .group_by(Useinfo.act)
     )
-    async with async_session() as session:
+    async with db_replica_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"res = {res}")
         return res.all()
 
 
+# Return a list of (day, act, count) for the multiple choice answers to ``div_id`` in ``course_name`` logged on or after ``start_date``, where ``day`` is the date of the answer (in UTC). The `answer counts <internal/answer_counts.py>` load their counts using this.
+async def count_mchoice_acts_by_day(
+    div_id: str, course_name: str, start_date: datetime.date
+) -> List[Tuple[datetime.date, str, int]]:
+    day = func.date(Useinfo.timestamp)
+    query = (
+        select(day, Useinfo.act, func.count(Useinfo.act))
+        .where(
+            (Useinfo.div_id == div_id)
+            & (Useinfo.course_id == course_name)
+            & (Useinfo.event == "mChoice")
+            & (Useinfo.timestamp >= start_date)
+        )
+        .group_by(day, Useinfo.act)
+    )
+    async with db_replica_session() as session:
+        res = await session.execute(query)
+        # SQLite returns the date as a string.
+        return [
+            (
+                d if isinstance(d, datetime.date) else datetime.date.fromisoformat(d),
+                act,
+                count,
+            )
+            for d, act, count in res.all()
+        ]
+
+
 async def fetch_chapter_for_subchapter(subchapter: str, base_course: str) -> str:
     """
     Used for pretext books where the subchapter is unique across the book
@@ -151,48 +182,33 @@ async def fetch_chapter_for_subchapter(subchapter: str, base_course: str) -> str
             & (SubChapter.sub_chapter_label == subchapter)
         )
     )
-    async with async_session() as session:
+    async with db_session() as session:
         chapter_label = await session.execute(query)
         return chapter_label.scalars().first()
 
 
 async def fetch_page_activity_counts(
-    chapter: str, subchapter: str, base_course: str, course_name: str, username: str
+    div_ids: List[str], course_name: str, username: str
 ) -> Dict[str, int]:
     """
-    Used for the progress bar at the bottom of each page.  This function
-    finds all of the components for a particular page (chaper/subchapter)
-    and then finds out which of those elements the student has interacted
-    with.  It returns a dictionary of {divid: 0/1}
+    Used for the progress bar at the bottom of each page.  Given all of the
+    components for a particular page (chaper/subchapter), which come from the
+    `book index <internal/book_index.py>`, find out which of those elements the
+    student has interacted with.  It returns a dictionary of {divid: 0/1}
     """
 
-    where_clause_common = (
-        (Question.subchapter == subchapter)
-        & (Question.chapter == chapter)
-        & (Question.from_source == True)  # noqa: E712
-        & (
-            (Question.optional == False)  # noqa: E712
-            | (Question.optional == None)  # noqa: E711
-        )
-        & (Question.base_course == base_course)
-    )
-
-    query = select(Question).where(where_clause_common)
-
-    async with async_session() as session:
-        page_divids = await session.execute(query)
-    rslogger.debug(f"PDVD {page_divids}")
-    div_counts = {q.name: 0 for q in page_divids.scalars()}
+    div_counts = {div_id: 0 for div_id in div_ids}
+    if not div_ids:
+        return div_counts
     query = select(distinct(Useinfo.div_id)).where(
-        where_clause_common
-        & (Question.name == Useinfo.div_id)
+        (Useinfo.div_id.in_(div_ids))
         & (Useinfo.course_id == course_name)
         & (Useinfo.sid == username)
     )
-    async with async_session() as session:
+    async with db_session() as session:
         sid_counts = await session.execute(query)
 
-    # doing a call to scalars() on a single column join query like this reduces
+    # doing a call to scalars() on a single column query like this reduces
     # the row to just the string.  So each row is just a string representing a unique
     # div_id the user has interacted with on this page.
     for row in sid_counts.scalars():
@@ -201,6 +217,16 @@ async def fetch_page_activity_counts(
     return div_counts
 
 
+# Return every div_id the student has interacted with in this course. The `activity tracker <internal/activity.py>` uses this to load its set for a student.
+async def fetch_interacted_div_ids(course_name: str, sid: str) -> List[str]:
+    query = select(distinct(Useinfo.div_id)).where(
+        (Useinfo.course_id == course_name) & (Useinfo.sid == sid)
+    )
+    async with db_session() as session:
+        res = await session.execute(query)
+        return [div_id for div_id in res.scalars() if div_id]
+
+
 async def fetch_poll_summary(div_id: str, course_name: str) -> List[tuple]:
     """
     find the last answer for each student and then aggregate
@@ -215,15 +241,37 @@ async def fetch_poll_summary(div_id: str, course_name: str) -> List[tuple]:
         on id = T.mid group by act"""
     )
 
-    async with async_session() as session:
+    async with db_replica_session() as session:
         rows = await session.execute(
             query, params=dict(div_id=div_id, course_name=course_name)
         )
         return rows.all()
 
 
+# Return a list of (sid, act) holding each student's last response to the poll ``div_id`` in ``course_name``. The `poll tallies <internal/poll_tally.py>` are built from this.
+async def fetch_poll_votes(div_id: str, course_name: str) -> List[Tuple[str, str]]:
+    query = text(
+        """select useinfo.sid, act from useinfo
+        join (select sid,  max(id) mid
+        from useinfo where event='poll' and div_id = :div_id and course_id = :course_name group by sid) as T
+        on id = T.mid"""
+    )
+    async with db_session() as session:
+        rows = await session.execute(
+            query, params=dict(div_id=div_id, course_name=course_name)
+        )
+        return [tuple(row) for row in rows.all()]
+
+
 async def fetch_top10_fitb(dbcourse: CoursesValidator, div_id: str) -> List[tuple]:
     "Return the top 10 answers to a fill in the blank question"
+    return await count_fitb_answers(dbcourse, div_id, 10)
+
+
+# Return a list of (answer, count) for the answers to the fill in the blank question ``div_id`` since the start of the term, most common first, omitting missing answers. If ``limit`` is given, return only that many. The `top answers <internal/fitb_top_answers.py>` are loaded from this.
+async def count_fitb_answers(
+    dbcourse: CoursesValidator, div_id: str, limit: Optional[int] = None
+) -> List[tuple]:
     rcd = runestone_component_dict["fitb_answers"]
     tbl = rcd.model
     query = (
@@ -232,12 +280,14 @@ async def fetch_top10_fitb(dbcourse: CoursesValidator, div_id: str) -> List[tupl
             (tbl.div_id == div_id)
             & (tbl.course_name == dbcourse.course_name)
             & (tbl.timestamp > dbcourse.term_start_date)
+            & (tbl.answer.isnot(None))
         )
         .group_by(tbl.answer)
         .order_by(func.count(tbl.answer).desc())
-        .limit(10)
     )
-    async with async_session() as session:
+    if limit is not None:
+        query = query.limit(limit)
+    async with db_replica_session() as session:
         rows = await session.execute(query)
         return rows.all()
 
@@ -253,13 +303,101 @@ async def create_answer_table_entry(
     rslogger.debug(f"hello from create at {log_entry}")
     rcd = runestone_component_dict[EVENT2TABLE[event]]
     new_entry = rcd.model(**log_entry.dict())  # type: ignore
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_entry)
 
     rslogger.debug(f"returning {new_entry}")
     return rcd.validator.from_orm(new_entry)  # type: ignore
 
 
+# Return up to ``limit`` answers (as validators) with an ID greater than ``after_id``, in order of ID, from the answer table for ``rcd``. Only answers from ``course_names`` (and to ``div_id``, if given) are included. Paging by ID (keyset pagination) keeps each query fast no matter how far into the table it is.
+async def fetch_answer_chunk(
+    rcd: RunestoneComponentDict,
+    course_names: List[str],
+    div_id: Optional[str],
+    after_id: int,
+    limit: int,
+) -> List[Any]:
+    tbl = rcd.model
+    query = select(tbl).where((tbl.course_name.in_(course_names)) & (tbl.id > after_id))
+    if div_id is not None:
+        query = query.where(tbl.div_id == div_id)
+    query = query.order_by(tbl.id).limit(limit)
+    async with db_session() as session:
+        res = await session.execute(query)
+        return [rcd.validator.from_orm(row) for row in res.scalars()]
+
+
+# Count the answers ``fetch_answer_chunk`` would return, starting from the beginning of the table.
+async def count_answers(
+    model: Type[Base], course_names: List[str], div_id: Optional[str]
+) -> int:
+    query = select(func.count(model.id)).where(model.course_name.in_(course_names))
+    if div_id is not None:
+        query = query.where(model.div_id == div_id)
+    async with db_session() as session:
+        return (await session.execute(query)).scalar()
+
+
+# Update the grades of answers in one statement executed for many rows. Each item of ``grades`` is a dict with the key ``_id`` (the row's ID) plus the columns to update, usually ``correct`` and ``percent``; every item must update the same columns.
+async def update_answer_grades(model: Type[Base], grades: List[dict]) -> None:
+    if not grades:
+        return
+    table = model.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam("_id"))
+        .values(
+            {
+                column: bindparam(column, type_=table.c[column].type)
+                for column in grades[0]
+                if column != "_id"
+            }
+        )
+    )
+    async with db_transaction() as session:
+        await session.execute(stmt, grades)
+
+
+# Update the answer ``sid`` submitted to ``div_id`` in ``course_name`` at ``timestamp``, setting the columns in ``values``. Return the number of rows updated. This records grades which are determined after the answer was stored, such as a deferred `literate programming build <../internal/lp_builds.py>`.
+async def update_answer_entry(
+    model: Type[Base],
+    sid: str,
+    div_id: str,
+    course_name: str,
+    timestamp: datetime.datetime,
+    values: Dict[str, Any],
+) -> int:
+    stmt = (
+        update(model)
+        .where(
+            (model.sid == sid)
+            & (model.div_id == div_id)
+            & (model.course_name == course_name)
+            & (model.timestamp == timestamp)
+        )
+        .values(**values)
+    )
+    async with db_transaction() as session:
+        return (await session.execute(stmt)).rowcount
+
+
+# Bulk inserts
+# ------------
+# Insert rows into one or more tables in a single transaction. ``entries`` maps a model to a list of dicts, each holding the column values for one row. The `write-behind ingestion pipeline <../internal/ingest.py>` uses this to coalesce many ``useinfo`` and answer table rows into a few statements.
+async def create_many_entries(entries: Dict[Type[Base], List[dict]]) -> None:
+    async with db_transaction() as session:
+        for model, rows in entries.items():
+            if not rows:
+                continue
+            if settings.database_type == DatabaseType.PostgreSQL:
+                # Send a single multi-row ``INSERT ... VALUES (...), (...)``.
+                await session.execute(insert(model).values(rows))
+            else:
+                # SQLite limits the number of bound parameters in one statement, which a large multi-row ``INSERT`` easily exceeds; use ``executemany`` instead.
+                await session.execute(insert(model), rows)
+
+
 async def fetch_last_answer_table_entry(
     query_data: schemas.AssessmentRequest,
 ) -> schemas.LogItemIncoming:
@@ -278,7 +416,7 @@ async def fetch_last_answer_table_entry(
         )
         .order_by(tbl.timestamp.desc())
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"res = {res}")
         return rcd.validator.from_orm(res.scalars().first())  # type: ignore
@@ -297,16 +435,31 @@ async def fetch_last_poll_response(sid: str, course_name: str, poll_id: str) ->
         )
         .order_by(Useinfo.id.desc())
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         return res.scalars().first()
 
 
 # Courses
 # -------
+# Course rows are read several times per request but rarely change, so cache them. ``fetch_course`` results are keyed by course name; ``fetch_base_course`` results are keyed by ``("base", base_course)``. A course that doesn't exist is cached only briefly, since the web2py server may create it at any time.
+_course_cache: AsyncTTLCache[Optional[CoursesValidator]] = AsyncTTLCache(
+    "courses",
+    cache_ttl(settings.course_cache_ttl),
+    settings.course_cache_size,
+    negative_ttl=settings.course_cache_negative_ttl,
+)
+
+
 async def fetch_course(course_name: str) -> CoursesValidator:
+    return await _course_cache.get_or_load(
+        course_name, lambda: _fetch_course(course_name)
+    )
+
+
+async def _fetch_course(course_name: str) -> CoursesValidator:
     query = select(Courses).where(Courses.course_name == course_name)
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         # When selecting ORM entries it is useful to use the ``scalars`` method
         # This modifies the result so that you are getting the ORM object
@@ -316,10 +469,16 @@ async def fetch_course(course_name: str) -> CoursesValidator:
 
 
 async def fetch_base_course(base_course: str) -> CoursesValidator:
+    return await _course_cache.get_or_load(
+        ("base", base_course), lambda: _fetch_base_course(base_course)
+    )
+
+
+async def _fetch_base_course(base_course: str) -> CoursesValidator:
     query = select(Courses).where(
         (Courses.base_course == base_course) & (Courses.course_name == base_course)
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         # When selecting ORM entries it is useful to use the ``scalars`` method
         # This modifies the result so that you are getting the ORM object
@@ -328,10 +487,28 @@ async def fetch_base_course(base_course: str) -> CoursesValidator:
         return CoursesValidator.from_orm(base_course)
 
 
+# Return the names of all courses using ``base_course`` (including the base course itself).
+async def fetch_courses_for_base_course(base_course: str) -> List[str]:
+    query = select(Courses.course_name).where(Courses.base_course == base_course)
+    async with db_session() as session:
+        return list((await session.execute(query)).scalars())
+
+
 async def create_course(course_info: CoursesValidator) -> None:
     new_course = Courses(**course_info.dict())
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_course)
+    invalidate_course(course_info.course_name)
+
+
+# Remove a course from the cache; call this after changing a course's row. Omit ``course_name`` to clear the entire cache.
+def invalidate_course(course_name: Optional[str] = None) -> None:
+    if course_name is None:
+        _course_cache.clear()
+    else:
+        _course_cache.invalidate(course_name)
+        # The course may also be cached as a base course.
+        _course_cache.invalidate(("base", course_name))
 
 
 # course_attributes
@@ -341,7 +518,7 @@ async def create_course(course_info: CoursesValidator) -> None:
 async def fetch_all_course_attributes(course_id: int) -> dict:
     query = select(CourseAttribute).where(CourseAttribute.course_id == course_id)
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         return {row.attr: row.value for row in res.scalars().fetchall()}
 
@@ -360,7 +537,7 @@ async def get_course_origin(base_course):
         & (CourseAttribute.attr == "markup_system")
     )
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         ca = res.scalars().first()
         return ca.value
@@ -368,9 +545,32 @@ async def get_course_origin(base_course):
 
 # auth_user
 # ---------
-async def fetch_user(user_name: str) -> AuthUserValidator:
+# The ``user_loader`` in `session.py` fetches the current user on every authenticated request, so cache users by username. The TTL is short, since web2py may change a user's row (for example, when the user changes courses). When ``settings.redis_cache`` is true, cached users are also shared between workers through Redis, without their password hash and secret keys; a user read from Redis has blanks in these fields. Code which checks a password must therefore use ``use_cache=False``.
+_user_cache: AsyncTTLCache[Optional[AuthUserValidator]] = AsyncTTLCache(
+    "users",
+    cache_ttl(settings.user_cache_ttl),
+    settings.user_cache_size,
+    negative_ttl=settings.user_cache_negative_ttl,
+    shared=RedisCacheTier(
+        "auth_user",
+        AuthUserValidator,
+        dict(password="", registration_key="", reset_password_key=""),
+    )
+    if settings.redis_cache
+    else None,
+)
+
+
+# Fetch a user; set ``use_cache`` to False to always query the database.
+async def fetch_user(user_name: str, use_cache: bool = True) -> AuthUserValidator:
+    if not use_cache:
+        return await _fetch_user(user_name)
+    return await _user_cache.get_or_load(user_name, lambda: _fetch_user(user_name))
+
+
+async def _fetch_user(user_name: str) -> AuthUserValidator:
     query = select(AuthUser).where(AuthUser.username == user_name)
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         user = res.scalars().one_or_none()
     return AuthUserValidator.from_orm(user)
@@ -381,7 +581,8 @@ async def create_user(user: AuthUserValidator) -> Optional[AuthUserValidator]:
     The given user will have the password in plain text.  First we will hash
     the password then add this user to the database.
     """
-    if await fetch_user(user.username):
+    # Don't trust a cached (possibly negative) result here.
+    if await fetch_user(user.username, use_cache=False):
         raise HTTPException(
             status_code=422,
             detail=http_422error_detail(
@@ -392,8 +593,10 @@ async def create_user(user: AuthUserValidator) -> Optional[AuthUserValidator]:
     new_user = AuthUser(**user.dict())
     crypt = CRYPT(key=settings.web2py_private_key, salt=True)
     new_user.password = str(crypt(user.password)[0])
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_user)
+    # Forget any cached lookup which found no user with this name.
+    await _user_cache.invalidate_shared(user.username)
     return AuthUserValidator.from_orm(new_user)
 
 
@@ -417,7 +620,7 @@ async def fetch_instructor_courses(
         )
     else:
         query = query.where(CourseInstructor.instructor == instructor_id)
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
 
         course_list = [
@@ -430,7 +633,7 @@ async def fetch_instructor_courses(
 # ----
 async def create_code_entry(data: CodeValidator) -> CodeValidator:
     new_code = Code(**data.dict())
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_code)
 
     return CodeValidator.from_orm(new_code)
@@ -442,7 +645,7 @@ async def fetch_code(sid: str, acid: str, course_id: int) -> List[CodeValidator]
         .where((Code.sid == sid) & (Code.acid == acid) & (Code.course_id == course_id))
         .order_by(Code.id)
     )
-    async with async_session() as session:
+    async with db_replica_session() as session:
         res = await session.execute(query)
 
         code_list = [CodeValidator.from_orm(x) for x in res.scalars().fetchall()]
@@ -452,7 +655,29 @@ async def fetch_code(sid: str, acid: str, course_id: int) -> List[CodeValidator]
 # Server-side grading
 # -------------------
 # Return the feedback associated with this question if this question should be graded on the server instead of on the client; otherwise, return None.
-async def is_server_feedback(div_id, course):
+#
+# This runs for every answer submitted, but feedback only changes when a book is rebuilt. So, cache the decoded feedback by (div_id, course). Each entry holds (base course, feedback), so that `invalidate_server_feedback` can drop every entry for a book; the `book index <internal/book_index.py>` does this when it finds a book was republished. Callers must not modify the returned feedback, since it's shared.
+_feedback_cache: AsyncTTLCache[Tuple[Optional[str], Any]] = AsyncTTLCache(
+    "server_feedback",
+    cache_ttl(settings.feedback_cache_ttl),
+    settings.feedback_cache_size,
+)
+
+
+#
+# If ``event`` is given and its answer table has a ``feedback_compiler``, return (and cache) the compiled feedback instead.
+async def is_server_feedback(div_id, course, event: Optional[str] = None):
+    _, feedback = await _feedback_cache.get_or_load(
+        (div_id, course, event),
+        lambda: _fetch_server_feedback(div_id, course, event),
+    )
+    return feedback
+
+
+# Return (base course, decoded feedback or None).
+async def _fetch_server_feedback(
+    div_id, course, event: Optional[str]
+) -> Tuple[Optional[str], Any]:
     # Get the information about this question.
     query = (
         select(Question, Courses)
@@ -460,16 +685,37 @@ async def is_server_feedback(div_id, course):
         .join(Courses, Question.base_course == Courses.base_course)
         .where(Courses.course_name == course)
     )
-    async with async_session() as session:
+    async with db_session() as session:
         query_results = (await session.execute(query)).first()
 
+        if not query_results:
+            return None, None
         # Get the feedback, if it exists.
-        feedback = query_results and query_results.Question.feedback
+        feedback = query_results.Question.feedback
         # If there's feedback and a login is required (necessary for server-side grading), return the decoded feedback.
         if feedback and query_results.Courses.login_required:
-            return json.loads(feedback)
+            feedback = json.loads(feedback)
+            compiler = (
+                runestone_component_dict[EVENT2TABLE[event]].feedback_compiler
+                if event in EVENT2TABLE
+                else None
+            )
+            return query_results.Question.base_course, (
+                compiler(feedback) if compiler else feedback
+            )
         # Otherwise, grade on the client.
-        return None
+        return query_results.Question.base_course, None
+
+
+# Drop cached feedback for all questions in ``base_course``, or for all books if ``base_course`` is omitted.
+def invalidate_server_feedback(base_course: Optional[str] = None) -> None:
+    if base_course is None:
+        _feedback_cache.clear()
+    else:
+        # Also drop entries for questions which weren't found, since a rebuild may have added them.
+        _feedback_cache.invalidate_where(
+            lambda key, value: value[0] in (base_course, None)
+        )
 
 
 # Development and Testing Utils
@@ -542,7 +788,7 @@ async def create_initial_courses_users():
 
 async def create_user_state_entry(user_id: int, course_name: str) -> UserStateValidator:
     new_us = UserState(user_id=user_id, course_name=course_name)
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_us)
     return UserStateValidator.from_orm(new_us)
 
@@ -561,7 +807,7 @@ async def update_user_state(user_data: schemas.LastPageData):
         )
         .values(**ud)
     )
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         await session.execute(stmt)
     rslogger.debug("SUCCESS")
 
@@ -592,7 +838,7 @@ async def update_sub_chapter_progress(user_data: schemas.LastPageData):
         )
         .values(**ud)
     )
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         await session.execute(stmt)
 
 
@@ -620,7 +866,7 @@ async def fetch_last_page(user: AuthUserValidator, course_name: str):
         .order_by(UserState.last_page_accessed_on.desc())
     )
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         # for A query like this one with columns from multiple tables
         # res.first() returns a tuple
@@ -651,7 +897,7 @@ async def fetch_user_sub_chapter_progress(
 
     query = select(UserSubChapterProgress).where(where_clause)
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         return [
@@ -672,7 +918,7 @@ async def create_user_sub_chapter_progress_entry(
         start_date=datetime.datetime.utcnow(),
         course_name=user.course_name,
     )
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_uspe)
     return UserSubChapterProgressValidator.from_orm(new_uspe)
 
@@ -687,7 +933,7 @@ async def fetch_user_chapter_progress(
         & (UserChapterProgress.chapter_id == last_page_chapter)
     )
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         return UserChapterProgressValidator.from_orm(res.scalars().first())
@@ -702,7 +948,7 @@ async def create_user_chapter_progress_entry(
         status=status,
         start_date=datetime.datetime.utcnow(),
     )
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_ucp)
     return UserChapterProgressValidator.from_orm(new_ucp)
 
@@ -726,7 +972,7 @@ async def create_selected_question(
         points=points,
         competency=competency,
     )
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_sqv)
     return SelectedQuestionValidator.from_orm(new_sqv)
 
@@ -744,7 +990,7 @@ async def fetch_selected_question(
         (SelectedQuestion.sid == sid) & (SelectedQuestion.selector_id == selector_id)
     )
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         return SelectedQuestionValidator.from_orm(res.scalars().first())
@@ -763,7 +1009,7 @@ async def update_selected_question(sid: str, selector_id: str, selected_id: str)
         )
         .values(selected_id=selected_id)
     )
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         await session.execute(stmt)
     rslogger.debug("SUCCESS")
 
@@ -792,7 +1038,7 @@ async def fetch_question(
 
     query = select(Question).where(where_clause)
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         return QuestionValidator.from_orm(res.scalars().first())
@@ -802,7 +1048,7 @@ async def count_matching_questions(name: str) -> int:
 
     query = select(func.count(Question.name)).where(Question.name == name)
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         return res.scalars().first()
 
@@ -853,7 +1099,7 @@ async def fetch_matching_questions(request_data: schemas.SelectQRequest) -> List
             )
         query = select(Question.name).where(where_clause)
 
-        async with async_session() as session:
+        async with db_session() as session:
             res = await session.execute(query)
             rslogger.debug(f"{res=}")
             questionlist = []
@@ -876,7 +1122,7 @@ async def fetch_assignment_question(
         & (Question.name == question_name)
     )
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         return AssignmentQuestionValidator.from_orm(res.scalars().first())
@@ -897,7 +1143,7 @@ async def fetch_question_grade(sid: str, course_name: str, qid: str):
             QuestionGrade.id.desc(),
         )
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         return QuestionGradeValidator.from_orm(res.scalars().one_or_none())
 
@@ -916,7 +1162,7 @@ async def fetch_user_experiment(sid: str, ab_name: str) -> int:
         .where((UserExperiment.sid == sid) & (UserExperiment.experiment_id == ab_name))
         .order_by(UserExperiment.id)
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         r = res.scalars().first()
         rslogger.debug(f"{r=}")
@@ -931,7 +1177,7 @@ async def create_user_experiment_entry(
     for this particular experiment (ab)
     """
     new_ue = UserExperiment(sid=sid, exp_group=group, experiment_id=ab)
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         session.add(new_ue)
     return UserExperimentValidator.from_orm(new_ue)
 
@@ -949,7 +1195,7 @@ async def fetch_viewed_questions(sid: str, questionlist: List[str]) -> List[str]
     query = select(Useinfo).where(
         (Useinfo.sid == sid) & (Useinfo.div_id.in_(questionlist))
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         rlist = [row.div_id for row in res]
@@ -958,7 +1204,7 @@ async def fetch_viewed_questions(sid: str, questionlist: List[str]) -> List[str]
 
 async def fetch_previous_selections(sid) -> List[str]:
     query = select(SelectedQuestion).where(SelectedQuestion.sid == sid)
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         return [row.selected_id for row in res.scalars().fetchall()]
@@ -976,7 +1222,7 @@ async def fetch_timed_exam(
         )
         .order_by(TimedExam.id.desc())
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         return TimedExamValidator.from_orm(res.scalars().first())
@@ -999,15 +1245,50 @@ async def fetch_subchapters(course, chap):
         .order_by(SubChapter.sub_chapter_num)
     )
 
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         # **Note** with this kind of query you do NOT want to call ``.scalars()`` on the result
         return res
 
 
+# Return the structure of a book, for use by the `book index <internal/book_index.py>`:
+#
+# - A list of (chapter label, subchapter label, subchapter name), in book order.
+# - A list of (chapter label, subchapter label, question name) for the questions a student must answer to complete a page; these are the questions from the book's source which aren't optional.
+async def fetch_book_structure(
+    base_course: str,
+) -> Tuple[List[Tuple[str, str, str]], List[Tuple[str, str, str]]]:
+    toc_query = (
+        select(
+            Chapter.chapter_label,
+            SubChapter.sub_chapter_label,
+            SubChapter.sub_chapter_name,
+        )
+        .join(SubChapter, Chapter.id == SubChapter.chapter_id)
+        .where(Chapter.course_id == base_course)
+        .order_by(Chapter.chapter_num, SubChapter.sub_chapter_num)
+    )
+    question_query = (
+        select(Question.chapter, Question.subchapter, Question.name)
+        .where(
+            (Question.base_course == base_course)
+            & (Question.from_source == True)  # noqa: E712
+            & (
+                (Question.optional == False)  # noqa: E712
+                | (Question.optional == None)  # noqa: E711
+            )
+        )
+        .order_by(Question.id)
+    )
+    async with db_session() as session:
+        toc = (await session.execute(toc_query)).all()
+        questions = (await session.execute(question_query)).all()
+    return [tuple(row) for row in toc], [tuple(row) for row in questions]
+
+
 async def create_traceback(exc: Exception, request: Request, host: str):
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         tbtext = "".join(traceback.format_tb(exc.__traceback__))
         new_entry = TraceBack(
             traceback=tbtext,
@@ -1027,7 +1308,7 @@ async def fetch_library_books():
         .where(Library.is_visible == True)  # noqa: E712
         .order_by(Library.shelf_section, Library.title)
     )
-    async with async_session() as session:
+    async with db_replica_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         book_list = [LibraryValidator.from_orm(x) for x in res.scalars().fetchall()]
@@ -1048,7 +1329,7 @@ async def fetch_course_practice(course_name: str) -> CoursePractice:
         .where(CoursePractice.course_name == course_name)
         .order_by(CoursePractice.id.desc())
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         return res.scalars().first()
 
@@ -1073,7 +1354,7 @@ async def fetch_one_user_topic_practice(
         & (UserTopicPractice.sub_chapter_label == last_page_subchapter)
         & (UserTopicPractice.question_name == qname)
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         utp = res.scalars().first()
@@ -1087,7 +1368,7 @@ async def delete_one_user_topic_practice(qid: int) -> None:
     can see.
     """
     query = delete(UserTopicPractice).where(UserTopicPractice.id == qid)
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         await session.execute(query)
 
 
@@ -1103,7 +1384,7 @@ async def create_user_topic_practice(
     """
     Add a question for the user to practice on
     """
-    async with async_session.begin() as session:
+    async with db_transaction() as session:
         new_entry = UserTopicPractice(
             user_id=user.id,
             course_name=user.course_name,
@@ -1143,9 +1424,15 @@ async def fetch_qualified_questions(
         & (Question.practice == True)  # noqa: E712
         & (Question.review_flag == False)  # noqa: E712
     )
-    async with async_session() as session:
+    async with db_session() as session:
         res = await session.execute(query)
         rslogger.debug(f"{res=}")
         questionlist = [QuestionValidator.from_orm(x) for x in res.scalars().fetchall()]
 
     return questionlist
+
+
+# Metrics
+# -------
+# Record the latency and queries of each function above; see `internal/db_metrics.py`. This must come last, so that it wraps every function.
+instrument_module(globals())
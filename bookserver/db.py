@@ -9,7 +9,11 @@
 #
 # Standard library
 # ----------------
-# None.
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Optional
+
 #
 # Third-party imports
 # -------------------
@@ -18,11 +22,14 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.sql import select
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
 
 # Local application imports
 # -------------------------
 from .config import settings, BookServerConfig, DatabaseType
 from .applogger import rslogger
+from .internal.db_metrics import InstrumentedQueuePool, instrument_engine
 
 
 if settings.database_type == DatabaseType.SQLite:
@@ -36,12 +43,51 @@ extra_settings = (
     if settings.book_server_config == BookServerConfig.test
     else dict(echo=settings.db_echo)
 )
+# Size the connection pool for PostgreSQL; SQLite uses a pool without these settings. See ``db_pool_size`` in `config.py`.
+pool_settings = (
+    {}
+    if settings.database_type == DatabaseType.SQLite
+    else dict(
+        poolclass=InstrumentedQueuePool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+    )
+)
 engine = create_async_engine(
-    settings.database_url, connect_args=connect_args, **extra_settings
+    settings.database_url,
+    connect_args=connect_args,
+    pool_pre_ping=settings.db_pool_pre_ping,
+    pool_recycle=settings.db_pool_recycle,
+    **pool_settings,
+    **extra_settings,
 )
+# Record pool and query metrics; see `internal/db_metrics.py`.
+instrument_engine(engine)
 # This creates the SessionLocal class.  An actual session is an instance of this class.
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# _`read replicas`: If a replica is configured, create an engine and sessions for it; see ``db_replica_session``.
+replica_engine = (
+    create_async_engine(
+        settings.replica_database_url,
+        connect_args=connect_args,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        pool_recycle=settings.db_pool_recycle,
+        **pool_settings,
+        **extra_settings,
+    )
+    if settings.replica_database_url
+    else None
+)
+if replica_engine:
+    instrument_engine(replica_engine)
+replica_session = (
+    sessionmaker(replica_engine, class_=AsyncSession, expire_on_commit=False)
+    if replica_engine
+    else None
+)
+
 # This creates the base class we will use to create models
 Base = declarative_base()
 
@@ -89,9 +135,170 @@ async def check_not_null():
 # If the engine isn't disposed of, then a PostgreSQL database will remain in a pseudo-locked state, refusing to drop or truncate tables (see `bookserver_session`).
 async def term_models():
     await engine.dispose()
+    if replica_engine:
+        await replica_engine.dispose()
 
 
 # Dependency
 async def get_session() -> AsyncSession:
     async with async_session() as session:
         yield session
+
+
+# Request-scoped sessions
+# =======================
+# Each function in `crud.py` uses a session for a single read (``db_session``) or write (``db_transaction``). Outside a request, each of these opens its own session, then closes it (committing a write). During a request, they instead share one session, the request's *unit of work*: the request checks out one connection, and all its writes are committed together just before the response is sent (see `RequestSessionMiddleware`). If an error escapes the request, the unit of work is rolled back; an error while writing rolls back only the writes of that ``db_transaction`` block.
+#
+# After each read or write, the shared session flushes then forgets (expunges) the objects it loaded, so that crud functions behave as they did with a session of their own: the objects they return are detached, and the next query loads fresh rows.
+#
+# Only the task serving the request uses its unit of work. Other tasks, such as those created by ``asyncio.gather`` or background tasks which outlive the request, use sessions of their own, since a session can't be shared by concurrent tasks.
+#
+# The unit of work also records whether the request wrote to the database, so that `read replicas` aren't used until the replica has caught up with these writes.
+class _UnitOfWork:
+    def __init__(self, pinned: bool) -> None:
+        self.task = asyncio.current_task()
+        self.session: Optional[AsyncSession] = None
+        self.closed = False
+        # True if this request wrote to the database.
+        self.wrote = False
+        # True if this client wrote to the database recently, so reads must use the primary.
+        self.pinned = pinned
+
+    # Commit the work done so far, returning the connection to the pool.
+    async def commit(self) -> None:
+        if self.session is not None:
+            await self.session.commit()
+
+    # End the unit of work, committing it if ``commit`` is true and rolling it back otherwise.
+    async def close(self, commit: bool) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.session is not None:
+            try:
+                if commit:
+                    await self.session.commit()
+            finally:
+                await self.session.close()
+
+
+_unit_of_work: ContextVar[Optional[_UnitOfWork]] = ContextVar(
+    "unit_of_work", default=None
+)
+
+
+# Return the session of the current request's unit of work, or None if the caller should use its own session.
+def _request_session() -> Optional[AsyncSession]:
+    uow = _unit_of_work.get()
+    if (
+        uow is None
+        or uow.closed
+        or uow.task is not asyncio.current_task()
+        or not settings.db_request_session
+    ):
+        return None
+    if uow.session is None:
+        uow.session = async_session()
+    return uow.session
+
+
+# Provide a session for reading.
+@asynccontextmanager
+async def db_session() -> AsyncIterator[AsyncSession]:
+    session = _request_session()
+    if session is None:
+        async with async_session() as session:
+            yield session
+    else:
+        try:
+            yield session
+        finally:
+            session.expunge_all()
+
+
+# Provide a session for writing. Changes are committed at the end of the block, or at the end of the request's unit of work.
+@asynccontextmanager
+async def db_transaction() -> AsyncIterator[AsyncSession]:
+    note_write()
+    session = _request_session()
+    if session is None:
+        async with async_session.begin() as session:
+            yield session
+    else:
+        try:
+            # Use a savepoint, so that an error undoes only this block's writes, not the request's earlier writes; a caller may catch the error and carry on. Leaving the block writes now (releasing the savepoint), so that the caller sees generated primary keys and any errors.
+            async with session.begin_nested():
+                yield session
+        finally:
+            session.expunge_all()
+
+
+# Record that the current request writes to the database. ``db_transaction`` calls this; code which writes by other means (such as the `write-behind ingestion pipeline <internal/ingest.py>`) should call it too.
+def note_write() -> None:
+    uow = _unit_of_work.get()
+    if uow is not None and not uow.closed:
+        uow.wrote = True
+
+
+# Provide a session for a read which may use the `read replica <read replicas>`. Use this only for queries which tolerate slightly stale data, such as summaries of a class's answers. Reads use the primary when there's no replica, or if the current request or a recent request from the same client wrote to the database.
+@asynccontextmanager
+async def db_replica_session() -> AsyncIterator[AsyncSession]:
+    uow = _unit_of_work.get()
+    if (
+        replica_session is None
+        or uow is not None
+        and not uow.closed
+        and (uow.wrote or uow.pinned)
+    ):
+        async with db_session() as session:
+            yield session
+    else:
+        async with replica_session() as session:
+            yield session
+
+
+# Commit the current request's work so far and return its connection to the pool; the next query checks out a connection again. Call this before waiting a long time for something other than the database, so that the request doesn't hold a connection while it waits.
+async def release_db_session() -> None:
+    uow = _unit_of_work.get()
+    if uow is not None and not uow.closed and uow.task is asyncio.current_task():
+        await uow.commit()
+
+
+# The cookie which marks a client which wrote to the database recently; see `read replicas`.
+_PRIMARY_COOKIE = "RS_primary"
+
+
+# Provide a unit of work for each HTTP request. This is a plain ASGI middleware, rather than a ``BaseHTTPMiddleware``, so that the endpoint runs in the same task, and so that the unit of work can be committed when the response starts, before the client sees the response.
+class RequestSessionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        uow = _UnitOfWork(
+            replica_engine is not None
+            and _PRIMARY_COOKIE in HTTPConnection(scope).cookies
+        )
+        token = _unit_of_work.set(uow)
+
+        async def send_after_commit(message):
+            if message["type"] == "http.response.start":
+                await uow.close(True)
+                if uow.wrote and replica_engine is not None:
+                    # Send this client's reads to the primary until the replica catches up.
+                    headers = MutableHeaders(scope=message)
+                    headers.append(
+                        "set-cookie",
+                        f"{_PRIMARY_COOKIE}=1; Max-Age={int(settings.replica_max_lag) + 1}; Path=/; HttpOnly; SameSite=Lax",
+                    )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_after_commit)
+        finally:
+            # If no response was started, an error occurred; roll back.
+            await uow.close(False)
+            _unit_of_work.reset(token)
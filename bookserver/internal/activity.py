@@ -0,0 +1,103 @@
+# **************************************************
+# |docname| - Track the questions a student has used
+# **************************************************
+# The progress bar at the bottom of each page shows which of the page's questions a student has interacted with; that is, which have a ``useinfo`` row for this student and course. ``useinfo`` is the largest table in the system, so instead of querying it for every page view, this module keeps a Redis set per student and course of the div_ids the student has interacted with. The logging endpoints in `../routers/rslogging.py` add to this set as they log events, and the progress bar needs only a few set lookups.
+#
+# A set is loaded from the database the first time it's needed. A set may exist before then, since logging an event adds to it; therefore, loading also sets a marker key, ``interacted:{course}:{sid}:loaded``, to show that the set is complete. (Any string, even an empty one, may be a div_id, so the marker can't be a member of the set.) The set and its marker are given the same expiry time whenever either is written, so the set never expires before its marker.
+#
+# This is used only when ``settings.redis_cache`` is true; otherwise, or if Redis is unavailable, the progress bar queries the database as before.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+from typing import Dict, List, Optional
+
+# Third-party imports
+# -------------------
+import aioredis
+
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import settings
+from ..crud import fetch_interacted_div_ids, fetch_page_activity_counts
+from .redis_client import get_redis
+
+
+def _key(course_name: str, sid: str) -> str:
+    return f"interacted:{course_name}:{sid}"
+
+
+def _loaded_key(key: str) -> str:
+    return f"{key}:loaded"
+
+
+# Record that ``sid`` interacted with ``div_id``.
+async def record_interaction(course_name: str, sid: str, div_id: str) -> None:
+    if not settings.redis_cache:
+        return
+    key = _key(course_name, sid)
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            await pipe.sadd(key, div_id).expire(
+                key, settings.activity_cache_ttl
+            ).expire(_loaded_key(key), settings.activity_cache_ttl).execute()
+    except (aioredis.RedisError, OSError) as e:
+        # The set is now incomplete; drop it so it will be reloaded.
+        rslogger.warning(f"Unable to record interaction in Redis: {e}")
+        await _discard(key)
+
+
+# Return a dict of {div_id: 0/1} for the given ``div_ids``, where 1 means ``sid`` has interacted with that div_id.
+async def fetch_activity_counts(
+    div_ids: List[str], course_name: str, sid: str
+) -> Dict[str, int]:
+    if not div_ids:
+        return {}
+    if settings.redis_cache:
+        counts = await _fetch_from_redis(div_ids, course_name, sid)
+        if counts is not None:
+            return counts
+    return await fetch_page_activity_counts(div_ids, course_name, sid)
+
+
+# Look up ``div_ids`` in the student's set, loading it if necessary. Return None if Redis can't answer.
+async def _fetch_from_redis(
+    div_ids: List[str], course_name: str, sid: str
+) -> Optional[Dict[str, int]]:
+    key = _key(course_name, sid)
+    try:
+        r = get_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.exists(_loaded_key(key))
+            for div_id in div_ids:
+                pipe.sismember(key, div_id)
+            loaded, *members = await pipe.execute()
+        if not loaded:
+            # Events logged while loading are added to the set as usual, so a union with the database's results is complete.
+            all_div_ids = await fetch_interacted_div_ids(course_name, sid)
+            async with r.pipeline(transaction=True) as pipe:
+                if all_div_ids:
+                    pipe.sadd(key, *all_div_ids)
+                await pipe.expire(key, settings.activity_cache_ttl).set(
+                    _loaded_key(key), 1, ex=settings.activity_cache_ttl
+                ).execute()
+            interacted = set(all_div_ids)
+            return {
+                div_id: int(bool(member) or div_id in interacted)
+                for div_id, member in zip(div_ids, members)
+            }
+        return {div_id: int(bool(member)) for div_id, member in zip(div_ids, members)}
+    except (aioredis.RedisError, OSError) as e:
+        rslogger.warning(f"Unable to read interactions from Redis: {e}")
+        return None
+
+
+async def _discard(key: str) -> None:
+    try:
+        await get_redis().delete(key, _loaded_key(key))
+    except (aioredis.RedisError, OSError):
+        pass
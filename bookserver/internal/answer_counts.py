@@ -0,0 +1,172 @@
+# **************************************************************
+# |docname| - Counts of the answers to multiple choice questions
+# **************************************************************
+# The "compare me" button of a multiple choice question shows how often each answer was chosen in the student's course (see ``getaggregateresults`` in `../routers/assessment.py`): since the start of the term or, for a base course (which may have years of data), in the last 90 days. Counting these answers means a ``GROUP BY`` over ``useinfo``, the largest table in the system, for every click. Instead, this module keeps the counts in Redis, updating them as the `log_book_event endpoint` logs each answer.
+#
+# The counts for a question in a course are stored in one Redis hash, with a field ``day|act`` per day and answer (``act``) holding the number of times that answer was logged that day. Counting by day supports both variants: the counts since a start date are the sum of the fields on or after that day. For a rolling window this includes all of the first day, a small difference from counting by the time of day.
+#
+# As in the `activity tracker <activity.py>`, the hash is loaded from the database the first time it's needed, starting from the requested start date. The marker field ``""`` records the first day loaded; a request for counts starting before this day reloads the hash. Logging an answer increments its count only if the hash is loaded or being loaded, since the database's counts already include answers logged before loading began.
+#
+# Only one process loads the hash at a time, holding a lock (see ``redis_lock`` in `redis_client.py`); meanwhile, other processes read the database. Taking the lock empties the hash, so that answers logged while the database is read are counted in the hash; the load then adds the database's counts to these. An answer is logged only after its row is written, so none is missed, but one written just before the database is read and logged just after the lock is taken is counted twice. Since counts may drift slightly, the hash expires after ``settings.answer_counts_ttl`` seconds and is then reloaded.
+#
+# Both the hash and the database (when Redis isn't used) count the ``mChoice`` events logged on or after the start day, using ``count_mchoice_acts_by_day``, so that they agree.
+#
+# This is used only when ``settings.redis_cache`` is true; otherwise, or if Redis is unavailable, the counts come from the database as before.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Third-party imports
+# -------------------
+import aioredis
+
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import settings
+from ..crud import count_mchoice_acts_by_day
+from .redis_client import get_redis, redis_lock
+
+# The field which records the first day loaded.
+_LOADED = ""
+
+# Increment a count, but only if the hash is loaded or being loaded. KEYS are the hash and its load lock; ARGV are the field to increment and the hash's TTL.
+_INCREMENT_IF_LOADED = """
+if redis.call("hexists", KEYS[1], "") == 1 or redis.call("exists", KEYS[2]) == 1 then
+    local count = redis.call("hincrby", KEYS[1], ARGV[1], 1)
+    if redis.call("ttl", KEYS[1]) < 0 then
+        redis.call("expire", KEYS[1], ARGV[2])
+    end
+    return count
+end
+return 0
+"""
+
+# Add the counts read from the database to the hash, then mark it as loaded, if the load lock is still held. KEYS are the hash and its lock; ARGV are the lock's token, the hash's TTL, the first day loaded, then pairs of field and count. Return the hash's fields, in the form ``hgetall`` returns, or nil if the lock was lost.
+_MERGE_COUNTS = """
+if redis.call("get", KEYS[2]) ~= ARGV[1] then
+    return nil
+end
+for i = 4, #ARGV, 2 do
+    redis.call("hincrby", KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call("hset", KEYS[1], "", ARGV[3])
+redis.call("expire", KEYS[1], ARGV[2])
+return redis.call("hgetall", KEYS[1])
+"""
+
+
+def _key(course_name: str, div_id: str) -> str:
+    return f"answer_counts:{course_name}:{div_id}"
+
+
+def _lock_key(key: str) -> str:
+    return f"{key}:load"
+
+
+def _day(d: datetime.date) -> str:
+    return d.strftime("%Y%m%d")
+
+
+# Record an answer ``act`` to the multiple choice question ``div_id``, logged at ``timestamp`` (in UTC).
+async def record_answer(
+    course_name: str, div_id: str, act: str, timestamp: datetime.datetime
+) -> None:
+    if not settings.redis_cache:
+        return
+    key = _key(course_name, div_id)
+    try:
+        r = get_redis()
+        await r.eval(
+            _INCREMENT_IF_LOADED,
+            2,
+            key,
+            _lock_key(key),
+            f"{_day(timestamp)}|{act}",
+            settings.answer_counts_ttl,
+        )
+    except (aioredis.RedisError, OSError) as e:
+        # The counts are now incomplete; drop them (and any load in progress) so they will be reloaded.
+        rslogger.warning(f"Unable to record an answer count in Redis: {e}")
+        await _discard(key)
+
+
+# Return a list of (act, count) for the multiple choice answers to ``div_id`` in ``course_name`` logged since ``start_date`` (in UTC), which may be a date or a datetime.
+async def fetch_answer_counts(
+    course_name: str, div_id: str, start_date: datetime.date
+) -> List[Tuple[str, int]]:
+    start_day = (
+        start_date.date() if isinstance(start_date, datetime.datetime) else start_date
+    )
+    counts = None
+    if settings.redis_cache:
+        counts = await _fetch_from_redis(course_name, div_id, start_day)
+    if counts is None:
+        counts = {}
+        for _, act, count in await count_mchoice_acts_by_day(
+            div_id, course_name, start_day
+        ):
+            counts[act] = counts.get(act, 0) + count
+    return list(counts.items())
+
+
+# Sum the counts since ``start_day``, loading them if necessary. Return None if Redis can't answer.
+async def _fetch_from_redis(
+    course_name: str, div_id: str, start_day: datetime.date
+) -> Optional[Dict[str, int]]:
+    key = _key(course_name, div_id)
+    start = _day(start_day)
+    try:
+        fields = await get_redis().hgetall(key)
+        loaded = fields.pop(_LOADED.encode(), None)
+        if loaded is None or loaded.decode() > start:
+            async with redis_lock(_lock_key(key), key) as token:
+                fields = token and await _load(
+                    key, token, course_name, div_id, start_day
+                )
+            if fields is None:
+                return None
+        counts: Dict[str, int] = {}
+        for field, count in fields.items():
+            day, act = field.decode().split("|", 1)
+            if day >= start:
+                counts[act] = counts.get(act, 0) + int(count)
+        return counts
+    except (aioredis.RedisError, OSError) as e:
+        rslogger.warning(f"Unable to read answer counts from Redis: {e}")
+        return None
+
+
+# Load the counts since ``start_day`` from the database into the hash, which the caller emptied when taking the load lock, whose token is ``token``. Return the hash's fields, in the form ``hgetall`` returns, without the marker; return None if the lock was lost.
+async def _load(
+    key: str, token: str, course_name: str, div_id: str, start_day: datetime.date
+) -> Optional[Dict[bytes, bytes]]:
+    rows = await count_mchoice_acts_by_day(div_id, course_name, start_day)
+    merged = await get_redis().eval(
+        _MERGE_COUNTS,
+        2,
+        key,
+        _lock_key(key),
+        token,
+        settings.answer_counts_ttl,
+        _day(start_day),
+        *[value for day, act, count in rows for value in (f"{_day(day)}|{act}", count)],
+    )
+    if merged is None:
+        return None
+    fields = dict(zip(merged[::2], merged[1::2]))
+    fields.pop(_LOADED.encode(), None)
+    return fields
+
+
+async def _discard(key: str) -> None:
+    try:
+        await get_redis().delete(key, _lock_key(key))
+    except (aioredis.RedisError, OSError):
+        pass
@@ -0,0 +1,123 @@
+# **************************************
+# |docname| - An index of a book's pages
+# **************************************
+# Rendering a page needs the structure of its book: the chapter a PreTeXt subchapter belongs to, the table of contents for the page's chapter, and the questions on the page (for the progress bar). This structure only changes when a book is republished, so this module builds an index of it once per base course, from the ``chapters``, ``sub_chapters`` and ``questions`` tables, instead of querying these tables on every page view.
+#
+# An index is built when a book is first requested. Publishing a book rewrites its files in `book_path`, so each index records a signature (the modification times) of the published book; when the signature changes, the index is rebuilt. Reading the signature means ``stat`` calls, which may block on a network filesystem, so these run in the threadpool, and each book's signature is checked at most once per ``settings.book_index_check_interval`` seconds. Indexes also expire after ``settings.book_index_ttl`` seconds, and may be dropped explicitly using ``invalidate_book_index``. Rebuilding an index also drops the book's cached server-side grading feedback (see ``is_server_feedback`` in `../crud.py`).
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Third-party imports
+# -------------------
+from starlette.concurrency import run_in_threadpool
+
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import settings
+from ..crud import fetch_book_structure, invalidate_server_feedback
+from .cache import AsyncTTLCache, cache_ttl
+
+
+# Index
+# =====
+class BookIndex:
+    def __init__(
+        self,
+        base_course: str,
+        # The signature of the published book this index was built from; see ``_book_signature``.
+        signature: Optional[Tuple[float, ...]],
+        # See ``fetch_book_structure``.
+        toc: List[Tuple[str, str, str]],
+        questions: List[Tuple[str, str, str]],
+    ):
+        self.base_course = base_course
+        self.signature = signature
+        # The time (from ``time.monotonic``) the signature was last checked.
+        self.checked = time.monotonic()
+        # Map a subchapter label to its chapter label. PreTeXt subchapter labels are unique in a book; if not, use the first chapter containing the subchapter.
+        self._chapter_for_subchapter: Dict[str, str] = {}
+        # Map a chapter label to the table of contents for that chapter, in the form ``fetch_subchaptoc`` in `../routers/books.py` used to produce.
+        self._toc: Dict[str, List[Dict[str, str]]] = {}
+        for chapter, subchapter, title in toc:
+            self._chapter_for_subchapter.setdefault(subchapter, chapter)
+            self._toc.setdefault(chapter, []).append(
+                dict(subchap_uri=f"{subchapter}.html", title=title)
+            )
+        # Map (chapter label, subchapter label) to the names of the questions a student must answer on that page.
+        self._div_ids: Dict[Tuple[str, str], List[str]] = {}
+        for chapter, subchapter, name in questions:
+            self._div_ids.setdefault((chapter, subchapter), []).append(name)
+
+    def chapter_for(self, subchapter: str) -> Optional[str]:
+        return self._chapter_for_subchapter.get(subchapter)
+
+    def toc_for(self, chapter: str) -> List[Dict[str, str]]:
+        return self._toc.get(chapter, [])
+
+    def div_ids_for(self, chapter: str, subchapter: str) -> List[str]:
+        return self._div_ids.get((chapter, subchapter), [])
+
+
+# Return a value which changes when a book is republished, or None if the book hasn't been published on this server.
+def _book_signature(base_course: str) -> Optional[Tuple[float, ...]]:
+    path = os.path.join(settings.book_path, base_course, "published", base_course)
+    try:
+        return tuple(
+            os.stat(p).st_mtime for p in (path, os.path.join(path, "index.html"))
+        )
+    except OSError:
+        try:
+            return (os.stat(path).st_mtime,)
+        except OSError:
+            return None
+
+
+_book_index_cache: AsyncTTLCache[BookIndex] = AsyncTTLCache(
+    "book_index", cache_ttl(settings.book_index_ttl), settings.book_index_size
+)
+
+
+async def _build_book_index(base_course: str) -> BookIndex:
+    # Take the signature first, so that a book republished while this index is being built causes another rebuild.
+    signature = await run_in_threadpool(_book_signature, base_course)
+    toc, questions = await fetch_book_structure(base_course)
+    rslogger.debug(
+        f"Built book index for {base_course}: {len(toc)} pages, {len(questions)} questions."
+    )
+    return BookIndex(base_course, signature, toc, questions)
+
+
+# Return the index for ``base_course``, building or rebuilding it if necessary.
+async def get_book_index(base_course: str) -> BookIndex:
+    index = await _book_index_cache.get_or_load(
+        base_course, lambda: _build_book_index(base_course)
+    )
+    if time.monotonic() - index.checked < settings.book_index_check_interval:
+        return index
+    # Mark the index as checked before waiting for the check, so that concurrent requests don't check it too.
+    index.checked = time.monotonic()
+    if index.signature != await run_in_threadpool(_book_signature, base_course):
+        rslogger.info(f"Book {base_course} was republished; rebuilding its index.")
+        invalidate_book_index(base_course)
+        index = await _book_index_cache.get_or_load(
+            base_course, lambda: _build_book_index(base_course)
+        )
+    return index
+
+
+# Drop the index for ``base_course``, or for all books if ``base_course`` is omitted. Call this after changing a book's structure in the database. Since the book was rebuilt, this also drops its cached server-side grading feedback.
+def invalidate_book_index(base_course: Optional[str] = None) -> None:
+    if base_course is None:
+        _book_index_cache.clear()
+    else:
+        _book_index_cache.invalidate(base_course)
+    invalidate_server_feedback(base_course)
@@ -0,0 +1,187 @@
+# **************************************************
+# |docname| - A cache of literate programming builds
+# **************************************************
+# Students often resubmit the same code: for example, after reloading a page, or after clicking the button again to see the results. Building and running a submission takes seconds, so `scheduled_builder.py` stores the result of each build, ``(output, correct)``, in this cache. An identical submission returns the stored result instead of building again. Only verdicts on the student's code are stored: results of builds which reached their final (run or simulation) step without timing out. A build which failed earlier, or timed out, may have failed because of the machine it ran on, so it's built again next time.
+#
+# The cache is content addressed: the key is a hash of everything which determines the result of a build:
+#
+# - the builder;
+# - the student's source, after it's been interleaved with the book's code;
+# - the contents of the instructor's test files;
+# - the modification times of the book's support libraries and linker files, which change when the book is rebuilt; and
+# - the version of the builder's toolchain.
+#
+# Entries are stored as small files on local disk, in the directory given by the ``LP_BUILD_CACHE_PATH`` environment variable (this runs in a Celery worker, which reads its configuration from the environment, like ``celery_config``). The cache is limited to ``LP_BUILD_CACHE_MAX_MB`` megabytes; when it grows past this, the least recently used entries are removed. Setting ``LP_BUILD_CACHE_MAX_MB`` to 0 disables the cache.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from functools import lru_cache
+import hashlib
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import threading
+from typing import List, Optional, Tuple
+
+# Third-party imports
+# -------------------
+# None.
+
+# Local imports
+# -------------
+# None.
+
+
+# Configuration
+# =============
+_cache_path = Path(
+    os.environ.get("LP_BUILD_CACHE_PATH", Path.home() / "Runestone/lp_build_cache")
+)
+_max_bytes = int(float(os.environ.get("LP_BUILD_CACHE_MAX_MB", 256)) * 1024 * 1024)
+
+# The command which prints the version of each builder's toolchain.
+_TOOLCHAIN_VERSION_ARGS = {
+    "rust": ["rustc", "--version"],
+    "pic24-xc16-bullylib": ["xc16-gcc", "--version"],
+    "armv7-newlib-sim": ["arm-none-eabi-gcc", "--version"],
+    "verilog": ["iverilog", "-V"],
+}
+
+
+# Keys
+# ====
+# Return a string identifying the version of ``builder``'s toolchain. This runs a subprocess, so cache the result for the life of the worker.
+@lru_cache(maxsize=None)
+def toolchain_version(builder: str) -> str:
+    if builder == "python":
+        return sys.version
+    args = _TOOLCHAIN_VERSION_ARGS.get(builder)
+    if not args:
+        return ""
+    try:
+        cp = subprocess.run(args, capture_output=True, text=True, timeout=15)
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+    return cp.stdout + cp.stderr
+
+
+# Return the cache key for a build.
+def build_key(
+    # The name of the builder.
+    builder: str,
+    # The code to build.
+    source_str: str,
+    # Paths to files whose contents determine the result of the build, such as the instructor's tests. A file which doesn't exist is included as missing.
+    content_paths: List[str],
+    # Paths to files or directories whose modification times determine the result of the build, such as the book's libraries.
+    mtime_paths: List[str],
+) -> str:
+    h = hashlib.sha256()
+    # Separate each part, so that different parts can't combine to produce the same input to the hash.
+    for part in (builder, toolchain_version(builder), source_str):
+        h.update(part.encode("utf-8", errors="surrogateescape"))
+        h.update(b"\0")
+    for path in content_paths:
+        try:
+            with open(path, "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            h.update(b"missing")
+        h.update(b"\0")
+    for path in mtime_paths:
+        try:
+            h.update(str(os.stat(path).st_mtime_ns).encode("ascii"))
+        except OSError:
+            h.update(b"missing")
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+# Storage
+# =======
+def _entry_path(key: str) -> Path:
+    # Spread entries over subdirectories, to keep directories small.
+    return _cache_path / key[:2] / f"{key}.json"
+
+
+# Return the cached ``(output, correct)`` for ``key``, or None on a miss.
+def get(key: str) -> Optional[Tuple[str, int]]:
+    if _max_bytes <= 0:
+        return None
+    path = _entry_path(key)
+    try:
+        with open(path, encoding="utf-8") as f:
+            output, correct = json.load(f)
+        # Mark this entry as recently used.
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return output, correct
+
+
+# The approximate size of the cache, in bytes; None until it's measured. Other worker processes share the cache directory, so this is re-measured whenever it passes the limit.
+_size: Optional[int] = None
+_size_lock = threading.Lock()
+
+
+# Store the result of a build.
+def put(key: str, output: str, correct: int) -> None:
+    global _size
+    if _max_bytes <= 0:
+        return
+    path = _entry_path(key)
+    data = json.dumps([output, correct]).encode("utf-8")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so that a concurrent ``get`` never reads a partial entry.
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        return
+    with _size_lock:
+        if _size is None:
+            _size = _measure()
+        else:
+            _size += len(data)
+        if _size > _max_bytes:
+            _size = _evict()
+
+
+# Return a list of (last use time, size, path) for every entry.
+def _entries() -> List[Tuple[float, int, Path]]:
+    entries = []
+    for path in _cache_path.glob("*/*.json"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def _measure() -> int:
+    return sum(size for _, size, _ in _entries())
+
+
+# Remove the least recently used entries until the cache is below 90% of its limit, leaving room for new entries before the next eviction. Return the resulting size.
+def _evict() -> int:
+    entries = sorted(_entries())
+    size = sum(size for _, size, _ in entries)
+    target = _max_bytes * 0.9
+    for _, entry_size, path in entries:
+        if size <= target:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        size -= entry_size
+    return size
@@ -0,0 +1,143 @@
+# *************************************************
+# |docname| - Where literate programming builds run
+# *************************************************
+# `scheduled_builder.py` builds and runs a literate programming (LP) answer using ``run_builder``. This module provides a choice of where ``run_builder`` executes, selected by ``settings.lp_builder_backend``:
+#
+# ``celery``
+#   In a Celery worker (the ``_scheduled_builder`` task), using Redis as the broker and result backend. This lets many webservers share a pool of build machines.
+#
+# ``local``
+#   In a pool of ``settings.lp_local_processes`` processes belonging to this webserver worker. This avoids the round trips through the broker and the need to run Celery, which suits a single-node install, and makes it possible to run (or benchmark) LP grading without Redis.
+#
+# Both backends run the same builders, so they produce identical results; the build cache (`build_cache.py`) is shared by both.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import abc
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import multiprocessing
+import time
+from typing import Any, Optional, Tuple
+
+# Third-party imports
+# -------------------
+from celery import states
+
+# Local application imports
+# -------------------------
+from ..config import LpBuilderBackend, settings
+from .redis_client import get_redis
+from .scheduled_builder import _scheduled_builder, run_builder, set_process_index
+
+
+# Executors
+# =========
+# The interface shared by all backends.
+class BuilderExecutor(abc.ABC):
+    # Run a build, passing ``args`` and ``kwargs`` to ``run_builder``. Return (output, correct). Raise ``asyncio.TimeoutError`` if the build doesn't finish in ``settings.lp_build_timeout`` seconds.
+    @abc.abstractmethod
+    async def build(self, *args: Any, **kwargs: Any) -> Tuple[str, int]:
+        ...
+
+    # Release any resources this executor holds.
+    async def close(self) -> None:
+        pass
+
+
+class CeleryBuilderExecutor(BuilderExecutor):
+    async def build(self, *args: Any, **kwargs: Any) -> Tuple[str, int]:
+        res = _scheduled_builder.delay(*args, **kwargs)
+        return await wait_for_result(res.id, settings.lp_build_timeout)
+
+
+# Poll the result backend until the task ``task_id`` finishes, then return its result (or raise its exception). Instead of the blocking ``AsyncResult.get``, this reads the Celery result backend (Redis) using the server's async Redis client.
+async def wait_for_result(task_id: str, timeout: float) -> Any:
+    backend = _scheduled_builder.backend
+    key = backend.get_key_for_task(task_id)
+    deadline = time.monotonic() + timeout
+    # Most builds take a few seconds; start by polling quickly, then back off.
+    delay = 0.1
+    while True:
+        data = await get_redis().get(key)
+        if data is not None:
+            meta = backend.decode_result(data)
+            if meta["status"] == states.SUCCESS:
+                return meta["result"]
+            if meta["status"] in states.READY_STATES:
+                result = meta["result"]
+                raise result if isinstance(result, BaseException) else RuntimeError(
+                    f"Build task {meta['status']}: {result}"
+                )
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError(f"Build task {task_id} timed out.")
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 1.5, 1.0)
+
+
+class LocalBuilderExecutor(BuilderExecutor):
+    def __init__(self, processes: int):
+        self._processes = processes
+        # Created when first needed.
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    async def build(self, *args: Any, **kwargs: Any) -> Tuple[str, int]:
+        if self._pool is None:
+            # Forking a process running an event loop and database connections isn't safe; start fresh processes instead. The builders run their subprocesses under ``runguard``, which enforces their time limits; the timeout here only bounds how long the request waits.
+            context = multiprocessing.get_context("spawn")
+            # Number the processes, so that concurrent builds run as different Jobe users.
+            indexes = context.Queue()
+            for index in range(1, self._processes + 1):
+                indexes.put(index)
+            self._pool = ProcessPoolExecutor(
+                self._processes,
+                mp_context=context,
+                initializer=_init_build_process,
+                initargs=(indexes,),
+            )
+        return await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(
+                self._pool, partial(run_builder, *args, **kwargs)
+            ),
+            settings.lp_build_timeout,
+        )
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+# Run in each new process of a ``LocalBuilderExecutor``'s pool: take a unique index for this process.
+def _init_build_process(indexes: Any) -> None:
+    set_process_index(indexes.get())
+
+
+# Selection
+# =========
+_executor: Optional[BuilderExecutor] = None
+
+
+# Return the executor selected by ``settings.lp_builder_backend``.
+def get_builder_executor() -> BuilderExecutor:
+    global _executor
+    if _executor is None:
+        if settings.lp_builder_backend == LpBuilderBackend.local:
+            _executor = LocalBuilderExecutor(settings.lp_local_processes)
+        else:
+            _executor = CeleryBuilderExecutor()
+    return _executor
+
+
+# `../main.py` calls this on shutdown.
+async def close_builder_executor() -> None:
+    global _executor
+    if _executor is not None:
+        await _executor.close()
+        _executor = None
@@ -0,0 +1,248 @@
+# ******************************************************
+# |docname| - In-process caches for rarely-changing rows
+# ******************************************************
+# Some rows, such as those in the ``courses`` table, are read several times per request but almost never change. This module provides a small async-safe cache for these: entries expire after a time to live (TTL), the least recently used entries are evicted once the cache is full, and concurrent misses on the same key share a single load (single-flight) instead of each issuing a query.
+#
+# Each cache lives in one worker process. Other processes (including the web2py server) can change the underlying rows, so the TTL bounds how stale an entry can be; code in this process which changes a row should also invalidate it. A cache may also be given a shared tier (see `RedisCacheTier`), which is consulted on a local miss so that a row loaded by one worker is available to all the others.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import asyncio
+from collections import OrderedDict
+import json
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+# Third-party imports
+# -------------------
+import aioredis
+from pydantic import BaseModel
+
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import BookServerConfig, settings
+from .redis_client import get_redis
+
+
+# Cache
+# =====
+V = TypeVar("V")
+
+# Every cache created registers itself here, so that `cache_stats` can report on all of them.
+_caches: List["AsyncTTLCache"] = []
+
+
+class AsyncTTLCache(Generic[V]):
+    def __init__(
+        self,
+        # A name for this cache, used when reporting statistics.
+        name: str,
+        # The time to live for an entry, in seconds. A TTL of 0 disables caching; every call loads the value.
+        ttl: float,
+        # The maximum number of entries to keep.
+        maxsize: int,
+        # The time to live for a ``None`` value (for example, a course that doesn't exist), in seconds. If not provided, use ``ttl``. Keeping this short means a row created elsewhere is found quickly.
+        negative_ttl: Optional[float] = None,
+        # An optional tier shared between processes, consulted before ``loader``.
+        shared: Optional["RedisCacheTier"] = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.negative_ttl = ttl if negative_ttl is None else min(negative_ttl, ttl)
+        self.shared = shared
+        # Map a key to (expiration time, value), ordered from least to most recently used.
+        self._data: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+        # Map a key to the future of a load in progress.
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+        # Incremented by every invalidation, so that a load which started before an invalidation doesn't store a stale value.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        _caches.append(self)
+
+    # Return the cached value for ``key``; on a miss, await ``loader()`` to produce it. Exceptions raised by ``loader`` propagate to every caller waiting on it and aren't cached.
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[V]]) -> V:
+        if self.ttl <= 0:
+            self.misses += 1
+            return await loader()
+
+        entry = self._data.get(key)
+        if entry:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+
+        # Share a load already in progress.
+        future = self._loading.get(key)
+        if future:
+            self.hits += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        generation = self._generation
+        try:
+            value = await self._load(key, loader, generation)
+        except BaseException as e:
+            future.set_exception(e)
+            # Avoid a "Future exception was never retrieved" warning when no other caller was waiting.
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if generation == self._generation:
+                self._store(key, value)
+            return value
+        finally:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+
+    # Load a value from the shared tier, if there is one; otherwise, from ``loader``.
+    async def _load(
+        self, key: Hashable, loader: Callable[[], Awaitable[V]], generation: int
+    ) -> V:
+        if not self.shared:
+            return await loader()
+        found, value = await self.shared.get(key)
+        if found:
+            return value
+        value = await loader()
+        if generation == self._generation:
+            await self.shared.set(key, value, self._ttl_for(value))
+        return value
+
+    def _ttl_for(self, value: Optional[V]) -> float:
+        return self.negative_ttl if value is None else self.ttl
+
+    def _store(self, key: Hashable, value: V) -> None:
+        ttl = self._ttl_for(value)
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    # Invalidation
+    # ------------
+    # Remove one entry.
+    def invalidate(self, key: Hashable) -> None:
+        self._generation += 1
+        self._data.pop(key, None)
+        # Later callers shouldn't share a load that may return the old value.
+        self._loading.pop(key, None)
+
+    # Remove one entry from this cache and from the shared tier. Other processes may still hold the entry in their local caches until it expires.
+    async def invalidate_shared(self, key: Hashable) -> None:
+        self.invalidate(key)
+        if self.shared:
+            await self.shared.delete(key)
+
+    # Remove every entry whose key and value satisfy ``predicate``.
+    def invalidate_where(self, predicate: Callable[[Hashable, V], bool]) -> None:
+        self._generation += 1
+        for key in [k for k, (_, v) in self._data.items() if predicate(k, v)]:
+            del self._data[key]
+        self._loading.clear()
+
+    # Remove all entries.
+    def clear(self) -> None:
+        self._generation += 1
+        self._data.clear()
+        self._loading.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    # Report statistics for monitoring.
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return dict(
+            size=len(self._data),
+            maxsize=self.maxsize,
+            ttl=self.ttl,
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / total if total else 0.0,
+        )
+
+
+# Shared tier
+# ===========
+# Store cached pydantic models in Redis, as JSON, under ``prefix:key``. Redis expires the entries using the TTL of the local cache. Redis errors are logged then treated as a miss, so that an unavailable Redis server only costs a database query.
+#
+# Fields which must not leave this process, such as password hashes, are listed in ``exclude``, which maps each field to the placeholder value it has when read back from Redis. Code which needs the real value of such a field must read it from the database.
+class RedisCacheTier:
+    def __init__(
+        self,
+        prefix: str,
+        model: Type[BaseModel],
+        exclude: Optional[Dict[str, Any]] = None,
+    ):
+        self.prefix = prefix
+        self.model = model
+        self.exclude = exclude or {}
+
+    def _key(self, key: Hashable) -> str:
+        return f"{self.prefix}:{key}"
+
+    # Return (found, value).
+    async def get(self, key: Hashable) -> Tuple[bool, Optional[BaseModel]]:
+        try:
+            data = await get_redis().get(self._key(key))
+        except (aioredis.RedisError, OSError) as e:
+            rslogger.warning(f"Unable to read {self._key(key)} from Redis: {e}")
+            return False, None
+        if data is None:
+            return False, None
+        obj = json.loads(data)
+        return True, (
+            None if obj is None else self.model.parse_obj({**obj, **self.exclude})
+        )
+
+    async def set(self, key: Hashable, value: Optional[BaseModel], ttl: float) -> None:
+        data = "null" if value is None else value.json(exclude=set(self.exclude))
+        try:
+            await get_redis().set(self._key(key), data, px=max(1, int(ttl * 1000)))
+        except (aioredis.RedisError, OSError) as e:
+            rslogger.warning(f"Unable to write {self._key(key)} to Redis: {e}")
+
+    async def delete(self, key: Hashable) -> None:
+        try:
+            await get_redis().delete(self._key(key))
+        except (aioredis.RedisError, OSError) as e:
+            rslogger.warning(f"Unable to delete {self._key(key)} from Redis: {e}")
+
+
+# Utilities
+# =========
+# Return the statistics of every cache, keyed by cache name.
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {cache.name: cache.stats() for cache in _caches}
+
+
+# Return the TTL to use for a cache of database rows. The tests truncate and re-create rows between tests from a different process than the server, which no TTL can keep up with; therefore, disable these caches when testing.
+def cache_ttl(ttl: float) -> float:
+    return 0 if settings.book_server_config == BookServerConfig.test else ttl
@@ -10,9 +10,12 @@
 # Standard library
 # ----------------
 import atexit
+from contextlib import nullcontext
 import os
 from pathlib import Path
+import queue
 import random
+import signal
 import subprocess
 from tempfile import TemporaryDirectory
 import threading
@@ -25,12 +28,6 @@ import time
 # Local imports
 # -------------
 # None.
-#
-#
-# Globals
-# =======
-# Set up thread-local storage
-_tls = threading.local()
 
 
 # Simulation scripts and checks
@@ -182,41 +179,75 @@ def check_sim_out(out_list, verification_code):
 
 # Run MDB
 # =======
-# This function runs a simulation, verifying that the simulation results
-# are correct, using the newer MDB simulator.
-#
-# Outputs: string read from the sim_output_file.
+# Starting MDB (a Java program) takes several seconds, so simulations run in a pool of simulators which persist between runs. Each simulator is recycled after ``MDB_MAX_RUNS`` simulations, or once its processes use more than ``MDB_MAX_RSS_MB`` megabytes of memory, since Java tends to grow over time. Measuring this scans every process in ``/proc``, so it's checked only every ``MDB_RSS_CHECK_RUNS`` simulations. A simulation which doesn't finish within ``MDB_TIMEOUT`` seconds kills its simulator, since it's probably stuck. These, plus the size of the pool (``MDB_POOL_SIZE`` simulators per process), are read from the environment, since this code also runs as part of a book's build.
 #
-# TODO: Need a test strategy, and unit tests for this.
-def sim_run_mdb(
-    # A path to the MDB script.
-    mdb_path,
-    # The microcontroller to simulate; for example, "dsPIC33EP128GP502".
-    mcu_name,
-    # A path to the binary (typically in .elf format) to simulate.
-    sim_binary_path,
-):
-    # Get or create an instance of the simulator.
-    po = _tls.__dict__.get("po")
-    if (
-        # If the simulator hasn't been started, ...
-        (not po)
-        # ... or it died, (re)create it.
-        or (po and po.poll() is not None)
+# By default, the pool's size isn't limited: a simulation waits for an idle simulator only if one exists, and otherwise starts another. Since simulators are reused, a process keeps as many as it runs simulations at once; this is one for a prefork Celery worker or a `local builder <builder_executor.py>` process, and the number of threads for a Celery worker using a thread pool. Set ``MDB_POOL_SIZE`` to cap the simulators (and so the memory they use) per process; simulations beyond this wait for a simulator.
+_mdb_pool_size = (
+    int(os.environ["MDB_POOL_SIZE"]) if os.environ.get("MDB_POOL_SIZE") else None
+)
+_mdb_max_runs = int(os.environ.get("MDB_MAX_RUNS", 200))
+_mdb_max_rss_mb = float(os.environ.get("MDB_MAX_RSS_MB", 1500))
+_mdb_rss_check_runs = max(int(os.environ.get("MDB_RSS_CHECK_RUNS", 10)), 1)
+_mdb_timeout = float(os.environ.get("MDB_TIMEOUT", 15))
+
+# MDB prints this line after a simulation finishes; see ``get_sim_run_str_mdb``.
+_MDB_FINISHED = ">/*Simulation finished.*/\n"
+
+
+# Return the memory used by a process and all its descendants, in MB, or None if this can't be determined (for example, on a system without ``/proc``).
+def _process_tree_rss_mb(pid):
+    try:
+        children = {}
+        for stat_path in Path("/proc").glob("[0-9]*/stat"):
+            try:
+                stat = stat_path.read_text()
+            except OSError:
+                continue
+            # The process name is in parentheses and may contain spaces; the parent's PID is the second field after it.
+            ppid = int(stat[stat.rindex(")") + 2 :].split()[1])
+            children.setdefault(ppid, []).append(int(stat_path.parent.name))
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        total = 0
+        pids = [pid]
+        while pids:
+            p = pids.pop()
+            try:
+                total += (
+                    int(Path(f"/proc/{p}/statm").read_text().split()[1]) * page_size
+                )
+            except (OSError, ValueError, IndexError):
+                pass
+            pids.extend(children.get(p, []))
+        return total / (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+
+
+# One MDB process, configured to simulate a specific MCU.
+class MdbSimulator:
+    def __init__(
+        self,
+        # A path to the MDB script.
+        mdb_path,
+        # The microcontroller to simulate; for example, "dsPIC33EP128GP502".
+        mcu_name,
     ):
+        self.mdb_path = mdb_path
+        self.mcu_name = mcu_name
+        self.runs = 0
 
         # Create a temp file for the simulation results. Since the simulator doesn't close the file after the simulation finishes, it can't be deleted. Instead, we need a single file to be used for a simulation, read, then truncated.
-        _tls.tempdir = tempdir = TemporaryDirectory()
-        _tls.simout_path = Path(_tls.tempdir.name) / "mdb_simout.txt"
-        _tls.simout_file = simout_file = open(
-            _tls.simout_path, "w+", encoding="utf-8", errors="backslashreplace"
+        self.tempdir = TemporaryDirectory()
+        self.simout_path = Path(self.tempdir.name) / "mdb_simout.txt"
+        self.simout_file = open(
+            self.simout_path, "w+", encoding="utf-8", errors="backslashreplace"
         )
 
         # Java, by default, doesn't free memory until it gets low, making it a memory hog. The `Java command-line flags <https://docs.oracle.com/en/java/javase/13/docs/specs/man/java.html>`_ ``-Xms750M -Xmx750M`` specify a heap size of 750 MB. However, these options must go before the ``--jar`` option when invoking ``java``, meaning they require hand edits to ``mdb.bat/sh``; they can't be passed as parameters (which are placed after ``--jar`` by ``mdb.bat/sh``). Therefore, use the `JAVA_TOOL_OPTIONS <https://docs.oracle.com/javase/8/docs/technotes/guides/troubleshoot/envvars002.html>`_ env var to pass these parameters.
         sim_env = os.environ.copy()
         sim_env["JAVA_TOOL_OPTIONS"] = "-Xms750M -Xmx750M"
         # Start the simulator.
-        po = subprocess.Popen(
+        self.po = subprocess.Popen(
             [
                 mdb_path,
                 # Per a conversation with Microchip's support team, this disables the start-up check for new language packs, which takes several seconds to complete.
@@ -228,48 +259,233 @@ def sim_run_mdb(
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             env=sim_env,
+            # Start a new process group, so that ``kill`` stops the shell, MDB, and Java together.
+            start_new_session=os.name == "posix",
         )
-        s = get_sim_setup_str_mdb(mcu_name)
-        po.stdin.write(s)
-        po.stdin.flush()
-        _tls.po = po
-
-        def on_exit():
-            # Shut down the simulator and end the simulation process.
-            po.communicate("quit\n")
-            # Remove the simout file.
-            simout_file.close()
-            tempdir.cleanup()
-
-            # TODO: Need to kill the process as well, in case it's stuck.
-
-        atexit.register(on_exit)
-
-    # Delete any previous simulation results.
-    _tls.simout_file.truncate(0)
-
-    # Run the simulation.
-    s = get_sim_run_str_mdb(sim_binary_path, _tls.simout_path)
-    po.stdin.write(s)
-    po.stdin.flush()
-
-    # Wait for it to finish by watching stdout.
-    end_time = time.time() + 15
-    output = []
-    while time.time() < end_time:
-        # If the process terminates (a not-``None`` return value), read the last output then exit the loop.
-        if po.poll() is not None:
-            output.append(po.communicate()[0])
-            break
-        line = po.stdout.readline()
-        if not line:
-            time.sleep(0.1)
-            continue
-        output.append(line)
-        if line == ">/*Simulation finished.*/\n":
-            output = []
-            break
-
-    # Read then return the result, starting from the beginning of the file.
-    _tls.simout_file.seek(0)
-    return "".join(output) + _tls.simout_file.read()
+        # Read the simulator's output in a thread, so that a run can wait for a line (or a timeout) instead of polling. ``None`` marks the end of the output.
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read_output, daemon=True).start()
+
+        self.po.stdin.write(get_sim_setup_str_mdb(mcu_name))
+        self.po.stdin.flush()
+
+    def _read_output(self):
+        for line in self.po.stdout:
+            self.lines.put(line)
+        self.lines.put(None)
+
+    def is_alive(self):
+        return self.po.poll() is None
+
+    # Run a simulation; return its output. Raise ``TimeoutError`` if it doesn't finish in ``timeout`` seconds, leaving the simulator in an unknown state; the caller should then ``kill`` it.
+    def run(self, sim_binary_path, timeout):
+        self.runs += 1
+        # Delete any previous simulation results.
+        self.simout_file.truncate(0)
+        # Discard any output left from setup or a previous run.
+        while True:
+            try:
+                self.lines.get_nowait()
+            except queue.Empty:
+                break
+
+        # Run the simulation.
+        self.po.stdin.write(get_sim_run_str_mdb(sim_binary_path, self.simout_path))
+        self.po.stdin.flush()
+
+        # Wait for it to finish by watching stdout.
+        end_time = time.monotonic() + timeout
+        output = []
+        while True:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("".join(output))
+            try:
+                line = self.lines.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            # The simulator exited; return what it produced.
+            if line is None:
+                break
+            output.append(line)
+            if line == _MDB_FINISHED:
+                output = []
+                break
+
+        # Read then return the result, starting from the beginning of the file.
+        self.simout_file.seek(0)
+        return "".join(output) + self.simout_file.read()
+
+    def rss_mb(self):
+        return _process_tree_rss_mb(self.po.pid)
+
+    # Shut down the simulator, politely if possible.
+    def close(self, timeout=5):
+        if self.is_alive():
+            try:
+                self.po.stdin.write("quit\n")
+                self.po.stdin.flush()
+                self.po.wait(timeout)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                self.kill()
+        self._cleanup()
+
+    # Stop the simulator immediately.
+    def kill(self):
+        try:
+            if os.name == "posix":
+                os.killpg(self.po.pid, signal.SIGKILL)
+            else:
+                self.po.kill()
+        except OSError:
+            pass
+        self.po.wait()
+        self._cleanup()
+
+    def _cleanup(self):
+        for f in (self.po.stdin, self.simout_file):
+            try:
+                f.close()
+            except (OSError, ValueError):
+                pass
+        self.tempdir.cleanup()
+
+
+# A pool of simulators for each (MDB path, MCU), shared by all threads in this process. If ``size`` is None, the number of simulators isn't limited.
+class MdbSimulatorPool:
+    def __init__(self, size=None):
+        self.size = size
+        # Limit the number of simulators running at once.
+        self._slots = threading.BoundedSemaphore(size) if size else nullcontext()
+        self._lock = threading.Lock()
+        # Idle simulators, keyed by (MDB path, MCU name).
+        self._idle = {}
+        self.busy = 0
+        self.started = 0
+        self.recycled = 0
+        self.killed = 0
+        self.runs = 0
+        self.total_run_s = 0.0
+        self.max_run_s = 0.0
+        self.last_run_s = 0.0
+        self.total_wait_s = 0.0
+
+    # Start simulators until ``count`` (by default, the size of the pool, or one if its size isn't limited) are idle, so that the first simulations don't wait for MDB to start.
+    def prewarm(self, mdb_path, mcu_name, count=None):
+        count = count or self.size or 1
+        if self.size:
+            count = min(count, self.size)
+        with self._lock:
+            missing = count - len(self._idle.get((mdb_path, mcu_name), []))
+        for _ in range(missing):
+            sim = MdbSimulator(mdb_path, mcu_name)
+            with self._lock:
+                self.started += 1
+                self._idle.setdefault((mdb_path, mcu_name), []).append(sim)
+
+    # Run a simulation using a simulator from the pool; return its output.
+    def run(self, mdb_path, mcu_name, sim_binary_path, timeout=None):
+        timeout = _mdb_timeout if timeout is None else timeout
+        wait_start = time.monotonic()
+        with self._slots:
+            run_start = time.monotonic()
+            sim = self._checkout(mdb_path, mcu_name)
+            try:
+                output = sim.run(sim_binary_path, timeout)
+            except BaseException as e:
+                # The simulator is stuck (or broken); replace it.
+                sim.kill()
+                with self._lock:
+                    self.killed += 1
+                    self.busy -= 1
+                if not isinstance(e, TimeoutError):
+                    raise
+                output = f"{e}\nTimeout.\n"
+            else:
+                self._checkin(sim)
+            run_s = time.monotonic() - run_start
+            with self._lock:
+                self.runs += 1
+                self.total_wait_s += run_start - wait_start
+                self.total_run_s += run_s
+                self.max_run_s = max(self.max_run_s, run_s)
+                self.last_run_s = run_s
+        return output
+
+    def _checkout(self, mdb_path, mcu_name):
+        with self._lock:
+            idle = self._idle.get((mdb_path, mcu_name), [])
+            self.busy += 1
+            while idle:
+                sim = idle.pop()
+                if sim.is_alive():
+                    return sim
+                # The simulator died while idle.
+                sim.kill()
+        try:
+            sim = MdbSimulator(mdb_path, mcu_name)
+        except Exception:
+            with self._lock:
+                self.busy -= 1
+            raise
+        with self._lock:
+            self.started += 1
+        return sim
+
+    def _checkin(self, sim):
+        recycle = not sim.is_alive() or sim.runs >= _mdb_max_runs
+        if not recycle and sim.runs % _mdb_rss_check_runs == 0:
+            rss_mb = sim.rss_mb()
+            recycle = rss_mb is not None and rss_mb > _mdb_max_rss_mb
+        if recycle:
+            sim.close()
+        with self._lock:
+            self.busy -= 1
+            if recycle:
+                self.recycled += 1
+            else:
+                self._idle.setdefault((sim.mdb_path, sim.mcu_name), []).append(sim)
+
+    # Report the pool's utilization and the latency of its simulations.
+    def stats(self):
+        with self._lock:
+            return dict(
+                size=self.size,
+                busy=self.busy,
+                idle=sum(len(sims) for sims in self._idle.values()),
+                started=self.started,
+                recycled=self.recycled,
+                killed=self.killed,
+                runs=self.runs,
+                mean_run_s=self.total_run_s / self.runs if self.runs else 0.0,
+                max_run_s=self.max_run_s,
+                last_run_s=self.last_run_s,
+                mean_wait_s=self.total_wait_s / self.runs if self.runs else 0.0,
+            )
+
+    # Shut down all idle simulators.
+    def close(self):
+        with self._lock:
+            sims = [sim for sims in self._idle.values() for sim in sims]
+            self._idle.clear()
+        for sim in sims:
+            sim.close()
+
+
+mdb_pool = MdbSimulatorPool(_mdb_pool_size)
+atexit.register(mdb_pool.close)
+
+
+# This function runs a simulation, verifying that the simulation results
+# are correct, using the newer MDB simulator.
+#
+# Outputs: string read from the sim_output_file.
+def sim_run_mdb(
+    # A path to the MDB script.
+    mdb_path,
+    # The microcontroller to simulate; for example, "dsPIC33EP128GP502".
+    mcu_name,
+    # A path to the binary (typically in .elf format) to simulate.
+    sim_binary_path,
+):
+    return mdb_pool.run(mdb_path, mcu_name, sim_binary_path)
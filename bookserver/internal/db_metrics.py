@@ -0,0 +1,215 @@
+# *******************************************
+# |docname| - Database pool and query metrics
+# *******************************************
+# Every function in `../crud.py` opens its own session, so under load it's hard to tell whether requests are waiting for the database or for a connection from the pool. This module records, for each worker process:
+#
+# - the connection pool: the connections in use (now and at most), and the time spent waiting to check out a connection, including timeouts;
+# - each crud function: the number of calls and errors, the latency of each call, and the number and total time of the SQL statements it executed.
+#
+# These are reported by the `metrics endpoint <../routers/metrics.py>`. Use them to size the number of workers and ``settings.db_pool_size``: if checkout waits grow while queries stay fast, the pool is too small; if queries slow down as more connections are used, the database is the bottleneck. When a `read replica <../db.py>` is configured, the pool metrics combine both engines.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+from contextvars import ContextVar
+from functools import wraps
+import inspect
+import time
+from typing import Any, Callable, Dict, Optional
+
+# Third-party imports
+# -------------------
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Local application imports
+# -------------------------
+# None.
+
+
+# Pool metrics
+# ============
+class PoolMetrics:
+    def __init__(self) -> None:
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.total_checkout_wait = 0.0
+        self.max_checkout_wait = 0.0
+
+    def record_checkout_wait(self, wait: float, timed_out: bool) -> None:
+        if timed_out:
+            self.checkout_timeouts += 1
+        self.total_checkout_wait += wait
+        self.max_checkout_wait = max(self.max_checkout_wait, wait)
+
+    # Report metrics for monitoring. Times are in seconds.
+    def stats(self) -> Dict[str, Any]:
+        waits = self.checkouts + self.checkout_timeouts
+        return dict(
+            in_use=self.in_use,
+            max_in_use=self.max_in_use,
+            checkouts=self.checkouts,
+            checkout_timeouts=self.checkout_timeouts,
+            avg_checkout_wait=self.total_checkout_wait / waits if waits else 0.0,
+            max_checkout_wait=self.max_checkout_wait,
+        )
+
+
+pool_metrics = PoolMetrics()
+
+
+# A pool which records how long each checkout waits for a connection. This includes the time to open a new connection, which is also a cost of a pool which is too small.
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self) -> Any:
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.record_checkout_wait(time.perf_counter() - start, True)
+            raise
+        pool_metrics.record_checkout_wait(time.perf_counter() - start, False)
+        return conn
+
+
+# Crud metrics
+# ============
+class FunctionMetrics:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.queries = 0
+        self.total_query_time = 0.0
+
+    # Report metrics for monitoring. Times are in seconds.
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            calls=self.calls,
+            errors=self.errors,
+            avg_latency=self.total_latency / self.calls if self.calls else 0.0,
+            max_latency=self.max_latency,
+            queries=self.queries,
+            avg_query_time=(
+                self.total_query_time / self.queries if self.queries else 0.0
+            ),
+        )
+
+
+# Metrics for each crud function, keyed by the function's name.
+crud_metrics: Dict[str, FunctionMetrics] = {}
+
+# The name of the crud function now running, so that SQL statements can be attributed to it. This is a context variable, so each request (task) has its own; SQLAlchemy runs statements in a greenlet which sees the same context. When one crud function calls another, statements are attributed to the innermost.
+_current_function: ContextVar[Optional[str]] = ContextVar(
+    "current_crud_function", default=None
+)
+
+
+# Wrap a coroutine function to record its metrics under ``name``.
+def _instrument(func: Callable, name: str) -> Callable:
+    metrics = crud_metrics.setdefault(name, FunctionMetrics())
+
+    @wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        token = _current_function.set(name)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            metrics.errors += 1
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            metrics.calls += 1
+            metrics.total_latency += latency
+            metrics.max_latency = max(metrics.max_latency, latency)
+            _current_function.reset(token)
+
+    return wrapper
+
+
+# Instrument every coroutine function defined in a module, given the module's ``globals()``. Call this at the end of the module, so that other modules import the instrumented functions.
+def instrument_module(module_globals: Dict[str, Any]) -> None:
+    module_name = module_globals["__name__"]
+    for name, obj in list(module_globals.items()):
+        if (
+            inspect.iscoroutinefunction(obj)
+            and obj.__module__ == module_name
+            and not name.startswith("_")
+        ):
+            module_globals[name] = _instrument(obj, name)
+
+
+# Engine events
+# =============
+# Attach the event listeners which record pool and statement metrics to ``engine``.
+def instrument_engine(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "checkout")
+    def checkout(dbapi_connection: Any, connection_record: Any, proxy: Any) -> None:
+        pool_metrics.checkouts += 1
+        pool_metrics.in_use += 1
+        pool_metrics.max_in_use = max(pool_metrics.max_in_use, pool_metrics.in_use)
+
+    @event.listens_for(sync_engine, "checkin")
+    def checkin(dbapi_connection: Any, connection_record: Any) -> None:
+        pool_metrics.in_use -= 1
+
+    # Store the start time in the statement's execution context, which is discarded if the statement fails.
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(
+        conn: Any,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        if context is not None:
+            context._rs_query_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(
+        conn: Any,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        name = _current_function.get()
+        start = getattr(context, "_rs_query_start", None)
+        if name is not None and start is not None:
+            metrics = crud_metrics[name]
+            metrics.queries += 1
+            metrics.total_query_time += time.perf_counter() - start
+
+
+# Reporting
+# =========
+# Report all database metrics for this worker process. ``engine`` provides the pool's current size and overflow.
+def db_stats(engine: AsyncEngine) -> Dict[str, Any]:
+    pool = engine.sync_engine.pool
+    pool_stats = dict(pool_class=type(pool).__name__, **pool_metrics.stats())
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        pool_stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            overflow=pool.overflow(),
+        )
+    return dict(
+        pool=pool_stats,
+        crud={
+            name: metrics.stats()
+            for name, metrics in sorted(crud_metrics.items())
+            if metrics.calls
+        },
+    )
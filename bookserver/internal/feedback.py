@@ -10,12 +10,12 @@
 # Standard library
 # ----------------
 import ast
-from bookserver.crud import fetch_course
+import asyncio
+from bookserver.crud import fetch_course, update_answer_entry
 import json
 import os
 import re
-import tempfile
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 # Third-party imports
 # -------------------
@@ -27,8 +27,10 @@ from runestone.lp.lp_common_lib import (
 
 # Local imports
 # -------------
+from ..applogger import rslogger
+from ..db import release_db_session
 from ..models import runestone_component_dict
-from .scheduled_builder import _scheduled_builder
+from .lp_builds import defer_build, run_build
 from ..config import settings
 
 
@@ -41,6 +43,8 @@ def init_graders():
         ("lp_answers", lp_feedback),
     ):
         runestone_component_dict[table_name].grader = grader
+    runestone_component_dict["fitb_answers"].feedback_compiler = FITBGrader
+    runestone_component_dict["fitb_answers"].batch_grader = grade_fitb_batch
 
 
 # Provide feedback for a fill-in-the-blank problem. This should produce
@@ -48,12 +52,39 @@ def init_graders():
 async def fitb_feedback(
     # The validator for the ``fitb_answers`` table containing data before it's stored in the db. This function updates the grade stored in the validator.
     fitb_validator: Any,
-    # The feedback to use when grading this question, taken from the ``feedback`` field of the ``fitb_answers`` table.
-    feedback: Dict[Any, Any],
+    # The feedback to use when grading this question, taken from the ``feedback`` field of the ``questions`` table. This may be already compiled into a `FITBGrader`.
+    feedback: Any,
 ) -> Dict[str, Any]:
-    # Grade based on this feedback. The new format is JSON; the old is
-    # comma-separated.
-    answer_json = fitb_validator.answer
+    grader = feedback if isinstance(feedback, FITBGrader) else FITBGrader(feedback)
+    answer = _parse_fitb_answer(fitb_validator.answer)
+    correct, percent, displayFeed, isCorrectArray = grader.grade(answer)
+
+    # Update the values to be stored in the db.
+    fitb_validator.correct = correct
+    fitb_validator.percent = percent
+
+    # Return grading results to the client for a non-exam scenario.
+    if settings.is_exam:
+        return dict(
+            correct=True,
+            displayFeed=["Response recorded."] * len(answer),
+            isCorrectArray=[True] * len(answer),
+            percent=1,
+        )
+    else:
+        return dict(
+            correct=correct,
+            displayFeed=displayFeed,
+            isCorrectArray=isCorrectArray,
+            percent=percent,
+        )
+
+
+# Grade based on this feedback. The new format is JSON; the old is
+# comma-separated. Older rows may have no answer (NULL); treat this as no blanks.
+def _parse_fitb_answer(answer_json: Optional[str]) -> List[Any]:
+    if answer_json is None:
+        return []
     try:
         answer = json.loads(answer_json)
         # Some answers may parse as JSON, but still be in the old format. The
@@ -61,76 +92,120 @@ async def fitb_feedback(
         assert isinstance(answer, list)
     except Exception:
         answer = answer_json.split(",")
-    displayFeed = []
-    isCorrectArray: List[Optional[bool]] = []
-    # The overall correctness of the entire problem.
-    correct = True
-    for blank, feedback_for_blank in zip(answer, feedback):
-        if not blank:
-            isCorrectArray.append(None)
-            displayFeed.append("No answer provided.")
-            correct = False
-        else:
-            # The correctness of this problem depends on if the first item matches.
-            is_first_item = True
+    return answer
+
+
+# Numbers which ``float`` or ``int`` parse exactly as ``ast.literal_eval`` would. Python doesn't allow leading zeros in an integer literal, so neither does ``_INT``.
+_INT = re.compile(r"[+-]?(0|[1-9][0-9]*)")
+_FLOAT = re.compile(
+    r"[+-]?(([0-9]+\.[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?|[0-9]+[eE][+-]?[0-9]+)"
+)
+# Returned by ``_parse_number`` when a blank isn't a number.
+_NOT_A_NUMBER = object()
+
+
+# Parse a blank as a number, taking the fast path for plain decimal numbers.
+def _parse_number(blank: Any) -> Any:
+    try:
+        # Note that ``literal_eval`` does **not** discard leading / trailing spaces, but considers them indentation errors. So, explicitly invoke ``strip``.
+        s = blank.strip()
+        if _INT.fullmatch(s):
+            return int(s)
+        if _FLOAT.fullmatch(s):
+            return float(s)
+        return ast.literal_eval(s)
+    except Exception:
+        return _NOT_A_NUMBER
+
+
+# A fill-in-the-blank question's feedback, compiled for grading: the regexes are compiled and the numeric ranges extracted once, instead of for every answer graded. `init_graders` registers this as the ``feedback_compiler`` for ``fitb_answers``, so that ``is_server_feedback`` in `../crud.py` caches a compiled grader for each question.
+class FITBGrader:
+    def __init__(self, feedback: List[List[Dict[str, Any]]]):
+        # For each blank, a list of (compiled regex or None, min, max, feedback) for every feedback item but the last, plus the feedback from the last item, which always matches.
+        self.blanks = []
+        for feedback_for_blank in feedback:
+            matchers = []
             # Check everything but the last answer, which always matches.
             for fb in feedback_for_blank[:-1]:
                 if "regex" in fb:
-                    if re.search(
-                        fb["regex"], blank, re.I if fb["regexFlags"] == "i" else 0
-                    ):
-                        isCorrectArray.append(is_first_item)
-                        if not is_first_item:
-                            correct = False
-                        displayFeed.append(fb["feedback"])
-                        break
+                    pattern = re.compile(
+                        fb["regex"], re.I if fb["regexFlags"] == "i" else 0
+                    )
+                    matchers.append((pattern, None, None, fb["feedback"]))
                 else:
                     assert "number" in fb
                     min_, max_ = fb["number"]
+                    matchers.append((None, min_, max_, fb["feedback"]))
+            last_feedback = (
+                feedback_for_blank[-1]["feedback"] if feedback_for_blank else None
+            )
+            self.blanks.append((matchers, last_feedback))
+
+    # Grade an answer (a list of blanks). Return (correct, percent, displayFeed, isCorrectArray).
+    def grade(
+        self, answer: List[Any]
+    ) -> Tuple[bool, float, List[str], List[Optional[bool]]]:
+        displayFeed = []
+        isCorrectArray: List[Optional[bool]] = []
+        # The overall correctness of the entire problem.
+        correct = True
+        for blank, (matchers, last_feedback) in zip(answer, self.blanks):
+            if not blank:
+                isCorrectArray.append(None)
+                displayFeed.append("No answer provided.")
+                correct = False
+                continue
+
+            # Parse the blank as a number only when a numeric item needs it.
+            val = None
+            for index, (pattern, min_, max_, feedback) in enumerate(matchers):
+                if pattern is not None:
+                    matched = bool(pattern.search(blank))
+                else:
+                    if val is None:
+                        val = _parse_number(blank)
                     try:
-                        # Note that ``literal_eval`` does **not** discard leading / trailing spaces, but considers them indentation errors. So, explicitly invoke ``strip``.
-                        val = ast.literal_eval(blank.strip())
-                        in_range = val >= min_ and val <= max_
+                        matched = val >= min_ and val <= max_
                     except Exception:
                         # In case something weird or invalid was parsed (dict, etc.)
-                        in_range = False
-                    if in_range:
-                        isCorrectArray.append(is_first_item)
-                        if not is_first_item:
-                            correct = False
-                        displayFeed.append(fb["feedback"])
-                        break
-                is_first_item = False
+                        matched = False
+                if matched:
+                    # The correctness of this problem depends on if the first item matches.
+                    isCorrectArray.append(index == 0)
+                    if index != 0:
+                        correct = False
+                    displayFeed.append(feedback)
+                    break
             # Nothing matched. Use the last feedback.
             else:
                 isCorrectArray.append(False)
                 correct = False
-                displayFeed.append(feedback_for_blank[-1]["feedback"])
+                displayFeed.append(last_feedback)
 
-    # Note that this isn't a percentage, but a ratio where 1.0 == all correct.
-    percent = (
-        isCorrectArray.count(True) / len(isCorrectArray) if len(isCorrectArray) else 0
-    )
+        # An answer with fewer blanks than the question (such as a missing answer) isn't correct.
+        if len(answer) < len(self.blanks):
+            correct = False
+        # Note that this isn't a percentage, but a ratio where 1.0 == all correct.
+        percent = (
+            isCorrectArray.count(True) / len(isCorrectArray)
+            if len(isCorrectArray)
+            else 0
+        )
+        return correct, percent, displayFeed, isCorrectArray
 
-    # Update the values to be stored in the db.
-    fitb_validator.correct = correct
-    fitb_validator.percent = percent
 
-    # Return grading results to the client for a non-exam scenario.
-    if settings.is_exam:
-        return dict(
-            correct=True,
-            displayFeed=["Response recorded."] * len(answer),
-            isCorrectArray=[True] * len(answer),
-            percent=1,
-        )
-    else:
-        return dict(
-            correct=correct,
-            displayFeed=displayFeed,
-            isCorrectArray=isCorrectArray,
-            percent=percent,
-        )
+# Grade many answers to one question, for `bulk regrading <regrade.py>`. This runs in a worker process, so it must be a top-level function of a picklable ``grader``. Return a dict of the new column values for each answer; this is empty for an answer which can't be graded (a NULL answer), so that its stored grade is kept.
+def grade_fitb_batch(
+    grader: FITBGrader, answers: List[Optional[str]]
+) -> List[Dict[str, Any]]:
+    grades: List[Dict[str, Any]] = []
+    for answer in answers:
+        if answer is None:
+            grades.append({})
+            continue
+        correct, percent, *_ = grader.grade(_parse_fitb_answer(answer))
+        grades.append(dict(correct=correct, percent=percent))
+    return grades
 
 
 # lp feedback
@@ -139,6 +214,9 @@ async def lp_feedback(lp_validator: Any, feedback: Dict[Any, Any]):
     # Begin by reformatting the answer for storage in the database. Do this now, so the code will be stored correctly even if the function returns early due to an error.
     try:
         code_snippets = json.loads(lp_validator.answer)
+        # When regrading, the answer is in the form stored below.
+        if isinstance(code_snippets, dict):
+            code_snippets = code_snippets["code_snippets"]
     except Exception:
         lp_validator.answer = json.dumps({})
         return {"errors": [f"Unable to load answers from '{lp_validator.answer}'."]}
@@ -195,41 +273,80 @@ async def lp_feedback(lp_validator: Any, feedback: Dict[Any, Any]):
     # Join them into a single string. Make sure newlines separate everything.
     source_str = "\n".join(interleaved_source)
 
-    # Create a temporary directory, then write the source there.
-    with tempfile.TemporaryDirectory() as temp_path:
-        temp_source_path = os.path.join(temp_path, os.path.basename(source_path))
-        with open(temp_source_path, "w", encoding="utf-8") as f:
-            f.write(source_str)
-
-        try:
-            res = _scheduled_builder.delay(
-                feedback["builder"],
-                temp_source_path,
-                sphinx_base_path,
-                sphinx_source_path,
-                sphinx_out_path,
-                source_path,
-            )
-            output, correct = res.get(timeout=60)
-        except Exception as e:
-            return {"errors": ["Error in build task: {}".format(e)]}
+    # Build using the configured `builder executor <builder_executor.py>`. The builder writes the source to its own temporary directory. Since this may take seconds, don't hold a database connection while waiting.
+    await release_db_session()
+    build = asyncio.create_task(
+        run_build(
+            course.course_name,
+            feedback["builder"],
+            os.path.basename(source_path),
+            sphinx_base_path,
+            sphinx_source_path,
+            sphinx_out_path,
+            source_path,
+            source_str=source_str,
+        )
+    )
+
+    # Store the results of a build in ``validator``; return the response for the client.
+    def record_build(validator: Any, output: str, correct: int) -> Dict[str, Any]:
+        # Strip whitespace and return only the last 4K or data or so.
+        # There's no need for more -- it's probably just a crashed or
+        # confused program spewing output, so don't waste bandwidth or
+        # storage space on it.
+        resultString = output.strip()[-4096:]
+        # Update the data to be stored in the database.
+        validator.answer = json.dumps(
+            dict(code_snippets=code_snippets, resultString=resultString)
+        )
+        validator.correct = correct
+        # Return just new data (not the code snippets) to the client.
+        return {
+            # The answer.
+            "answer": {"resultString": resultString},
+            "correct": correct,
+        }
+
+    try:
+        if settings.lp_build_wait is None:
+            await build
         else:
-            # Strip whitespace and return only the last 4K or data or so.
-            # There's no need for more -- it's probably just a crashed or
-            # confused program spewing output, so don't waste bandwidth or
-            # storage space on it.
-            resultString = output.strip()[-4096:]
-            # Update the data to be stored in the database.
-            lp_validator.answer = json.dumps(
-                dict(code_snippets=code_snippets, resultString=resultString)
-            )
-            lp_validator.correct = correct
-            # Return just new data (not the code snippets) to the client.
-            return {
-                # The answer.
-                "answer": {"resultString": resultString},
-                "correct": correct,
-            }
+            await asyncio.wait_for(asyncio.shield(build), settings.lp_build_wait)
+    except Exception:
+        # Any error is reported below.
+        pass
+    if not build.done():
+        # This is a long build. Store the answer as ungraded, then finish the build in the background; the client polls for the results using the returned ``build_id``.
+        lp_validator.correct = None
+        pending_validator = lp_validator.copy()
+
+        async def finish() -> Dict[str, Any]:
+            output, correct = await build
+            response = record_build(pending_validator, output, correct)
+            if not await update_answer_entry(
+                runestone_component_dict["lp_answers"].model,
+                pending_validator.sid,
+                pending_validator.div_id,
+                pending_validator.course_name,
+                pending_validator.timestamp,
+                dict(
+                    answer=pending_validator.answer,
+                    correct=pending_validator.correct,
+                ),
+            ):
+                rslogger.warning(
+                    f"No stored answer for the build of {pending_validator.div_id} by {pending_validator.sid}."
+                )
+            return response
+
+        build_id = await defer_build(lp_validator.sid, finish())
+        return {"build_id": build_id, "correct": None}
+
+    try:
+        output, correct = build.result()
+    except Exception as e:
+        return {"errors": ["Error in build task: {}".format(e)]}
+    return record_build(lp_validator, output, correct)
 
 
 # This function should take a list of code snippets and modify them to prepare
@@ -0,0 +1,158 @@
+# ******************************************************
+# |docname| - Top answers to fill-in-the-blank questions
+# ******************************************************
+# The "compare me" button of a fill-in-the-blank question shows the most common answers in the student's course since the start of the term (see ``gettop10Answers`` in `../routers/assessment.py`). Finding these means grouping and sorting every row of ``fitb_answers`` for the question on each click. Instead, this module keeps the count of each answer in a Redis sorted set, ``fitb_top:{course}:{div_id}``, updating it as the `log_book_event endpoint` logs each answer. The sorted set keeps its members ordered by count, so reading the top answers costs the same however many answers were given.
+#
+# The counts are exact: a question has few distinct answers, so there's no need to approximate them. As in the `answer counts <answer_counts.py>`, the set is loaded from the database the first time it's needed, and an answer is counted only if the set is loaded or being loaded; loading takes the same lock, and merges the database's counts into the answers logged meanwhile in the same way. The marker member ``""`` (with a score of 0, below any answer, and never a valid answer) records that the set is loaded. The set expires after ``settings.fitb_top_answers_ttl`` seconds and is then reloaded, correcting any drift and following changes to the course's term start date.
+#
+# This is used only when ``settings.redis_cache`` is true; otherwise, or if Redis is unavailable, the top answers come from the database as before.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+from typing import List, Optional, Tuple
+
+# Third-party imports
+# -------------------
+import aioredis
+
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import settings
+from ..crud import count_fitb_answers, fetch_top10_fitb
+from ..models import CoursesValidator
+from .redis_client import get_redis, redis_lock
+
+# The member which marks the set as loaded.
+_LOADED = ""
+
+# The number of answers returned.
+TOP_N = 10
+
+# Increment a count, but only if the set is loaded or being loaded. KEYS are the set and its load lock; ARGV are the answer and the set's TTL.
+_INCREMENT_IF_LOADED = """
+if redis.call("zscore", KEYS[1], "") or redis.call("exists", KEYS[2]) == 1 then
+    local count = redis.call("zincrby", KEYS[1], 1, ARGV[1])
+    if redis.call("ttl", KEYS[1]) < 0 then
+        redis.call("expire", KEYS[1], ARGV[2])
+    end
+    return count
+end
+return 0
+"""
+
+# Add the counts read from the database to the set, then mark it as loaded, if the load lock is still held. KEYS are the set and its lock; ARGV are the lock's token, the set's TTL, the number of top answers to return, then pairs of answer and count. Return the top members with their scores, in the form ``zrevrange`` returns, or nil if the lock was lost.
+_MERGE_COUNTS = """
+if redis.call("get", KEYS[2]) ~= ARGV[1] then
+    return nil
+end
+for i = 4, #ARGV, 2 do
+    redis.call("zincrby", KEYS[1], ARGV[i + 1], ARGV[i])
+end
+redis.call("zadd", KEYS[1], 0, "")
+redis.call("expire", KEYS[1], ARGV[2])
+return redis.call("zrevrange", KEYS[1], 0, ARGV[3], "withscores")
+"""
+
+
+def _key(course_name: str, div_id: str) -> str:
+    return f"fitb_top:{course_name}:{div_id}"
+
+
+def _lock_key(key: str) -> str:
+    return f"{key}:load"
+
+
+# Record an ``answer`` to the fill-in-the-blank question ``div_id``.
+async def record_fitb_answer(
+    course_name: str, div_id: str, answer: Optional[str]
+) -> None:
+    # Like `count_fitb_answers <../crud.py>`, don't count missing answers.
+    if not settings.redis_cache or not answer:
+        return
+    key = _key(course_name, div_id)
+    try:
+        await get_redis().eval(
+            _INCREMENT_IF_LOADED,
+            2,
+            key,
+            _lock_key(key),
+            answer,
+            settings.fitb_top_answers_ttl,
+        )
+    except (aioredis.RedisError, OSError) as e:
+        # The counts are now incomplete; drop them (and any load in progress) so they will be reloaded.
+        rslogger.warning(f"Unable to record a fill-in-the-blank answer in Redis: {e}")
+        await _discard(key)
+
+
+# Return a list of (answer, count) for the ``TOP_N`` most common answers to ``div_id`` in ``dbcourse`` since the start of its term, most common first.
+async def fetch_top_fitb_answers(
+    dbcourse: CoursesValidator, div_id: str
+) -> List[Tuple[str, int]]:
+    if settings.redis_cache:
+        top = await _fetch_from_redis(dbcourse, div_id)
+        if top is not None:
+            return top
+    return [tuple(row) for row in await fetch_top10_fitb(dbcourse, div_id)]
+
+
+# Read the top answers, loading the set if necessary. Return None if Redis can't answer.
+async def _fetch_from_redis(
+    dbcourse: CoursesValidator, div_id: str
+) -> Optional[List[Tuple[str, int]]]:
+    key = _key(dbcourse.course_name, div_id)
+    try:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            # Read one extra member, in case the marker is among them.
+            loaded, members = (
+                await pipe.zscore(key, _LOADED)
+                .zrevrange(key, 0, TOP_N, withscores=True)
+                .execute()
+            )
+        if loaded is None:
+            async with redis_lock(_lock_key(key), key) as token:
+                members = token and await _load(key, token, dbcourse, div_id)
+            if members is None:
+                return None
+        return [
+            (answer.decode(), int(count))
+            for answer, count in members
+            if answer != _LOADED.encode()
+        ][:TOP_N]
+    except (aioredis.RedisError, OSError) as e:
+        rslogger.warning(
+            f"Unable to read top fill-in-the-blank answers from Redis: {e}"
+        )
+        return None
+
+
+# Load the counts of every answer from the database into the set, which the caller emptied when taking the load lock, whose token is ``token``. Return the top members with their scores, as ``zrevrange`` returns them, including one extra in case the marker is among them; return None if the lock was lost.
+async def _load(
+    key: str, token: str, dbcourse: CoursesValidator, div_id: str
+) -> Optional[List[Tuple[bytes, float]]]:
+    rows = await count_fitb_answers(dbcourse, div_id)
+    merged = await get_redis().eval(
+        _MERGE_COUNTS,
+        2,
+        key,
+        _lock_key(key),
+        token,
+        settings.fitb_top_answers_ttl,
+        TOP_N,
+        *[value for answer, count in rows for value in (answer, count)],
+    )
+    if merged is None:
+        return None
+    return list(zip(merged[::2], merged[1::2]))
+
+
+async def _discard(key: str) -> None:
+    try:
+        await get_redis().delete(key, _lock_key(key))
+    except (aioredis.RedisError, OSError):
+        pass
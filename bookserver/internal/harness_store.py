@@ -0,0 +1,176 @@
+# ******************************************************
+# |docname| - Precompiled test harnesses for LP builders
+# ******************************************************
+# The xc16 and ARMv7 builders in `scheduled_builder.py` test a student's code by linking it with the instructor's test code. Compiling the test code (plus, for ARMv7, assembling its interrupt vectors) takes as long as compiling the student's code, yet it only changes when the book is rebuilt. This module stores these objects per book, compiling them once, so that each submission only compiles the student's code and links.
+#
+# Each test run checks for a random verification code, so that student code can't simply print a passing result. This code must differ for every submission, since students see the output of their tests (which contains the code). Therefore, the precompiled test code refers to the verification code as an external variable, whose name is chosen at random when the harness is compiled; each submission links in a one-line C file (`Harness.write_verification_source`) which defines this variable with a new code. A harness whose test code can't be compiled this way (for example, if it uses ``VERIFICATION_CODE`` to initialize a static variable) is recorded as unusable, and the builder compiles the test code for each submission as before.
+#
+# A harness which can't be compiled because of a failure outside the test code (such as a missing toolchain, or a compile which times out) isn't recorded, since the failure may be transient. Instead, this process doesn't try to compile it again for ``_FAILURE_BACKOFF`` seconds.
+#
+# Harnesses are stored in the directory given by the ``LP_HARNESS_PATH`` environment variable, in a subdirectory named by a hash of the builder, its toolchain version, the compile commands, the contents of the test code, and the modification times of the book's support files; rebuilding the book therefore produces a new harness.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import json
+import os
+from pathlib import Path
+import secrets
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+# Third-party imports
+# -------------------
+# None.
+
+# Local imports
+# -------------
+from .build_cache import build_key
+
+
+# Configuration
+# =============
+_store_path = Path(
+    os.environ.get("LP_HARNESS_PATH", Path.home() / "Runestone/lp_harness")
+)
+
+# The time, in seconds, to wait before trying again to compile a harness whose compile failed for reasons outside the test code.
+_FAILURE_BACKOFF = 300
+
+# For each harness whose compile failed this way, the ``time.monotonic()`` at which to try again.
+_failures: Dict[Path, float] = {}
+
+
+# Harnesses
+# =========
+class Harness:
+    def __init__(self, path: Path, meta: dict):
+        self.path = path
+        # The name of the variable holding the verification code.
+        self.symbol = meta["symbol"]
+        # Its C type.
+        self.c_type = meta["c_type"]
+
+    # Return the path to the precompiled object ``name``.
+    def object_path(self, name: str) -> str:
+        return str(self.path / name)
+
+    # Write a C source file defining the verification code for one submission.
+    def write_verification_source(self, path: str, verification_code: int) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"{self.c_type} {self.symbol} = {verification_code}ul;\n")
+
+
+# Return the harness for a book's test code, compiling it if necessary. Return None if the test code can't be precompiled.
+def get_harness(
+    # The name of the builder.
+    builder: str,
+    # The C type of the verification code; it must hold any value returned by ``get_verification_code``.
+    c_type: str,
+    # Given the directory to place objects in and the compiler options which define ``VERIFICATION_CODE``, return a list of commands (each a list of arguments for ``subprocess.run``) which compile the harness.
+    compile_commands: Callable[[str, List[str]], List[List[str]]],
+    # The files whose contents determine the harness, such as the test code.
+    content_paths: List[str],
+    # The files whose modification times determine the harness, such as the book's libraries.
+    mtime_paths: List[str],
+) -> Optional[Harness]:
+    key = build_key(
+        builder,
+        json.dumps([c_type, compile_commands("", [])]),
+        content_paths,
+        mtime_paths,
+    )
+    path = _store_path / key
+    meta = _read_meta(path)
+    if meta is None:
+        if _failures.get(path, 0) > time.monotonic():
+            return None
+        meta = _compile(path, c_type, compile_commands)
+        if meta is None:
+            _record_failure(path)
+    return Harness(path, meta) if meta and meta["ok"] else None
+
+
+def _record_failure(path: Path) -> None:
+    now = time.monotonic()
+    # Forget failures whose back-off has passed, so that this doesn't grow as books are rebuilt.
+    for failed_path, retry_time in list(_failures.items()):
+        if retry_time <= now:
+            del _failures[failed_path]
+    _failures[path] = now + _FAILURE_BACKOFF
+
+
+def _read_meta(path: Path) -> Optional[dict]:
+    try:
+        with open(path / "meta.json", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Compile a harness in a temporary directory, then move it to ``path``. If another process finished the same harness first, use that one instead. Return the harness's metadata.
+def _compile(
+    path: Path,
+    c_type: str,
+    compile_commands: Callable[[str, List[str]], List[List[str]]],
+) -> Optional[dict]:
+    symbol = f"runestone_vc_{secrets.token_hex(8)}"
+    try:
+        _store_path.mkdir(parents=True, exist_ok=True)
+        temp_path = tempfile.mkdtemp(dir=_store_path)
+    except OSError:
+        return None
+    try:
+        header_path = os.path.join(temp_path, "verification_code.h")
+        with open(header_path, "w", encoding="utf-8") as f:
+            f.write(f"extern {c_type} {symbol};\n")
+        flags = [f"-DVERIFICATION_CODE=({symbol})", "-include", header_path]
+        ok = True
+        for args in compile_commands(temp_path, flags):
+            try:
+                returncode = _run(args, temp_path)
+            except (OSError, subprocess.TimeoutExpired):
+                # This may be a transient failure; don't store it. The caller backs off instead.
+                return None
+            if returncode:
+                ok = False
+                break
+        meta = dict(ok=ok, symbol=symbol, c_type=c_type)
+        with open(os.path.join(temp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Another process stored this harness first.
+            return _read_meta(path)
+        return meta
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+# Run a compile command in ``cwd``, returning its exit code. On a timeout, kill every process it started, not just the compiler driver, so that none writes to ``cwd`` after it's removed.
+def _run(args: List[str], cwd: str) -> int:
+    with subprocess.Popen(
+        args,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    ) as proc:
+        try:
+            return proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            raise
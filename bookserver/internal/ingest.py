@@ -0,0 +1,253 @@
+# ***************************************************
+# |docname| - Write-behind ingestion of logged events
+# ***************************************************
+# The `log_book_event endpoint` is called for nearly every click in a book. Writing each ``useinfo`` row and each answer table row in its own transaction means several commits per click, which becomes the bottleneck at peak load. Instead, this module queues rows in process and writes them in batches: a background task collects rows until ``settings.ingest_batch_size`` are waiting or ``settings.ingest_flush_interval`` seconds have passed since the first row of the batch arrived, then inserts the whole batch in one transaction.
+#
+# Durability is selected by ``settings.ingest_ack`` (see ``IngestAck`` in `../config.py`):
+#
+# - ``flush`` (the default): a request waits until its rows are committed, so the endpoint's response still means the data is stored. Concurrent requests share a commit. A request which stores several rows queues them all (``queue_useinfo``, ``queue_answer``), then waits for them together (``wait``), so that they also share a commit.
+# - ``enqueue``: a request returns once its rows are queued. This is faster, but rows still in the queue are lost if the worker crashes.
+# - ``direct``: bypass the queue completely, writing each row as before.
+#
+# The queue is bounded by ``settings.ingest_max_queue``; when it's full, requests wait for space (backpressure) instead of growing memory without limit. On shutdown, `../main.py` calls ``drain`` so that queued rows are written before the database engine is disposed of.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+# Third-party imports
+# -------------------
+# None.
+#
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import IngestAck, settings
+from ..crud import (
+    EVENT2TABLE,
+    create_answer_table_entry,
+    create_many_entries,
+    create_useinfo_entry,
+)
+from ..db import Base, note_write, release_db_session
+from ..models import Useinfo, UseinfoValidation, runestone_component_dict
+from ..schemas import LogItemIncoming
+
+
+# Pipeline
+# ========
+# Each queued item is the model to insert into, the column values of the row, and (when acknowledging after a flush) a future to resolve once the row is committed.
+_QueueItem = Tuple[Type[Base], Dict[str, Any], Optional[asyncio.Future]]
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        ack: IngestAck,
+        batch_size: int,
+        flush_interval: float,
+        max_queue: int,
+    ):
+        self.ack = ack
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        # These are created by ``start``, since they must belong to the running event loop.
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+        # Metrics; see ``stats``.
+        self.rows_written = 0
+        self.batches_written = 0
+        self.rows_failed = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    # Start the background writer. Call this from the application's startup event.
+    def start(self) -> None:
+        if self.ack == IngestAck.direct or self._worker:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._worker = asyncio.create_task(self._run())
+        rslogger.info(
+            f"Ingestion pipeline started: ack={self.ack.value}, batch size={self.batch_size}, flush interval={self.flush_interval} s."
+        )
+
+    # Write everything still queued, then stop the background writer. Rows added after this are written directly.
+    async def drain(self) -> None:
+        queue, worker = self._queue, self._worker
+        if not (queue and worker):
+            return
+        # Route new rows around the queue while it empties.
+        self._queue = None
+        self._worker = None
+        rslogger.info(f"Draining {queue.qsize()} queued rows.")
+        await queue.join()
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+
+    # Queue a ``useinfo`` row, then wait until it's acknowledged.
+    async def add_useinfo(self, log_entry: UseinfoValidation) -> UseinfoValidation:
+        await self.wait(await self.queue_useinfo(log_entry))
+        return log_entry
+
+    # Queue a row for the answer table associated with ``event``, then wait until it's acknowledged.
+    async def add_answer(
+        self, log_entry: LogItemIncoming, event: str
+    ) -> LogItemIncoming:
+        await self.wait(await self.queue_answer(log_entry, event))
+        return log_entry
+
+    # Queue a ``useinfo`` row without waiting for it to be written. Pass the result to ``wait``; a caller which stores several rows should queue them all, then wait for them together, so that they share a flush.
+    async def queue_useinfo(
+        self, log_entry: UseinfoValidation
+    ) -> Optional[asyncio.Future]:
+        if not self._queue:
+            await create_useinfo_entry(log_entry)
+            return None
+        return await self._put(Useinfo, log_entry.dict())
+
+    # Queue a row for the answer table associated with ``event``; see ``queue_useinfo``.
+    async def queue_answer(
+        self, log_entry: LogItemIncoming, event: str
+    ) -> Optional[asyncio.Future]:
+        if not self._queue:
+            await create_answer_table_entry(log_entry, event)
+            return None
+        rcd = runestone_component_dict[EVENT2TABLE[event]]
+        return await self._put(rcd.model, log_entry.dict())
+
+    # Wait until the rows queued by ``queue_useinfo`` and ``queue_answer`` are acknowledged; ``None`` (from a row already written, or which isn't acknowledged after a flush) is ignored. Raise the first error.
+    async def wait(self, *futures: Optional[asyncio.Future]) -> None:
+        pending = [future for future in futures if future]
+        if not pending:
+            return
+        # The writer needs a connection from the same pool; a request holding its connection while waiting for the writer could deadlock the pool under load. Give it back first.
+        await release_db_session()
+        # Collect every result, so that no error goes unretrieved.
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, BaseException):
+                raise result
+
+    # Queue a row. Return a future which completes once the row is committed when acknowledging after a flush, or None otherwise.
+    async def _put(
+        self, model: Type[Base], row: Dict[str, Any]
+    ) -> Optional[asyncio.Future]:
+        assert self._queue
+        note_write()
+        # Let the database assign the ID.
+        row.pop("id", None)
+        future = (
+            asyncio.get_running_loop().create_future()
+            if self.ack == IngestAck.flush
+            else None
+        )
+        # This waits if the queue is full, providing backpressure.
+        await self._queue.put((model, row, future))
+        return future
+
+    # The background writer: collect a batch, then flush it.
+    async def _run(self) -> None:
+        assert self._queue
+        queue = self._queue
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[_QueueItem] = [await queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                # Take whatever is already waiting without a timer, then wait for more until the deadline.
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # ``_flush`` reports errors through the futures; this is a last resort to keep the writer alive. Don't leave any request waiting for a batch which will never be written.
+                rslogger.error(f"Unexpected error while flushing a batch: {e}")
+                for model, row, future in batch:
+                    if future and not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _flush(self, batch: List[_QueueItem]) -> None:
+        start = time.perf_counter()
+        entries: Dict[Type[Base], List[Dict[str, Any]]] = {}
+        for model, row, future in batch:
+            entries.setdefault(model, []).append(row)
+        try:
+            await create_many_entries(entries)
+        except Exception as e:
+            # One bad row (for example, a course that doesn't exist) fails the whole batch. Retry each row on its own so that only the bad rows are lost.
+            rslogger.error(
+                f"Batch insert of {len(batch)} rows failed ({e}); retrying row by row."
+            )
+            for model, row, future in batch:
+                try:
+                    await create_many_entries({model: [row]})
+                except Exception as row_e:
+                    self.rows_failed += 1
+                    rslogger.error(
+                        f"Unable to store {model.__tablename__} row {row}: {row_e}"
+                    )
+                    if future and not future.done():
+                        future.set_exception(row_e)
+                else:
+                    self.rows_written += 1
+                    if future and not future.done():
+                        future.set_result(None)
+        else:
+            self.rows_written += len(batch)
+            for model, row, future in batch:
+                if future and not future.done():
+                    future.set_result(None)
+
+        self.batches_written += 1
+        self.last_flush_latency = time.perf_counter() - start
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.total_flush_latency += self.last_flush_latency
+
+    # Report metrics for monitoring. Latencies are in seconds.
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            ack=self.ack.value,
+            queue_depth=self._queue.qsize() if self._queue else 0,
+            max_queue=self.max_queue,
+            rows_written=self.rows_written,
+            rows_failed=self.rows_failed,
+            batches_written=self.batches_written,
+            last_flush_latency=self.last_flush_latency,
+            max_flush_latency=self.max_flush_latency,
+            avg_flush_latency=(
+                self.total_flush_latency / self.batches_written
+                if self.batches_written
+                else 0.0
+            ),
+        )
+
+
+# There's one pipeline per worker process.
+ingest_pipeline = IngestPipeline(
+    settings.ingest_ack,
+    settings.ingest_batch_size,
+    settings.ingest_flush_interval,
+    settings.ingest_max_queue,
+)
@@ -0,0 +1,103 @@
+# *******************************************
+# |docname| - Run literate programming builds
+# *******************************************
+# Grading a literate programming (LP) answer means compiling and running it, which `scheduled_builder.py` does, either in a Celery worker or in a local process pool (see `builder_executor.py`). This module submits these builds and waits for their results without blocking the event loop.
+#
+# To keep one course's students from using every build slot, each worker runs at most ``settings.lp_course_concurrency`` builds per course at a time; other builds from that course wait their turn.
+#
+# If ``settings.lp_build_wait`` is set (it's off by default, since this needs a client which polls for results), a build which takes longer than this many seconds is deferred (see `defer_build`): it continues in the background, while the request returns a build ID. The client then polls the `lp_build endpoint <get_lp_build>`, which returns a 202 until the build's results are available. Deferred results are stored in Redis, so any worker can answer these polls.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import asyncio
+import json
+from typing import Any, Awaitable, Dict, Optional, Set, Tuple
+from uuid import uuid4
+from weakref import WeakValueDictionary
+
+# Third-party imports
+# -------------------
+import aioredis
+
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import settings
+from .builder_executor import get_builder_executor
+from .redis_client import get_redis
+
+
+# Builds
+# ======
+# One semaphore per course, created on first use (inside the running event loop). Each build running or waiting in a course holds a reference to its semaphore; once none do, the semaphore is unused (all its slots are free), so it's dropped rather than kept for every course ever seen.
+_course_semaphores: "WeakValueDictionary[str, asyncio.Semaphore]" = (
+    WeakValueDictionary()
+)
+
+
+def _course_semaphore(course_name: str) -> asyncio.Semaphore:
+    semaphore = _course_semaphores.get(course_name)
+    if semaphore is None:
+        semaphore = _course_semaphores[course_name] = asyncio.Semaphore(
+            settings.lp_course_concurrency
+        )
+    return semaphore
+
+
+# Run a build for ``course_name`` using the configured `builder executor <builder_executor.py>`, passing ``args`` and ``kwargs`` to ``run_builder``. Return (output, correct). Raise ``asyncio.TimeoutError`` if the build doesn't finish in ``settings.lp_build_timeout`` seconds.
+async def run_build(course_name: str, *args: Any, **kwargs: Any) -> Tuple[str, int]:
+    async with _course_semaphore(course_name):
+        return await get_builder_executor().build(*args, **kwargs)
+
+
+# Deferred builds
+# ===============
+# The time, in seconds, to keep the results of a deferred build.
+_RESULT_TTL = 10 * 60
+
+# Keep a reference to each background task, so that it isn't garbage collected before it finishes.
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _key(build_id: str) -> str:
+    return f"lp_build:{build_id}"
+
+
+async def _store(build_id: str, record: Dict[str, Any]) -> None:
+    try:
+        await get_redis().set(_key(build_id), json.dumps(record), ex=_RESULT_TTL)
+    except (aioredis.RedisError, OSError) as e:
+        rslogger.warning(f"Unable to store the results of build {build_id}: {e}")
+
+
+# Finish a build in the background. ``finish`` awaits the build, records its results, then returns the response for the client. Return an ID the client can poll for this response; only ``sid`` may fetch it.
+async def defer_build(sid: str, finish: Awaitable[Dict[str, Any]]) -> str:
+    build_id = uuid4().hex
+    await _store(build_id, dict(sid=sid, pending=True))
+
+    async def run() -> None:
+        try:
+            response = await finish
+        except Exception as e:
+            rslogger.exception(f"Deferred build {build_id} failed.")
+            response = {"errors": [f"Error in build task: {e}"]}
+        await _store(build_id, dict(sid=sid, pending=False, response=response))
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return build_id
+
+
+# Return the record for a deferred build, or None if it's unknown or expired. The record contains ``sid``, ``pending``, and (once the build finishes) ``response``.
+async def fetch_build_result(build_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        data = await get_redis().get(_key(build_id))
+    except (aioredis.RedisError, OSError) as e:
+        rslogger.warning(f"Unable to fetch the results of build {build_id}: {e}")
+        return None
+    return None if data is None else json.loads(data)
@@ -0,0 +1,231 @@
+# *********************************
+# |docname| - Live tallies of polls
+# *********************************
+# During a lecture, every student answering a poll loads its results (see ``getpollresults`` in `../routers/assessment.py`) at about the same time. Computing these results means finding each student's last vote in ``useinfo``, then counting the votes for each option. Instead, this module keeps a tally of each poll in Redis, updated as the `log_book_event endpoint` logs each vote, using two hashes:
+#
+# - ``poll:{course}:{div_id}:votes`` maps each student to their last vote (the ``act`` logged, such as ``2`` or ``2:a comment``). Its field ``""`` marks the tally as loaded.
+# - ``poll:{course}:{div_id}:counts`` maps each option to its number of votes.
+#
+# A Lua script records a vote, moving the student's vote from their previous option to the new one atomically. The tally is built from ``useinfo`` (see ``rebuild_poll_tally``) the first time it's needed, and rebuilt after ``settings.poll_tally_ttl`` seconds, correcting any drift. To recover from a lost or inconsistent tally, call ``rebuild_poll_tally``.
+#
+# Votes arrive while a tally is being built; a vote whose row is written after the build reads ``useinfo`` would otherwise be missed. Therefore, a vote is always stored in the votes hash, even if the tally isn't loaded (only the counts wait for the tally to load), and a build merges the votes it reads into the hash, keeping any vote already there, since a vote is stored only after its row is written. The build then recounts the votes. Only one process builds a tally at a time (see ``redis_lock`` in `redis_client.py`); others read the database meanwhile.
+#
+# If ``settings.poll_push_interval`` is set, then after a vote the updated results are published to the chat websockets (see `../routers/discuss.py`) as a broadcast message of type ``poll_results`` for the poll's course, so that open pages can update without polling. A short-lived Redis key limits this to one message per poll every ``settings.poll_push_interval`` seconds across all workers; the message sent at the end of this interval includes every vote received during it. The message's ``detail`` holds the results, in the form ``getpollresults`` returns (without the student's own vote). The pages served by this server don't yet handle this message, so the push is off by default.
+#
+# This is used only when ``settings.redis_cache`` is true; otherwise, or if Redis is unavailable, the results come from the database as before, and nothing is pushed.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import asyncio
+import json
+import time
+from typing import Dict, Optional, Set, Tuple
+
+# Third-party imports
+# -------------------
+import aioredis
+
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import settings
+from ..crud import fetch_last_poll_response, fetch_poll_summary, fetch_poll_votes
+from .redis_client import get_redis, redis_lock
+
+# The field which marks a tally as loaded.
+_LOADED = ""
+
+# Record a vote, and count it if the tally is loaded; return 1 if it was counted. KEYS are the votes and counts hashes; ARGV are the student, their vote, and the tally's TTL. The option voted for is the part of the vote before any ``:``.
+_RECORD_VOTE = """
+local old = redis.call("hget", KEYS[1], ARGV[1])
+redis.call("hset", KEYS[1], ARGV[1], ARGV[2])
+if redis.call("hexists", KEYS[1], "") == 0 then
+    -- Keep the vote for the build to merge, but don't keep it forever.
+    if redis.call("ttl", KEYS[1]) < 0 then
+        redis.call("expire", KEYS[1], ARGV[3])
+    end
+    return 0
+end
+if old then
+    redis.call("hincrby", KEYS[2], string.match(old, "^[^:]*"), -1)
+end
+redis.call("hincrby", KEYS[2], string.match(ARGV[2], "^[^:]*"), 1)
+return 1
+"""
+
+# Merge votes read from the database into the votes hash, keeping the votes already there, then mark the tally as loaded and recount it. KEYS are the votes and counts hashes; ARGV are the tally's TTL, then pairs of student and vote. Return the counts, in the form ``hgetall`` returns.
+_MERGE_VOTES = """
+for i = 2, #ARGV, 2 do
+    redis.call("hsetnx", KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call("hset", KEYS[1], "", 1)
+redis.call("del", KEYS[2])
+local votes = redis.call("hgetall", KEYS[1])
+for i = 1, #votes, 2 do
+    if votes[i] ~= "" then
+        redis.call("hincrby", KEYS[2], string.match(votes[i + 1], "^[^:]*"), 1)
+    end
+end
+redis.call("expire", KEYS[1], ARGV[1])
+redis.call("expire", KEYS[2], ARGV[1])
+return redis.call("hgetall", KEYS[2])
+"""
+
+# Keep a reference to each pending push, so that it isn't garbage collected before it runs.
+_push_tasks: Set[asyncio.Task] = set()
+
+
+def _keys(course_name: str, div_id: str) -> Tuple[str, str]:
+    prefix = f"poll:{course_name}:{div_id}"
+    return f"{prefix}:votes", f"{prefix}:counts"
+
+
+# Return the option of a vote, such as 2 for ``2:a comment``.
+def _option(act: str) -> int:
+    return int(act.split(":")[0])
+
+
+# Tallies
+# =======
+# Record the vote ``act`` by ``sid`` in the poll ``div_id``, then schedule a push of the updated results.
+async def record_vote(course_name: str, div_id: str, sid: str, act: str) -> None:
+    if not settings.redis_cache:
+        return
+    votes_key, counts_key = _keys(course_name, div_id)
+    try:
+        if await get_redis().eval(
+            _RECORD_VOTE, 2, votes_key, counts_key, sid, act, settings.poll_tally_ttl
+        ):
+            await _schedule_push(course_name, div_id)
+    except (aioredis.RedisError, OSError) as e:
+        # The tally is now incomplete; drop it so it will be rebuilt.
+        rslogger.warning(f"Unable to record a poll vote in Redis: {e}")
+        await _discard(votes_key, counts_key)
+
+
+# Return a dict of {option: number of votes} for the poll ``div_id``, counting each student's last vote.
+async def fetch_poll_counts(course_name: str, div_id: str) -> Dict[int, int]:
+    if settings.redis_cache:
+        try:
+            redis_counts = await _fetch_counts(course_name, div_id, True)
+            if redis_counts is not None:
+                return redis_counts
+        except (aioredis.RedisError, OSError) as e:
+            rslogger.warning(f"Unable to read a poll tally from Redis: {e}")
+    counts: Dict[int, int] = {}
+    for act, count in await fetch_poll_summary(div_id, course_name):
+        option = _option(act)
+        counts[option] = counts.get(option, 0) + count
+    return counts
+
+
+# Return the last vote by ``sid`` in the poll ``div_id``, or None if the student hasn't voted.
+async def fetch_poll_vote(course_name: str, div_id: str, sid: str) -> Optional[str]:
+    if settings.redis_cache:
+        votes_key, _ = _keys(course_name, div_id)
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                loaded, vote = (
+                    await pipe.hexists(votes_key, _LOADED)
+                    .hget(votes_key, sid)
+                    .execute()
+                )
+            if loaded:
+                return vote.decode() if vote is not None else None
+        except (aioredis.RedisError, OSError) as e:
+            rslogger.warning(f"Unable to read a poll vote from Redis: {e}")
+    return await fetch_last_poll_response(sid, course_name, div_id)
+
+
+# Read the counts from Redis. If the tally isn't loaded, rebuild it if ``load`` is true, or return an empty dict otherwise. Return None if another process is rebuilding the tally.
+async def _fetch_counts(
+    course_name: str, div_id: str, load: bool
+) -> Optional[Dict[int, int]]:
+    votes_key, counts_key = _keys(course_name, div_id)
+    async with get_redis().pipeline(transaction=True) as pipe:
+        loaded, counts = (
+            await pipe.hexists(votes_key, _LOADED).hgetall(counts_key).execute()
+        )
+    if loaded:
+        return _parse_counts(counts)
+    if not load:
+        return {}
+    async with redis_lock(f"{votes_key}:rebuild") as token:
+        return None if token is None else await rebuild_poll_tally(course_name, div_id)
+
+
+def _parse_counts(counts: Dict[bytes, bytes]) -> Dict[int, int]:
+    return {int(option): int(count) for option, count in counts.items()}
+
+
+# Rebuild the tally of the poll ``div_id`` from ``useinfo``, merging it with the votes recorded in Redis, then recounting it. Return its counts, as ``fetch_poll_counts`` does.
+async def rebuild_poll_tally(course_name: str, div_id: str) -> Dict[int, int]:
+    votes = await fetch_poll_votes(div_id, course_name)
+    votes_key, counts_key = _keys(course_name, div_id)
+    counts = await get_redis().eval(
+        _MERGE_VOTES,
+        2,
+        votes_key,
+        counts_key,
+        settings.poll_tally_ttl,
+        *[value for vote in votes for value in vote],
+    )
+    return _parse_counts(dict(zip(counts[::2], counts[1::2])))
+
+
+async def _discard(*keys: str) -> None:
+    try:
+        await get_redis().delete(*keys)
+    except (aioredis.RedisError, OSError):
+        pass
+
+
+# Results
+# =======
+# Return the results of a poll, given its counts, in the form ``getpollresults`` returns (without the student's own vote).
+def poll_results(div_id: str, opt_counts: Dict[int, int]) -> Dict[str, object]:
+    opt_counts = dict(opt_counts)
+    opt_num = max(opt_counts.keys()) if opt_counts else 0
+    for i in range(opt_num):
+        if i not in opt_counts:
+            opt_counts[i] = 0
+    return dict(total=sum(opt_counts.values()), opt_counts=opt_counts, div_id=div_id)
+
+
+# Push
+# ====
+# Schedule a push of the results of the poll ``div_id``, if pushes are enabled and one isn't already scheduled by any worker.
+async def _schedule_push(course_name: str, div_id: str) -> None:
+    interval = settings.poll_push_interval
+    if interval is None or not await get_redis().set(
+        f"poll:{course_name}:{div_id}:push", 1, nx=True, px=max(int(interval * 1000), 1)
+    ):
+        return
+    task = asyncio.create_task(_push_later(course_name, div_id, interval))
+    _push_tasks.add(task)
+    task.add_done_callback(_push_tasks.discard)
+
+
+async def _push_later(course_name: str, div_id: str, delay: float) -> None:
+    await asyncio.sleep(delay)
+    try:
+        counts = await _fetch_counts(course_name, div_id, False)
+        if not counts:
+            return
+        message = dict(
+            type="poll_results",
+            sender="server",
+            message="poll_results",
+            broadcast=True,
+            course_name=course_name,
+            div_id=div_id,
+            time=time.time(),
+            detail=poll_results(div_id, counts),
+        )
+        await get_redis().publish("peermessages", json.dumps(message))
+    except (aioredis.RedisError, OSError) as e:
+        rslogger.warning(f"Unable to push the results of poll {div_id}: {e}")
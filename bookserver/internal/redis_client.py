@@ -0,0 +1,85 @@
+# *********************************************
+# |docname| - A shared Redis client per process
+# *********************************************
+# Creating a Redis client opens a new connection pool. To avoid doing this per request, code in the server should use the client returned by ``get_redis``, which is created on first use and closed by `../main.py` on shutdown. This module also provides ``redis_lock``, which the caches built on Redis use so that only one process at a time loads an entry from the database.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from uuid import uuid4
+
+# Third-party imports
+# -------------------
+import aioredis
+
+# Local application imports
+# -------------------------
+from ..config import settings
+
+
+# Client
+# ======
+_redis: Optional[aioredis.Redis] = None
+
+
+# Return this process's Redis client, connected to ``settings.redis_uri``.
+def get_redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(settings.redis_uri)
+    return _redis
+
+
+# Close the client, if one was created.
+async def close_redis() -> None:
+    global _redis
+    if _redis is not None:
+        await _redis.close()
+        await _redis.connection_pool.disconnect()
+        _redis = None
+
+
+# Locks
+# =====
+# Take the lock and delete the keys to reset. KEYS are the lock then the keys to reset; ARGV are the lock's token and its timeout, in ms.
+_ACQUIRE = """
+if redis.call("set", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    for i = 2, #KEYS do
+        redis.call("del", KEYS[i])
+    end
+    return 1
+end
+return 0
+"""
+
+# Release the lock, unless it expired and another caller took it since.
+_RELEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+# Try to take the lock ``name``, which expires after ``settings.redis_load_timeout`` seconds. If the lock is taken, also delete the keys in ``reset``, atomically, then provide the lock's token, which a Lua script may compare with the value of ``name`` to check that the lock is still held; otherwise, provide None. The lock is released when the block exits. Redis errors propagate.
+@asynccontextmanager
+async def redis_lock(name: str, *reset: str) -> AsyncIterator[Optional[str]]:
+    r = get_redis()
+    token = uuid4().hex
+    timeout_ms = max(int(settings.redis_load_timeout * 1000), 1)
+    if not await r.eval(_ACQUIRE, 1 + len(reset), name, *reset, token, timeout_ms):
+        yield None
+        return
+    try:
+        yield token
+    finally:
+        try:
+            await r.eval(_RELEASE, 1, name, token)
+        except (aioredis.RedisError, OSError):
+            # The lock expires on its own.
+            pass
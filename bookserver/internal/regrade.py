@@ -0,0 +1,312 @@
+# ******************************************
+# |docname| - Regrade stored answers in bulk
+# ******************************************
+# When the feedback for a server-graded question changes (for example, after an instructor fixes a fill-in-the-blank answer key or a literate programming test), the grades already stored for that question are stale. This module regrades the stored answers in one answer table (see `register_answer_table <register_answer_table>`), either for one question or for every question, in one course or in every course using a base course.
+#
+# A regrade job reads answers in chunks, in order of ID, and grades each chunk:
+#
+# - If the table's ``RunestoneComponentDict`` provides a ``batch_grader``, the answers to each question in the chunk are graded by this function in a process pool, since grading is CPU-bound.
+# - Otherwise, each answer is graded by the table's ``grader``, a few at a time.
+#
+# Only the grades which changed are written back, using a single bulk ``UPDATE`` per chunk. An answer whose grader fails keeps its stored grade and is counted in ``errors``; a literate programming build which is deferred (see ``settings.lp_build_wait``) stores its grade when it finishes, and is counted in ``pending``.
+#
+# After each chunk, the job saves its progress to a small JSON file in ``settings.regrade_state_path``. This reports progress (see `regrade_status`) to any worker process, and allows a job which was interrupted (by a restart of the server, for example) to resume from the last chunk written instead of starting over. Since a regrade is idempotent, regrading a chunk twice is harmless.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Third-party imports
+# -------------------
+from starlette.concurrency import run_in_threadpool
+
+# Local application imports
+# -------------------------
+from ..applogger import rslogger
+from ..config import settings
+from ..crud import (
+    EVENT2TABLE,
+    count_answers,
+    fetch_answer_chunk,
+    fetch_course,
+    fetch_courses_for_base_course,
+    invalidate_server_feedback,
+    is_server_feedback,
+    update_answer_grades,
+)
+from ..models import RunestoneComponentDict, runestone_component_dict
+
+
+# Constants
+# =========
+# Map an answer table's name to the event which stores answers in it.
+_TABLE2EVENT = {table: event for event, table in EVENT2TABLE.items()}
+
+# The columns a ``grader`` may change when regrading an answer. Some graders (such as the literate programming grader) also store their results in the ``answer`` column.
+_GRADE_COLUMNS = ("answer", "correct", "percent")
+
+# Graders without a ``batch_grader`` (such as the literate programming grader) may take seconds per answer. Read fewer of these answers at a time, so that progress is saved regularly, and grade a few at once.
+_GRADER_CHUNK_SIZE = 50
+_GRADER_CONCURRENCY = 4
+
+# A job whose state hasn't been saved for this many seconds is assumed to have died, and may be resumed by another process.
+_STALE_SECONDS = 10 * 60
+
+
+# Errors
+# ======
+class RegradeError(Exception):
+    pass
+
+
+# Job state
+# =========
+# Return an ID for a regrade job. Requesting the same regrade again produces the same ID, so that an unfinished job is resumed instead of duplicated.
+def regrade_job_id(
+    table: str, course_name: str, div_id: Optional[str], whole_base_course: bool
+) -> str:
+    key = json.dumps([table, course_name, div_id, whole_base_course])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def _state_path(job_id: str) -> str:
+    return os.path.join(settings.regrade_state_path, f"{job_id}.json")
+
+
+# Return the saved state of a regrade job, or None if there is no such job.
+def regrade_status(job_id: str) -> Optional[Dict[str, Any]]:
+    # Job IDs are hex digests; refuse anything else, since this becomes part of a path.
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(_state_path(job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Save ``state``, replacing the file atomically so that a reader never sees a partial file.
+def _save_state(state: Dict[str, Any]) -> None:
+    state["updated"] = time.time()
+    os.makedirs(settings.regrade_state_path, exist_ok=True)
+    path = _state_path(state["job_id"])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+# Jobs
+# ====
+# The jobs running in this process, keyed by job ID.
+_tasks: Dict[str, asyncio.Task] = {}
+
+# A process pool for ``batch_grader`` functions, created when first needed.
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+# Start regrading the answers in ``table`` for ``course_name`` (or every course using its base course, if ``whole_base_course``), limited to the question ``div_id`` if it's given. Grading uses the feedback now in the database. An unfinished job for the same regrade is resumed, unless ``restart`` is true. Return the job's state; the job runs in the background.
+async def start_regrade(
+    table: str,
+    course_name: str,
+    div_id: Optional[str] = None,
+    whole_base_course: bool = False,
+    restart: bool = False,
+) -> Dict[str, Any]:
+    rcd = runestone_component_dict.get(table)
+    if not rcd or not rcd.grader or table not in _TABLE2EVENT:
+        raise RegradeError(f"Answers in {table} aren't graded by the server.")
+    course = await fetch_course(course_name)
+    if not course:
+        raise RegradeError(f"Unknown course {course_name}.")
+
+    job_id = regrade_job_id(table, course_name, div_id, whole_base_course)
+    task = _tasks.get(job_id)
+    if task and not task.done():
+        return regrade_status(job_id) or {}
+    state = regrade_status(job_id)
+    if state and state["status"] == "running":
+        if time.time() - state["updated"] < _STALE_SECONDS:
+            # Another process is running this job.
+            return state
+    if restart or not state or state["status"] == "done":
+        state = dict(
+            job_id=job_id,
+            table=table,
+            course_name=course_name,
+            base_course=course.base_course,
+            div_id=div_id,
+            whole_base_course=whole_base_course,
+            # The ID of the last answer regraded and written.
+            last_id=0,
+            total=None,
+            graded=0,
+            changed=0,
+            skipped=0,
+            errors=0,
+            pending=0,
+            started=time.time(),
+            error=None,
+        )
+    # A job saved before ``pending`` was counted lacks it.
+    state.setdefault("pending", 0)
+    state["status"] = "running"
+    _save_state(state)
+    _tasks[job_id] = asyncio.create_task(_run(rcd, state))
+    return state
+
+
+# Run a regrade job to completion, saving its state as it goes.
+async def _run(rcd: RunestoneComponentDict, state: Dict[str, Any]) -> None:
+    job_id = state["job_id"]
+    try:
+        if state["whole_base_course"]:
+            course_names = await fetch_courses_for_base_course(state["base_course"])
+        else:
+            course_names = [state["course_name"]]
+        if state["total"] is None:
+            state["total"] = await count_answers(
+                rcd.model, course_names, state["div_id"]
+            )
+        # Grade using the feedback now in the database, not a cached copy.
+        invalidate_server_feedback(state["base_course"])
+        event = _TABLE2EVENT[state["table"]]
+        chunk_size = (
+            settings.regrade_chunk_size if rcd.batch_grader else _GRADER_CHUNK_SIZE
+        )
+        # Cache the feedback for each (div_id, course_name) for the life of the job.
+        feedback: Dict[Tuple[str, str], Any] = {}
+        while True:
+            rows = await fetch_answer_chunk(
+                rcd, course_names, state["div_id"], state["last_id"], chunk_size
+            )
+            if not rows:
+                break
+            for key in {(row.div_id, row.course_name) for row in rows} - set(feedback):
+                feedback[key] = await is_server_feedback(*key, event)
+            if rcd.batch_grader:
+                grades = await _grade_batches(rcd, rows, feedback, state)
+            else:
+                grades = await _grade_each(rcd, rows, feedback, state)
+            await update_answer_grades(rcd.model, grades)
+            state["last_id"] = rows[-1].id
+            state["graded"] += len(rows)
+            state["changed"] += len(grades)
+            _save_state(state)
+        state["status"] = "done"
+        rslogger.info(
+            f"Regrade {job_id} of {state['table']} finished: {state['graded']} answers graded, {state['changed']} changed, {state['errors']} errors, {state['pending']} pending."
+        )
+    except asyncio.CancelledError:
+        # The server is shutting down; the job can be resumed from its last chunk.
+        state["status"] = "interrupted"
+        raise
+    except Exception as e:
+        rslogger.exception(f"Regrade {job_id} failed.")
+        state["status"] = "failed"
+        state["error"] = str(e)
+    finally:
+        _save_state(state)
+        _tasks.pop(job_id, None)
+
+
+# Grade ``rows`` using ``rcd.batch_grader``, one batch per question. Return the grades which changed, in the form ``update_answer_grades`` requires.
+async def _grade_batches(
+    rcd: RunestoneComponentDict,
+    rows: List[Any],
+    feedback: Dict[Tuple[str, str], Any],
+    state: Dict[str, Any],
+) -> List[Dict[str, Any]]:
+    batches: Dict[Tuple[str, str], List[Any]] = {}
+    for row in rows:
+        batches.setdefault((row.div_id, row.course_name), []).append(row)
+    grades = []
+    for key, batch in batches.items():
+        if not feedback[key]:
+            state["skipped"] += len(batch)
+            continue
+        answers = [row.answer for row in batch]
+        if settings.regrade_processes > 0:
+            new_grades = await asyncio.get_running_loop().run_in_executor(
+                _get_process_pool(), rcd.batch_grader, feedback[key], answers
+            )
+        else:
+            new_grades = await run_in_threadpool(
+                rcd.batch_grader, feedback[key], answers
+            )
+        for row, new_grade in zip(batch, new_grades):
+            if any(getattr(row, k) != v for k, v in new_grade.items()):
+                grades.append(dict(_id=row.id, **new_grade))
+    return grades
+
+
+# Grade ``rows`` by calling ``rcd.grader`` for each answer. Return the grades which changed, in the form ``update_answer_grades`` requires.
+async def _grade_each(
+    rcd: RunestoneComponentDict,
+    rows: List[Any],
+    feedback: Dict[Tuple[str, str], Any],
+    state: Dict[str, Any],
+) -> List[Dict[str, Any]]:
+    columns = [c for c in _GRADE_COLUMNS if c in rcd.model.__table__.c]
+    semaphore = asyncio.Semaphore(_GRADER_CONCURRENCY)
+
+    async def grade(row: Any) -> Optional[Dict[str, Any]]:
+        fb = feedback[(row.div_id, row.course_name)]
+        if not fb:
+            state["skipped"] += 1
+            return None
+        # The grader updates the validator it's given; keep ``row`` to compare with.
+        validator = row.copy()
+        async with semaphore:
+            try:
+                result = await rcd.grader(validator, fb)
+            except Exception as e:
+                rslogger.warning(f"Unable to regrade answer {row.id}: {e}")
+                result = dict(errors=[str(e)])
+        if result.get("errors"):
+            # Keep the stored grade.
+            state["errors"] += 1
+            return None
+        if result.get("build_id"):
+            # A deferred `literate programming build <lp_builds.py>` stores its grade when it finishes, after this job has moved on; report it as pending rather than graded.
+            state["pending"] += 1
+            return None
+        new_grade = {c: getattr(validator, c) for c in columns}
+        if all(getattr(row, c) == v for c, v in new_grade.items()):
+            return None
+        return dict(_id=row.id, **new_grade)
+
+    return [g for g in await asyncio.gather(*[grade(row) for row in rows]) if g]
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # Forking a process running an event loop and database connections isn't safe; start fresh processes instead.
+        _process_pool = ProcessPoolExecutor(
+            settings.regrade_processes, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+# Stop all jobs in this process (saving their progress so they can be resumed) and the process pool. `../main.py` calls this on shutdown.
+async def stop_regrades() -> None:
+    global _process_pool
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
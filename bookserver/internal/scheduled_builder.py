@@ -10,22 +10,30 @@
 # Standard library
 # ----------------
 from io import open
+import json
 import os
+import selectors
 import shutil
+import socket
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 
 # Third-party imports
 # -------------------
 from celery import Celery
-from celery.utils.log import current_process_index
+from celery.signals import worker_process_init
+from celery.utils.log import current_process_index, get_task_logger
 from runestone.lp.lp_common_lib import BUILD_SYSTEM_PATH
 
 # Local imports
 # -------------
+from . import build_cache, harness_store
 from .common_builder import (
     get_sim_str_sim30,
+    mdb_pool,
     sim_run_mdb,
     get_verification_code,
     check_sim_out,
@@ -54,18 +62,55 @@ celery_config = dict(
 # Create and configure the Celery app.
 app = Celery("scheduled_builder")
 app.conf.update(celery_config)
+logger = get_task_logger(__name__)
 
 
 # Provide a Celery task to run mdb. This is used when externally compiling code in a book; it's not used by the webserver.
 @app.task
 def celery_sim_run_mdb(*args, **kwargs):
-    return sim_run_mdb(*args, **kwargs)
+    out = sim_run_mdb(*args, **kwargs)
+    publish_mdb_pool_stats()
+    return out
 
 
-# This function should run the provided code and report the results. It will
-# vary for a given compiler and language.
+# MDB simulator pool
+# ------------------
+# The xc16 builder simulates code using MDB; see ``mdb_pool`` in `common_builder.py`. Start this process's simulators as soon as the worker process starts, instead of making the first students wait for them. Starting MDB takes several seconds, so do this in a thread rather than delaying the worker's startup.
+@worker_process_init.connect
+def _prewarm_mdb_pool(**kwargs):
+    if shutil.which("mdb"):
+        threading.Thread(target=_prewarm_mdb, daemon=True).start()
+
+
+def _prewarm_mdb():
+    try:
+        mdb_pool.prewarm("mdb", "dspic33EP128GP502")
+    except Exception:
+        logger.exception("Unable to start the MDB simulator.")
+    publish_mdb_pool_stats()
+
+
+# Store the utilization and latency of this process's MDB pool in Redis, under ``mdb_pool_stats:<host>:<pid>``, so that monitoring can collect the stats of every worker process. Entries expire if the process stops updating them.
+def publish_mdb_pool_stats():
+    try:
+        app.backend.client.set(
+            f"mdb_pool_stats:{socket.gethostname()}:{os.getpid()}",
+            json.dumps(mdb_pool.stats()),
+            ex=600,
+        )
+    except Exception as e:
+        logger.warning(f"Unable to publish MDB pool stats: {e}")
+
+
+# Provide a Celery task to run a build; see `run_builder`.
 @app.task(name="scheduled_builder._scheduled_builder")
-def _scheduled_builder(
+def _scheduled_builder(*args, **kwargs):
+    return run_builder(*args, **kwargs)
+
+
+# This function should run the provided code and report the results. It will
+# vary for a given compiler and language. Besides the Celery task above, the `local builder executor <builder_executor.py>` calls this directly.
+def run_builder(
     # The name of the builder to use.
     builder,
     # An absolute path to the file which contains code to test. The file resides in a temporary directory, which should be used to hold any additional files produced by the test.
@@ -78,7 +123,22 @@ def _scheduled_builder(
     sphinx_out_path,
     # A relative path to the source file from the ``sphinx_source_path``, based on the submitting web page.
     source_path,
+    # If provided, the code to test. This task writes it to this worker's `sandbox <SandboxSession>` directory, using the name of ``file_path``, instead of reading ``file_path``. This lets the webserver submit a build without waiting for it to finish, and without sharing a filesystem with this worker.
+    source_str=None,
 ):
+    if source_str is not None:
+        with SandboxSession() as sandbox:
+            temp_source_path = os.path.join(sandbox.path, os.path.basename(file_path))
+            with open(temp_source_path, "w", encoding="utf-8") as f:
+                f.write(source_str)
+            return run_builder(
+                builder,
+                temp_source_path,
+                sphinx_base_path,
+                sphinx_source_path,
+                sphinx_out_path,
+                source_path,
+            )
 
     # Translate the provided builder into a Python function.
     builder_func = {
@@ -91,7 +151,21 @@ def _scheduled_builder(
     if builder_func is None:
         raise RuntimeError(f"Unknown builder {builder}")
 
-    # Run the builder then return the results.
+    # Return the results of an identical build, if there was one.
+    with open(file_path, encoding="utf-8") as f:
+        source_str = f.read()
+    key = build_cache.build_key(
+        builder,
+        source_str,
+        _build_content_paths(sphinx_base_path, sphinx_source_path, source_path),
+        _build_mtime_paths(sphinx_base_path, sphinx_source_path, sphinx_out_path),
+    )
+    result = build_cache.get(key)
+    if result:
+        return result
+
+    # Run the builder then return the results. A builder which returns reached its final (run or simulation) step.
+    verdict = True
     try:
         out_list, correct = builder_func(
             file_path,
@@ -104,16 +178,51 @@ def _scheduled_builder(
     except BuildFailed as e:
         out_list = e.out_list
         correct = e.correct
-    return "".join(out_list), correct
+        verdict = e.verdict
+    output = "".join(out_list)
+    # Cache only verdicts on the student's code. A build which failed before its final step may have failed because of this machine (a missing tool, library, or test file, for example) instead of the code; likewise, a timeout may be caused by load on this machine.
+    if verdict and "Timeout." not in output:
+        build_cache.put(key, output, correct)
+    return output, correct
 
 
 # Utilities
 # =========
-# Raise this exception if the build fails.
+# Raise this exception if the build fails. ``verdict`` is True if the build failed in its final (run or simulation) step, so that the failure is a verdict on the student's code.
 class BuildFailed(Exception):
-    def __init__(self, out_list, correct=0):
+    def __init__(self, out_list, correct=0, verdict=False):
         self.out_list = out_list
         self.correct = correct
+        self.verdict = verdict
+
+
+# Return the paths to the files whose contents, along with the student's code, determine the result of a build: the instructor's tests for ``source_path``. Builders use the test file with the same extension as the source, a C or Verilog test file, and a file of test vectors.
+def _build_content_paths(sphinx_base_path, sphinx_source_path, source_path):
+    base, ext = os.path.splitext(
+        os.path.join(sphinx_base_path, sphinx_source_path, source_path)
+    )
+    return [f"{base}-test{e}" for e in dict.fromkeys([ext, ".c", ".v", ".txt"])]
+
+
+# Return the paths to the book's support files whose modification times determine the result of a build. These are rebuilt (or replaced) when the book is rebuilt.
+def _build_mtime_paths(sphinx_base_path, sphinx_source_path, sphinx_out_path):
+    lib_path = os.path.normpath(
+        os.path.join(
+            sphinx_base_path,
+            sphinx_out_path,
+            BUILD_SYSTEM_PATH,
+            sphinx_source_path,
+            "..",
+        )
+    )
+    source_root = os.path.join(sphinx_base_path, sphinx_source_path)
+    return [
+        os.path.join(lib_path, "libpic24_stdlib.a"),
+        os.path.join(lib_path, "libarmv7_stdlib.a"),
+        os.path.join(source_root, "lib/lkr/p33EP128GP502_bootldr.gld"),
+        os.path.join(source_root, "tests/platform/ARMv7-A_ARMv7-R/interrupts.S"),
+        os.path.join(source_root, "tests/platform/ARMv7-A_ARMv7-R/redboot.ld"),
+    ]
 
 
 # Transform the arguments to ``subprocess.run`` into a string showing what
@@ -134,6 +243,8 @@ def report_subprocess(
     out_list,
     # True if stderr should be included in the results.
     include_stderr=True,
+    # True if this is the build's final (run or simulation) step, whose failure is a verdict on the student's code; see ``BuildFailed``.
+    verdict=False,
     # Additional kwargs for the subprocess call.
     **kwargs,
 ):
@@ -148,30 +259,73 @@ def report_subprocess(
         ]
     )
 
-    try:
-        cp = subprocess.run(
-            args, capture_output=True, text=True, cwd=cwd, timeout=15, *kwargs
-        )
-    except subprocess.TimeoutExpired as e:
-        cp = e
-        # Create a failing return code for the logic below.
-        cp.returncode = True
+    returncode, stdout, stderr = _run_capped(args, cwd, 15, **kwargs)
 
     # Record output if available.
-    if cp.stdout:
-        out_list.append(cp.stdout)
-    if include_stderr and cp.stderr:
-        out_list.append(cp.stderr)
+    if stdout:
+        out_list.append(stdout)
+    if include_stderr and stderr:
+        out_list.append(stderr)
     # Put the timeout message last.
-    if cp.returncode is True:
+    if returncode is None:
         out_list.append("Timeout.\n\n")
 
-    # A returncode of 0 indicates success; anything else is an error.
-    if cp.returncode:
-        raise BuildFailed(out_list, 0)
+    # A returncode of 0 indicates success; anything else (including a timeout) is an error.
+    if returncode != 0:
+        raise BuildFailed(out_list, 0, verdict)
     return out_list, 100
 
 
+# The maximum output kept from each stream of a subprocess, in bytes. Only the end of the output is kept: that's where a test reports its results, and the webserver only stores the last 4K of output.
+_OUTPUT_CAP = 64 * 1024
+
+
+# Run a subprocess, reading its output as it's produced and keeping only the last ``_OUTPUT_CAP`` bytes of each stream, so that a program which floods its output can't exhaust this worker's memory. Return (returncode, stdout, stderr); the returncode is None if the subprocess timed out.
+def _run_capped(args, cwd, timeout, **kwargs):
+    po = subprocess.Popen(
+        args,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs,
+    )
+    # For each stream, the output kept and the number of bytes discarded.
+    kept = {po.stdout: [bytearray(), 0], po.stderr: [bytearray(), 0]}
+    deadline = time.monotonic() + timeout
+    returncode = None
+    with selectors.DefaultSelector() as sel:
+        for f in kept:
+            sel.register(f, selectors.EVENT_READ)
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, _ in sel.select(remaining):
+                data = os.read(key.fileobj.fileno(), 65536)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                buf = kept[key.fileobj]
+                buf[0] += data
+                if len(buf[0]) > _OUTPUT_CAP:
+                    buf[1] += len(buf[0]) - _OUTPUT_CAP
+                    del buf[0][:-_OUTPUT_CAP]
+    try:
+        returncode = po.wait(max(deadline - time.monotonic(), 0))
+    except subprocess.TimeoutExpired:
+        po.kill()
+        po.wait()
+    for f in kept:
+        f.close()
+
+    def decode(buf, discarded):
+        text = buf.decode("utf-8", errors="backslashreplace")
+        return f"[{discarded} bytes of output omitted]\n{text}" if discarded else text
+
+    return returncode, decode(*kept[po.stdout]), decode(*kept[po.stderr])
+
+
 # Copy the test file from its Sphinx location to the temporary directory where the student source code is. Return the name of the test file; if the copy failed, assume there's no test file; instead, return the file name of the student source code.
 def copy_test_file_to_tmp(
     file_path, cwd, sphinx_base_path, sphinx_source_path, source_path, ext=None
@@ -198,6 +352,71 @@ def copy_test_file_to_tmp(
     return test_file_name
 
 
+# The index (starting from 1) of this process in a `local builder pool <builder_executor.py>`, set by ``set_process_index`` when the process starts.
+_process_index = None
+
+
+def set_process_index(index):
+    global _process_index
+    _process_index = index
+
+
+# Select a jobe userid that's not in use by another build: use this process's index in a local builder pool or (hopefully) the `prefork pool process index <https://docs.celeryproject.org/en/stable/userguide/workers.html#prefork-pool-process-index>`_. Thread IDs aren't unique across processes, so they're used only as a backup outside these pools (for example, in a Celery thread pool).
+def _jobe_user():
+    index = _process_index if _process_index is not None else current_process_index()
+    return f"jobe{index or (threading.get_ident() % 10):02d}"
+
+
+# Sandbox sessions
+# ----------------
+# The root of the working directories used by `SandboxSession`.
+_sandbox_root = os.path.abspath(
+    os.environ.get(
+        "LP_SANDBOX_PATH", os.path.join(tempfile.gettempdir(), "runestone_lp")
+    )
+)
+# The working directories whose access for the Jobe user has been set up.
+_sandbox_paths = set()
+
+
+# A working directory for one build. Each thread of a worker process reuses its own directory, emptied before and after each build, instead of creating a new temporary directory per build. Access for the thread's Jobe user is granted once, when the directory is created, using a default ACL which files created in the directory inherit; therefore, `runguard` doesn't need to run ``setfacl`` for each step of a build.
+class SandboxSession:
+    def __init__(self):
+        self.user = _jobe_user()
+        self.path = os.path.join(
+            _sandbox_root, f"{os.getpid()}-{threading.get_ident()}"
+        )
+
+    def __enter__(self):
+        if self.path in _sandbox_paths:
+            self._empty()
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, mode=0o700)
+            # Give the Jobe user access to the directory and (through the default ACL) everything created in it. Keep access for this worker's user, too, so it can remove what the Jobe user creates.
+            acl = f"u:{self.user}:rwX,u:{os.getuid()}:rwX"
+            subprocess.run(
+                ["setfacl", "-m", acl, "-d", "-m", acl, self.path], check=True
+            )
+            _sandbox_paths.add(self.path)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._empty()
+        except OSError:
+            # Start over with a new directory next time.
+            _sandbox_paths.discard(self.path)
+        return False
+
+    def _empty(self):
+        for entry in os.scandir(self.path):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+
 # Given an list of arguments to pass as the first parameter of ``subprocess.run``, wrap this in runguard. Return an updated list of parameters for ``subprocess.run``.
 def runguard(
     # A list of arguments comprising the first parameter of ``subprocess.run``.
@@ -217,10 +436,10 @@ def runguard(
     # Disable core dumps when True
     no_core_dumps=True,
 ):
-    # Get (hopefully) the `prefork pool process index <https://docs.celeryproject.org/en/stable/userguide/workers.html#prefork-pool-process-index>`_. Use this to select a jobe userid that's not in use. Since it only applies to prefork pools, use a thread ID as backup.
-    user = f"jobe{current_process_index() or (threading.get_ident() % 10):02d}"
-    # Give the selected Jobe user access. Inspired by `jobe source <https://github.com/trampgeek/jobe/blob/master/application/libraries/LanguageTask.php>`_.
-    subprocess.run(["setfacl", "-m", f"u:{user}:rwX", cwd], check=True)
+    user = _jobe_user()
+    # Give the selected Jobe user access, unless a `sandbox session <SandboxSession>` already did. Inspired by `jobe source <https://github.com/trampgeek/jobe/blob/master/application/libraries/LanguageTask.php>`_.
+    if os.path.abspath(cwd) not in _sandbox_paths:
+        subprocess.run(["setfacl", "-m", f"u:{user}:rwX", cwd], check=True)
     return (
         [
             "sudo",
@@ -249,7 +468,11 @@ def python_builder(
     )
 
     return report_subprocess(
-        runguard([sys.executable, run_file_name], cwd, memsize_kb=20000), "Run", cwd, []
+        runguard([sys.executable, run_file_name], cwd, memsize_kb=20000),
+        "Run",
+        cwd,
+        [],
+        verdict=True,
     )
 
 
@@ -271,6 +494,7 @@ def rust_builder(
         "Run",
         cwd,
         out_list,
+        verdict=True,
     )
 
 
@@ -334,34 +558,63 @@ def xc16_builder(
         sphinx_source_path,
         os.path.splitext(source_path)[0] + "-test.c",
     )
-    test_object_path = file_path + ".test.o"
-    args = [
-        "xc16-gcc",
-        "-mcpu=33EP128GP502",
-        "-omf=elf",
-        "-g",
-        "-O0",
-        "-msmart-io=1",
-        "-Wall",
-        "-Wextra",
-        "-Wdeclaration-after-statement",
-        "-I" + os.path.join(sphinx_base_path, sphinx_source_path, "lib/include"),
-        "-I" + os.path.join(sphinx_base_path, sphinx_source_path, "tests"),
-        "-I"
-        + os.path.join(
-            sphinx_base_path, sphinx_source_path, "tests/platform/Microchip_PIC24"
-        ),
-        "-I"
-        + os.path.join(
-            sphinx_base_path, sphinx_source_path, os.path.dirname(source_path)
-        ),
-        test_file_path,
-        "-DSIM",
-        "-DVERIFICATION_CODE=({}u)".format(verification_code),
-        "-c",
-        "-o" + test_object_path,
-    ]
-    report_subprocess(args, "Compile test code", cwd, out_list)
+
+    def test_compile_args(output_path, defines):
+        return [
+            "xc16-gcc",
+            "-mcpu=33EP128GP502",
+            "-omf=elf",
+            "-g",
+            "-O0",
+            "-msmart-io=1",
+            "-Wall",
+            "-Wextra",
+            "-Wdeclaration-after-statement",
+            "-I" + os.path.join(sphinx_base_path, sphinx_source_path, "lib/include"),
+            "-I" + os.path.join(sphinx_base_path, sphinx_source_path, "tests"),
+            "-I"
+            + os.path.join(
+                sphinx_base_path, sphinx_source_path, "tests/platform/Microchip_PIC24"
+            ),
+            "-I"
+            + os.path.join(
+                sphinx_base_path, sphinx_source_path, os.path.dirname(source_path)
+            ),
+            test_file_path,
+            "-DSIM",
+            *defines,
+            "-c",
+            "-o" + output_path,
+        ]
+
+    # Use the book's precompiled test code if possible; see `harness_store.py`.
+    harness = harness_store.get_harness(
+        "pic24-xc16-bullylib",
+        "unsigned long",
+        lambda dir_path, defines: [
+            test_compile_args(os.path.join(dir_path, "test.o"), defines)
+        ],
+        [test_file_path],
+        _build_mtime_paths(sphinx_base_path, sphinx_source_path, sphinx_out_path),
+    )
+    if harness:
+        test_object_path = harness.object_path("test.o")
+        verification_path = file_path + ".vc.c"
+        harness.write_verification_source(verification_path, verification_code)
+        # The link step compiles the verification code, so it needs the processor.
+        extra_link_args = ["-mcpu=33EP128GP502", verification_path]
+    else:
+        test_object_path = file_path + ".test.o"
+        report_subprocess(
+            test_compile_args(
+                test_object_path,
+                ["-DVERIFICATION_CODE=({}u)".format(verification_code)],
+            ),
+            "Compile test code",
+            cwd,
+            out_list,
+        )
+        extra_link_args = []
 
     # Link.
     elf_path = file_path + ".elf"
@@ -375,6 +628,7 @@ def xc16_builder(
         ),
         test_object_path,
         o_path,
+        *extra_link_args,
         "-lpic24_stdlib",
         "-L" + os.path.join(waf_root, ".."),
         "-o" + elf_path,
@@ -385,6 +639,7 @@ def xc16_builder(
     sim_ret = 0
     if not is_extension_asm:
         out_list.append(sim_run_mdb("mdb", "dspic33EP128GP502", elf_path))
+        publish_mdb_pool_stats()
     else:
         simout_path = file_path + ".simout"
         timeout_str = ""
@@ -473,36 +728,81 @@ def armv7_builder(
         lib_path,
         os.path.splitext(source_path)[0] + "-test.c",
     )
-    test_object_path = file_path + ".test.o"
 
-    # Build the test code with a random verification code.
-    args = [
-        "arm-none-eabi-gcc",
-        # The test code.
-        test_file_path,
-        # Pass the verification code. TODO: separate compiles, so user code doesn't have this value.
-        "-DVERIFICATION_CODE=({}u)".format(verification_code),
-        # Provide picky warnings, etc.
-        "-g",
-        "-O0",
-        "-Wall",
-        "-Wextra",
-        "-Wdeclaration-after-statement",
-        # Include paths for the book.
-        "-I" + os.path.join(sphinx_base_path, sphinx_source_path, "lib/include"),
-        "-I" + os.path.join(sphinx_base_path, sphinx_source_path, "tests"),
-        "-I"
-        + os.path.join(
-            sphinx_base_path, sphinx_source_path, "tests/platform/ARMv7-A_ARMv7-R"
-        ),
-        "-I"
-        + os.path.join(
-            sphinx_base_path, sphinx_source_path, os.path.dirname(source_path)
-        ),
-        "-c",
-        "-o" + test_object_path,
-    ]
-    report_subprocess(args, "Compile test code", cwd, out_list)
+    def test_compile_args(output_path, defines):
+        return [
+            "arm-none-eabi-gcc",
+            # The test code.
+            test_file_path,
+            # Pass the verification code.
+            *defines,
+            # Provide picky warnings, etc.
+            "-g",
+            "-O0",
+            "-Wall",
+            "-Wextra",
+            "-Wdeclaration-after-statement",
+            # Include paths for the book.
+            "-I" + os.path.join(sphinx_base_path, sphinx_source_path, "lib/include"),
+            "-I" + os.path.join(sphinx_base_path, sphinx_source_path, "tests"),
+            "-I"
+            + os.path.join(
+                sphinx_base_path, sphinx_source_path, "tests/platform/ARMv7-A_ARMv7-R"
+            ),
+            "-I"
+            + os.path.join(
+                sphinx_base_path, sphinx_source_path, os.path.dirname(source_path)
+            ),
+            "-c",
+            "-o" + output_path,
+        ]
+
+    # The ARM needs an interrupt vector table defined for this specific processor. It doesn't work if placed in the library below.
+    interrupts_path = os.path.join(
+        sphinx_base_path,
+        sphinx_source_path,
+        "tests/platform/ARMv7-A_ARMv7-R/interrupts.S",
+    )
+
+    # Use the book's precompiled test code and interrupt vectors if possible; see `harness_store.py`.
+    harness = harness_store.get_harness(
+        "armv7-newlib-sim",
+        "unsigned int",
+        lambda dir_path, defines: [
+            test_compile_args(os.path.join(dir_path, "test.o"), defines),
+            [
+                "arm-none-eabi-gcc",
+                interrupts_path,
+                "-c",
+                "-o" + os.path.join(dir_path, "interrupts.o"),
+            ],
+        ],
+        [test_file_path, interrupts_path],
+        _build_mtime_paths(sphinx_base_path, sphinx_source_path, sphinx_out_path),
+    )
+    if harness:
+        test_object_path = harness.object_path("test.o")
+        verification_path = file_path + ".vc.c"
+        harness.write_verification_source(verification_path, verification_code)
+        harness_args = [
+            test_object_path,
+            verification_path,
+            harness.object_path("interrupts.o"),
+        ]
+    else:
+        # Build the test code with a random verification code.
+        test_object_path = file_path + ".test.o"
+        report_subprocess(
+            test_compile_args(
+                test_object_path,
+                # TODO: separate compiles, so user code doesn't have this value.
+                ["-DVERIFICATION_CODE=({}u)".format(verification_code)],
+            ),
+            "Compile test code",
+            cwd,
+            out_list,
+        )
+        harness_args = [test_object_path, interrupts_path]
 
     # Link.
     elf_path = file_path + ".elf"
@@ -510,16 +810,12 @@ def armv7_builder(
         "arm-none-eabi-gcc",
         # Compiled sources.
         o_path,
-        test_object_path,
+        harness_args[0],
         # Output args.
         "-o",
         elf_path,
-        # The ARM needs an interrupt vector table defined for this specific processor. It doesn't work if placed in the library below.
-        os.path.join(
-            sphinx_base_path,
-            sphinx_source_path,
-            "tests/platform/ARMv7-A_ARMv7-R/interrupts.S",
-        ),
+        # The verification code (when precompiled) and the interrupt vector table.
+        *harness_args[1:],
         # Include the ARM library.
         "-larmv7_stdlib",
         "-L" + os.path.join(waf_root, ".."),
@@ -576,7 +872,7 @@ def armv7_builder(
         "-semihosting",
     ]
     out_list, correct = report_subprocess(
-        args, "Simulate", cwd, out_list, include_stderr=False
+        args, "Simulate", cwd, out_list, include_stderr=False, verdict=True
     )
 
     return out_list, (
@@ -639,5 +935,6 @@ def verilog_builder(
         cwd,
         out_list,
         include_stderr=True,
+        verdict=True,
     )
     return out_list, (100 if check_sim_out(out_list, verification_code) else 0)
@@ -0,0 +1,249 @@
+# *****************************************
+# |docname| - Serving a book's static files
+# *****************************************
+# Books contain many static assets (images, CSS, JavaScript, JupyterLite files, etc.) which `../routers/books.py` serves. Compared to a plain ``FileResponse``, this module:
+#
+# - Emits a strong ``ETag`` and ``Last-Modified``, and answers conditional requests (``If-None-Match``, ``If-Modified-Since``) with a 304.
+# - Sends a long-lived, ``immutable`` ``Cache-Control`` for assets whose names contain a content hash (or which are requested with Sphinx's ``?v=hash`` query string), and a shorter ``settings.static_max_age`` otherwise.
+# - Supports a single HTTP ``Range`` (plus ``If-Range``), so media can be seeked.
+# - Serves a precompressed ``.br`` or ``.gz`` sibling of a file when it exists, is up to date, and the client accepts that encoding.
+# - Optionally (when ``settings.static_accel_redirect_prefix`` is set) replies with an ``X-Accel-Redirect`` header, so that nginx sends the file instead of this process.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+import os
+import re
+import stat
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+# Third-party imports
+# -------------------
+import anyio
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+# Local application imports
+# -------------------------
+from ..config import settings
+
+
+# Constants
+# =========
+# Precompressed variants, in order of preference: (encoding, file extension).
+_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# A hash of a file's contents: at least 8 hex digits. The hash must contain both a letter and a digit, so that a date or a number (``20230115``) or a word (``deadbeef``) isn't mistaken for a hash; a hash without both merely gets the shorter max-age.
+_HASH = r"(?=[0-9]*[a-fA-F])(?=[a-fA-F]*[0-9])[0-9a-fA-F]{8,}"
+
+# A file name containing a hash, such as ``main.1a2b3c4d.js`` or ``style-1a2b3c4d5e.css``, but not ``report-20230115.pdf`` or ``image-deadbeef.png``.
+_HASHED_NAME = re.compile(rf"[.-]{_HASH}\.[^/]+$")
+
+# The value of Sphinx's ``?v=`` query string, which is a hash of the file's contents (``main.js?v=1a2b3c4d``). Any other value, such as one a client made up, doesn't mark the file as immutable.
+_VERSION_QUERY = re.compile(_HASH)
+
+_IMMUTABLE = "public, max-age=31536000, immutable"
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# Responses
+# =========
+# Send ``length`` bytes of a file, starting at ``start``.
+class _FileRangeResponse(Response):
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self, path: str, start: int, length: int, headers: Dict[str, str], media_type
+    ):
+        super().__init__(status_code=206, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.length = length
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.start)
+            remaining = self.length
+            while remaining:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": bool(remaining),
+                    }
+                )
+        if remaining:
+            # The file shrank while sending; end the response.
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+# Utilities
+# =========
+# Return the stat results for ``path`` and each of its precompressed variants; a result is None if the file doesn't exist (or isn't a regular file).
+def _stat_all(path: str) -> List[Optional[os.stat_result]]:
+    results = []
+    for p in [path] + [path + ext for _, ext in _ENCODINGS]:
+        try:
+            st = os.stat(p)
+        except OSError:
+            st = None
+        results.append(st if st and stat.S_ISREG(st.st_mode) else None)
+    return results
+
+
+def _etag(st: os.stat_result, suffix: str = "") -> str:
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}{suffix}"'
+
+
+# Return the encodings in ``Accept-Encoding`` with a non-zero q-value.
+def _accepted_encodings(accept_encoding: str) -> List[str]:
+    accepted = []
+    for item in accept_encoding.split(","):
+        coding, *params = [s.strip() for s in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if coding and q > 0:
+            accepted.append(coding.lower())
+    return accepted
+
+
+# Return True if the client's cached copy, described by the conditional request headers, is current.
+def _not_modified(request: Request, etag: str, st: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Use the weak comparison, as required for ``If-None-Match``.
+        tags = [re.sub("^W/", "", t.strip()) for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return (
+                int(st.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            )
+        except (TypeError, ValueError):
+            pass
+    return False
+
+
+# Parse a ``Range`` header for a file of ``size`` bytes. Return None to send the entire file (no range, or a form this doesn't support, such as multiple ranges), or (start, length). Raise a 416 if the range can't be satisfied.
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    m = _RANGE.match(range_header.strip())
+    if not m or m.groups() == ("", ""):
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        # A suffix range: the last ``last`` bytes.
+        start = max(size - int(last), 0)
+        end = size - 1
+        if int(last) == 0:
+            start = size
+    if start >= size:
+        raise HTTPException(416, headers={"content-range": f"bytes */{size}"})
+    return start, end - start + 1
+
+
+# Serving
+# =======
+# Return a response for the file at ``path``, which must be under ``settings.book_path``.
+async def static_file_response(request: Request, path: str) -> Response:
+    st, *variant_stats = await run_in_threadpool(_stat_all, path)
+    if st is None:
+        raise HTTPException(404)
+
+    media_type = guess_type(path)[0] or "text/plain"
+    etag = _etag(st)
+    hashed = _HASHED_NAME.search(os.path.basename(path)) or _VERSION_QUERY.fullmatch(
+        request.query_params.get("v", "")
+    )
+    headers = {
+        "cache-control": _IMMUTABLE
+        if hashed
+        else f"public, max-age={settings.static_max_age}",
+        "last-modified": formatdate(st.st_mtime, usegmt=True),
+        "accept-ranges": "bytes",
+    }
+
+    # Find a precompressed variant which is at least as new as the file it was compressed from.
+    variants = [
+        (encoding, ext, vst)
+        for (encoding, ext), vst in zip(_ENCODINGS, variant_stats)
+        if vst and vst.st_mtime >= st.st_mtime
+    ]
+    if variants:
+        headers["vary"] = "Accept-Encoding"
+    range_header = request.headers.get("range")
+    encoding = ext = vst = None
+    # Byte ranges apply to the identity encoding only.
+    if variants and not range_header:
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        for encoding, ext, vst in variants:
+            if encoding in accepted:
+                break
+        else:
+            encoding = ext = vst = None
+    if encoding:
+        etag = _etag(st, f"-{ext[1:]}")
+    headers["etag"] = etag
+
+    if _not_modified(request, etag, st):
+        return Response(status_code=304, headers=headers)
+
+    if settings.static_accel_redirect_prefix:
+        # Let nginx send the file; it handles ranges itself.
+        rel_path = os.path.relpath(path, settings.book_path) + (ext or "")
+        headers["x-accel-redirect"] = settings.static_accel_redirect_prefix.rstrip(
+            "/"
+        ) + quote(f"/{rel_path}")
+        if encoding:
+            headers["content-encoding"] = encoding
+        return Response(headers=headers, media_type=media_type)
+
+    if encoding:
+        headers["content-encoding"] = encoding
+        return FileResponse(
+            path + ext, headers=headers, media_type=media_type, stat_result=vst
+        )
+
+    if range_header:
+        if_range = request.headers.get("if-range")
+        if not if_range or if_range in (etag, headers["last-modified"]):
+            byte_range = _parse_range(range_header, st.st_size)
+            if byte_range:
+                start, length = byte_range
+                headers[
+                    "content-range"
+                ] = f"bytes {start}-{start + length - 1}/{st.st_size}"
+                return _FileRangeResponse(path, start, length, headers, media_type)
+
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=st)
@@ -29,14 +29,19 @@ from pydantic.error_wrappers import ValidationError
 from .applogger import rslogger
 from .config import settings
 from .crud import create_traceback
-from .db import init_models, term_models
+from .db import RequestSessionMiddleware, init_models, term_models
+from .internal.builder_executor import close_builder_executor
 from .internal.feedback import init_graders
+from .internal.ingest import ingest_pipeline
+from .internal.redis_client import close_redis
+from .internal.regrade import stop_regrades
 from .routers import assessment
 from .routers import auth
 from .routers import books
 from .routers import rslogging
 from .routers import discuss
 from .routers import coach
+from .routers import metrics
 from .session import auth_manager
 
 
@@ -49,6 +54,9 @@ if root_path := os.environ.get("ROOT_PATH"):
 app = FastAPI(**kwargs)  # type: ignore
 rslogger.info(f"Serving books from {settings.book_path}.\n")
 
+# Give each request a `unit of work <Request-scoped sessions>` which its database queries share. Middleware added later wraps middleware added earlier, so this is the innermost middleware; it must be, since the unit of work belongs to the task which runs the endpoint, and each ``BaseHTTPMiddleware`` (such as those below) runs the rest of the app in a new task.
+app.add_middleware(RequestSessionMiddleware)
+
 # Install the auth_manager as middleware This will make the user
 # part of the request ``request.state.user`` `See FastAPI_Login Advanced <https://fastapi-login.readthedocs.io/advanced_usage/>`_
 auth_manager.useRequest(app)
@@ -66,6 +74,7 @@ app.include_router(assessment.router)
 app.include_router(auth.router)
 app.include_router(discuss.router)
 app.include_router(coach.router)
+app.include_router(metrics.router)
 
 # We can mount various "apps" with mount.  Anything that gets to this server with /staticAssets
 # will serve staticfiles - StaticFiles class implements the same interface as a FastAPI app.
@@ -85,17 +94,27 @@ async def startup():
     # Check/create paths used by the server.
     os.makedirs(settings.book_path, exist_ok=True)
     os.makedirs(settings.error_path, exist_ok=True)
+    os.makedirs(settings.template_bytecode_cache_path, exist_ok=True)
     assert (
         settings.runestone_path.exists()
     ), f"Runestone appplication in web2py path {settings.runestone_path} does not exist."
 
     await init_models()
     init_graders()
+    ingest_pipeline.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    # Stop chat first, since it logs messages through the ingest pipeline.
+    await discuss.stop_chat_listener()
+    # Write any queued log entries while the database is still available.
+    await ingest_pipeline.drain()
+    # Save the progress of regrades while the database is still available.
+    await stop_regrades()
+    await close_builder_executor()
     await term_models()
+    await close_redis()
 
 
 #
@@ -96,6 +96,10 @@ class Web2PyBoolean(types.TypeDecorator):
 class RunestoneComponentDict:
     def __init__(self, model: Type[Base], validator: Type[BaseModelNone]):
         self.grader = None
+        # If provided, a function which transforms a question's decoded feedback into the form passed to ``grader`` (for example, by precompiling it); ``is_server_feedback`` caches the result.
+        self.feedback_compiler = None
+        # If provided, a picklable function ``batch_grader(feedback, answers)`` which grades a list of stored answers to one question without blocking, returning a list of dicts of the new column values (such as ``correct`` and ``percent``). `Bulk regrading <internal/regrade.py>` runs this in a process pool; otherwise, it calls ``grader`` for each answer.
+        self.batch_grader = None
         self.model = model
         self.validator = validator
 
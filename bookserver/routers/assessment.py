@@ -16,6 +16,7 @@
 # Standard library
 # ----------------
 import datetime
+from functools import lru_cache
 import random
 from typing import Optional, Dict, Any
 
@@ -31,28 +32,28 @@ from ..applogger import rslogger
 from ..crud import (
     EVENT2TABLE,
     count_matching_questions,
-    count_useinfo_for,
     create_selected_question,
     create_user_experiment_entry,
     fetch_assignment_question,
     fetch_code,
     fetch_course,
     fetch_last_answer_table_entry,
-    fetch_last_poll_response,
     fetch_matching_questions,
-    fetch_poll_summary,
     fetch_previous_selections,
     fetch_question,
     fetch_question_grade,
     fetch_selected_question,
     fetch_timed_exam,
-    fetch_top10_fitb,
     fetch_user,
     fetch_user_experiment,
     fetch_viewed_questions,
     is_server_feedback,
     update_selected_question,
 )
+from ..internal.answer_counts import fetch_answer_counts
+from ..internal.fitb_top_answers import fetch_top_fitb_answers
+from ..internal.poll_tally import fetch_poll_counts, fetch_poll_vote, poll_results
+from ..internal.regrade import RegradeError, regrade_status, start_regrade
 from ..internal.utils import make_json_response
 from ..models import runestone_component_dict
 from ..schemas import AssessmentRequest, SelectQRequest
@@ -99,7 +100,9 @@ async def get_assessment_results(
     ret = row.dict()
 
     # Do server-side grading if needed, which restores the answer and feedback.
-    if feedback := await is_server_feedback(request_data.div_id, request_data.course):
+    if feedback := await is_server_feedback(
+        request_data.div_id, request_data.course, request_data.event
+    ):
         rcd = runestone_component_dict[EVENT2TABLE[request_data.event]]
         # The grader should also be defined if there's feedback.
         assert rcd.grader
@@ -203,7 +206,8 @@ async def getaggregateresults(request: Request, div_id: str, course_name: str):
     else:
         start_date = course.term_start_date
 
-    result = await count_useinfo_for(question, course_name, start_date)
+    # See `../internal/answer_counts.py`.
+    result = await fetch_answer_counts(course_name, question, start_date)
     # result rows will look like act, count
     # the act field may look like
     # ``answer:1:correct`` or
@@ -253,36 +257,11 @@ async def getaggregateresults(request: Request, div_id: str, course_name: str):
 @router.get("/getpollresults")
 async def getpollresults(request: Request, course: str, div_id: str):
 
-    # fetch summary of poll answers
-    result = await fetch_poll_summary(div_id, course)
-
-    opt_counts = {}
-
-    for row in result:
-        rslogger.debug(row)
-        if ":" in row[0]:
-            val = int(row[0].split(":")[0])
-        else:
-            val = int(row[0])
-        opt_counts[val] = row[1]
-
-    opt_num = max(opt_counts.keys()) if opt_counts else 0
-    for i in range(opt_num):
-        if i not in opt_counts:
-            opt_counts[i] = 0
-    # opt_list holds the option numbers from smallest to largest
-    # count_list[i] holds the count of responses that chose option i
-    opt_list = sorted(opt_counts.keys())
-    count_list = []
-    for i in opt_list:
-        count_list.append(opt_counts[i])
-
-    total = sum(opt_counts.values())
+    # Count each student's last vote; see `../internal/poll_tally.py`.
+    results = poll_results(div_id, await fetch_poll_counts(course, div_id))
     user_res = None
     if request.state.user:
-        user_res = await fetch_last_poll_response(
-            request.state.user.username, course, div_id
-        )
+        user_res = await fetch_poll_vote(course, div_id, request.state.user.username)
     my_comment = ""
     if user_res:
         if ":" in user_res:
@@ -296,15 +275,19 @@ async def getpollresults(request: Request, course: str, div_id: str):
 
     return make_json_response(
         detail=dict(
-            total=total,
-            opt_counts=opt_counts,
-            div_id=div_id,
+            **results,
             my_vote=my_vote,
             my_comment=my_comment,
         )
     )
 
 
+# The same answers are shown to every student in a course, so cache their sanitized forms rather than sanitizing them on each request.
+@lru_cache(maxsize=4096)
+def _clean_answer(answer: str) -> str:
+    return clean(answer)
+
+
 # Called from :ref:`compareFITBAnswers`
 #
 @router.get("/gettop10Answers")
@@ -316,15 +299,94 @@ async def gettop10Answers(request: Request, course: str, div_id: str):
     # [(["12"], 2), (["22"], 1), (["11"], 1), (["10"], 1)]
     # the first element of each tuple is a list of the responses to 1 or more blanks
     # the second element of each tuple is the count
-    rows = await fetch_top10_fitb(dbcourse, div_id)
+    # See `../internal/fitb_top_answers.py`.
+    rows = await fetch_top_fitb_answers(dbcourse, div_id)
     rslogger.debug(f"{rows=}")
-    res = [{"answer": clean(row[0]), "count": row[1]} for row in rows]
+    res = [{"answer": _clean_answer(row[0]), "count": row[1]} for row in rows]
 
     miscdata = {"course": course}
 
     return make_json_response(detail=dict(res=res, miscdata=miscdata))
 
 
+# Regrade answers in bulk
+# -----------------------
+# Regrade the stored answers in an answer table (such as ``fitb_answers`` or ``lp_answers``) for one question, or for all questions if ``div_id`` is omitted. The answers in every course using this book may be regraded only from the base course. See `../internal/regrade.py`.
+class RegradeJobRequest(BaseModel):
+    course: str
+    table: str
+    div_id: Optional[str] = None
+    whole_base_course: bool = False
+    # Start over instead of resuming an unfinished regrade.
+    restart: bool = False
+
+
+@router.post("/regrade")
+async def regrade(
+    request: Request, request_data: RegradeJobRequest, user=Depends(auth_manager)
+):
+    if user.course_name != request_data.course or not await is_instructor(request):
+        return make_json_response(
+            status=status.HTTP_401_UNAUTHORIZED, detail="not an instructor"
+        )
+    if request_data.whole_base_course:
+        course = await fetch_course(request_data.course)
+        if course.base_course != course.course_name:
+            return make_json_response(
+                status=status.HTTP_403_FORBIDDEN,
+                detail="Only the base course may regrade every course using its book.",
+            )
+    try:
+        state = await start_regrade(
+            request_data.table,
+            request_data.course,
+            request_data.div_id,
+            request_data.whole_base_course,
+            request_data.restart,
+        )
+    except RegradeError as e:
+        return make_json_response(status=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return make_json_response(status=status.HTTP_202_ACCEPTED, detail=state)
+
+
+# Regrade fill-in-the-blank answers
+# ---------------------------------
+# After fixing the answer key of a fill-in-the-blank question (and rebuilding the book), an instructor can regrade every stored answer to it. This is a shortcut for a `regrade <Regrade answers in bulk>` of one question in ``fitb_answers``; poll ``/regrade/{job_id}`` for its progress.
+class RegradeRequest(BaseModel):
+    course: str
+    div_id: str
+
+
+@router.post("/regrade_fitb")
+async def regrade_fitb(
+    request: Request, request_data: RegradeRequest, user=Depends(auth_manager)
+):
+    return await regrade(
+        request,
+        RegradeJobRequest(
+            course=request_data.course,
+            table="fitb_answers",
+            div_id=request_data.div_id,
+        ),
+        user,
+    )
+
+
+# Report the progress of a regrade started by ``regrade`` or ``regrade_fitb``.
+@router.get("/regrade/{job_id}")
+async def get_regrade_status(request: Request, job_id: str, user=Depends(auth_manager)):
+    state = regrade_status(job_id)
+    if (
+        not state
+        or state["course_name"] != user.course_name
+        or not await is_instructor(request)
+    ):
+        return make_json_response(
+            status=status.HTTP_404_NOT_FOUND, detail="no such regrade"
+        )
+    return make_json_response(detail=state)
+
+
 @router.get("/set_selected_question")
 async def set_selected_question(request: Request, metaid: str, selected: str):
     """
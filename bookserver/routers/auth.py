@@ -29,10 +29,10 @@ from pydal.validators import CRYPT
 
 # Local application imports
 # -------------------------
-from ..session import load_user, auth_manager
+from ..session import auth_manager
 from ..applogger import rslogger
 from ..config import settings
-from ..crud import create_user
+from ..crud import create_user, fetch_user
 from ..models import AuthUserValidator
 
 # Routing
@@ -76,7 +76,8 @@ async def login(
     password = data.password
 
     rslogger.debug(f"username = {username}")
-    user = await load_user(username)
+    # Read the password hash from the database; cached users may not have it.
+    user = await fetch_user(username, use_cache=False)
     rslogger.debug(user)
     # um = UserManagerWeb2Py()
     if not user:
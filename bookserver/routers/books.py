@@ -16,13 +16,15 @@ import os.path
 import posixpath
 import random
 import socket
+from functools import lru_cache
 from typing import Optional
 
 # Third-party imports
 # -------------------
 from fastapi import APIRouter, Cookie, Request, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 from jinja2.exceptions import TemplateNotFound
 from pydantic import constr
 
@@ -32,13 +34,13 @@ from ..applogger import rslogger
 from ..config import settings
 from ..crud import (
     create_useinfo_entry,
-    fetch_chapter_for_subchapter,
     fetch_course,
     fetch_library_books,
-    fetch_page_activity_counts,
     fetch_all_course_attributes,
-    fetch_subchapters,
 )
+from ..internal.activity import fetch_activity_counts
+from ..internal.book_index import get_book_index
+from ..internal.static_assets import static_file_response
 from ..models import UseinfoValidation
 from ..session import is_instructor
 
@@ -68,10 +70,10 @@ router = APIRouter(
 #
 
 # TODO: make published/draft configurable
-async def return_static_asset(course, kind, filepath):
+async def return_static_asset(request: Request, course: str, kind: str, filepath: str):
     # Get the course row so we can use the base_course
     # We would like to serve book pages with the actual course name in the URL
-    # instead of the base course.  This is a necessary step.
+    # instead of the base course.  This is a necessary step. Course rows are cached, so this usually doesn't query the database.
     course_row = await fetch_course(course)
     if not course_row:
         raise HTTPException(404)
@@ -85,10 +87,10 @@ async def return_static_asset(course, kind, filepath):
         filepath,
     )
     rslogger.debug(f"GETTING: {filepath}")
-    if os.path.exists(filepath) and not os.path.isdir(filepath):
-        return FileResponse(filepath)
-    else:
+    if filepath is None:
         raise HTTPException(404)
+    # See `../internal/static_assets.py`.
+    return await static_file_response(request, filepath)
 
 
 # Runestone academy supported several additional static folders:
@@ -99,47 +101,47 @@ async def return_static_asset(course, kind, filepath):
 
 
 @router.get("/published/{course:str}/_images/{filepath:path}")
-async def get_image(course: str, filepath: str):
-    return await return_static_asset(course, "_images", filepath)
+async def get_image(request: Request, course: str, filepath: str):
+    return await return_static_asset(request, course, "_images", filepath)
 
 
 @router.get("/published/{course:str}/_static/{filepath:path}")
-async def get_static(course: str, filepath: str):
-    return await return_static_asset(course, "_static", filepath)
+async def get_static(request: Request, course: str, filepath: str):
+    return await return_static_asset(request, course, "_static", filepath)
 
 
 # PreTeXt books put images in images not _images -- oh for regexes in routes!
 @router.get("/published/{course:str}/images/{filepath:path}")
-async def get_ptximages(course: str, filepath: str):
-    return await return_static_asset(course, "images", filepath)
+async def get_ptximages(request: Request, course: str, filepath: str):
+    return await return_static_asset(request, course, "images", filepath)
 
 
 # Umich book uses the _downloads folder and ``:download:`` role
 @router.get("/published/{course:str}/_downloads/{filepath:path}")
-async def get_downloads(course: str, filepath: str):
-    return await return_static_asset(course, "_downloads", filepath)
+async def get_downloads(request: Request, course: str, filepath: str):
+    return await return_static_asset(request, course, "_downloads", filepath)
 
 
 # PreTeXt
 @router.get("/published/{course:str}/generated/{filepath:path}")
-async def get_generated(course: str, filepath: str):
-    return await return_static_asset(course, "generated", filepath)
+async def get_generated(request: Request, course: str, filepath: str):
+    return await return_static_asset(request, course, "generated", filepath)
 
 
 # PreTeXt
 @router.get("/published/{course:str}/external/{filepath:path}")
-async def get_external(course: str, filepath: str):
-    return await return_static_asset(course, "external", filepath)
+async def get_external(request: Request, course: str, filepath: str):
+    return await return_static_asset(request, course, "external", filepath)
 
 
 # Jupyterlite
 @router.get("/published/{course:str}/lite/{filepath:path}")
-async def get_jlite(course: str, filepath: str):
+async def get_jlite(request: Request, course: str, filepath: str):
 
     rslogger.debug(f"Getting {filepath} but adding index.html")
     if filepath[-1] == "/":
         filepath += "index.html"
-    return await return_static_asset(course, "lite", filepath)
+    return await return_static_asset(request, course, "lite", filepath)
 
 
 # Basic page renderer
@@ -207,49 +209,30 @@ async def serve_page(
             )
     # proceed with the knowledge that course_row is defined after this point.
 
-    # The template path comes from the base course's name.
-    templates = Jinja2Templates(
-        directory=safe_join(
-            settings.book_path,
-            course_row.base_course,
-            "published",
-            course_row.base_course,
-        )
-    )
     course_attrs = await fetch_all_course_attributes(course_row.id)
     # course_attrs will always return a dictionary, even if an empty one.
     rslogger.debug(f"HEY COURSE ATTRS: {course_attrs}")
-    # TODO set custom delimiters for PreTeXt books (https://stackoverflow.com/questions/33775085/is-it-possible-to-change-the-default-double-curly-braces-delimiter-in-polymer)
-    # Books built with lots of LaTeX math in them are troublesome as they tend to have many instances
-    # of ``{{`` and ``}}`` which conflicts with the default Jinja2 start stop delimiters. Rather than
-    # escaping all of the latex math the PreTeXt built books use different delimiters for the templates
-    # templates.env is a reference to a Jinja2 Environment object
-    # try - templates.env.block_start_string = "@@@+"
-    # try - templates.env.block_end_string = "@@@-"
-
-    if course_attrs.get("markup_system", "RST") == "PreTeXt":
-        rslogger.debug(f"PRETEXT book found at path {pagepath}")
-        templates.env.variable_start_string = "~._"
-        templates.env.variable_end_string = "_.~"
-        templates.env.comment_start_string = "@@#"
-        templates.env.comment_end_string = "#@@"
-        templates.env.globals.update({"URL": URL})
+    templates = get_book_templates(
+        course_row.base_course, course_attrs.get("markup_system", "RST")
+    )
 
     # enable compare me can be set per course if its not set provide a default of true
     if "enable_compare_me" not in course_attrs:
         course_attrs["enable_compare_me"] = "true"
 
+    # The structure of the book comes from its index, rather than from the database.
+    book_index = await get_book_index(course_row.base_course)
     subchapter = os.path.basename(os.path.splitext(pagepath)[0])
     rslogger.debug(f"SUBCHAPTER IS {subchapter}")
     if course_attrs.get("markup_system", "RST") == "PreTeXt":
-        chapter = await fetch_chapter_for_subchapter(subchapter, course_row.base_course)
+        chapter = book_index.chapter_for(subchapter)
     else:
         chapter = os.path.split(os.path.split(pagepath)[0])[1]
 
     rslogger.debug(f"CHAPTER IS {chapter} / {subchapter}")
     if user:
-        activity_info = await fetch_page_activity_counts(
-            chapter, subchapter, course_row.base_course, course_name, user.username
+        activity_info = await fetch_activity_counts(
+            book_index.div_ids_for(chapter, subchapter), course_name, user.username
         )
 
     reading_list = []
@@ -275,7 +258,7 @@ async def serve_page(
     else:
         canonical_host = os.environ.get("RUNESTONE_HOST", "localhost")
 
-    subchapter_list = await fetch_subchaptoc(course_row.base_course, chapter)
+    subchapter_list = book_index.toc_for(chapter)
     # TODO: restore the contributed questions list ``questions`` for books (only fopp) that
     # show the contributed questions list on an Exercises page.
 
@@ -358,6 +341,9 @@ async def crashme():
 
 # The Library Page
 # ================
+library_templates = Jinja2Templates(
+    directory=f"{settings._book_server_path}/templates{router.prefix}"
+)
 
 
 @router.api_route("/index", methods=["GET", "POST"])
@@ -378,10 +364,7 @@ async def library(request: Request, response_class=HTMLResponse):
         course = ""
         username = ""
         instructor_status = False
-    templates = Jinja2Templates(
-        directory=f"{settings._book_server_path}/templates{router.prefix}"
-    )
-    return templates.TemplateResponse(
+    return library_templates.TemplateResponse(
         "index.html",
         {
             "request": request,
@@ -396,6 +379,45 @@ async def library(request: Request, response_class=HTMLResponse):
 
 # Utilities
 # =========
+# Templates
+# ---------
+# Return the templates for a book. Creating a Jinja ``Environment`` for each page view would discard its cache of compiled templates, so keep one per book in an LRU cache. Since ``auto_reload`` is on (the default), Jinja checks each template's mtime and recompiles it when the book is republished. Compiled bytecode is also stored in ``settings.template_bytecode_cache_path``, so that a new worker process (or an evicted book) doesn't need to parse the templates again.
+_bytecode_cache = FileSystemBytecodeCache(str(settings.template_bytecode_cache_path))
+
+
+@lru_cache(maxsize=settings.template_cache_size)
+def get_book_templates(base_course: str, markup_system: str) -> Jinja2Templates:
+    env_options = {}
+    if markup_system == "PreTeXt":
+        # Books built with lots of LaTeX math in them are troublesome as they tend to have many instances
+        # of ``{{`` and ``}}`` which conflicts with the default Jinja2 start stop delimiters. Rather than
+        # escaping all of the latex math the PreTeXt built books use different delimiters for the templates.
+        rslogger.debug(f"PRETEXT book found for {base_course}")
+        env_options = dict(
+            variable_start_string="~._",
+            variable_end_string="_.~",
+            comment_start_string="@@#",
+            comment_end_string="#@@",
+        )
+    # The template path comes from the base course's name.
+    templates = Jinja2Templates(
+        directory=safe_join(
+            settings.book_path,
+            base_course,
+            "published",
+            base_course,
+        ),
+        bytecode_cache=_bytecode_cache,
+        auto_reload=True,
+        **env_options,
+    )
+    if markup_system == "PreTeXt":
+        templates.env.globals.update({"URL": URL})
+    return templates
+
+
+# Paths
+# -----
 # This is copied verbatim from https://github.com/pallets/werkzeug/blob/master/werkzeug/security.py#L30.
 _os_alt_seps = list(
     sep for sep in [os.path.sep, os.path.altsep] if sep not in (None, "/")
@@ -429,15 +451,3 @@ def safe_join(directory, *pathnames):
             return None
         parts.append(filename)
     return posixpath.join(*parts)
-
-
-async def fetch_subchaptoc(course: str, chap: str):
-    res = await fetch_subchapters(course, chap)
-    toclist = []
-    for row in res:
-        rslogger.debug(f"row = {row}")
-        sc_url = "{}.html".format(row[0])
-        title = row[1]
-        toclist.append(dict(subchap_uri=sc_url, title=title))
-
-    return toclist
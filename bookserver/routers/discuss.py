@@ -14,20 +14,28 @@
 # We will use redis pubsub model to support a fast production environment.
 #
 # We have one end point called ``websocket_endpoint`` that browsers open a websocket with
-# this connection is only for the page to RECEIVE messages.  The endpoint is also a redis
-# subscriber to the "peermessages" channel.
+# this connection is only for the page to RECEIVE messages.  Each worker has one redis
+# subscriber to the "peermessages" channel, which delivers messages to the websockets
+# connected to that worker.
 #
 # We have a second endpoint called ``send_message`` that accepts a json formatted message
 # package.  This could be a broadcast text message, or could be a special control mesage
 # that allows the instructor to move the students through the peer process.  The ``send_message``
 # endpoint is the redis producer.
 #
-# The producer sends the message into the redis queue and then all copies of the consumer
-# look at the message.  If the recipient of that message is connected to that instance
-# then the message is sent to the recipient and all other instance ignore that message.
+# The producer sends the message into the redis queue and then every worker's consumer
+# looks at the message.  If the recipient of that message is connected to that worker
+# then the message is sent to the recipient and all other workers ignore that message.
 # If the message is a broadcast message then all instances of the consumer forward that
-# message to all connected parties.
+# message to all connected parties. A broadcast which names a ``course_name`` (such as the
+# `poll results <../internal/poll_tally.py>`) goes only to the parties whose current course
+# is that course.
+#
+# The consumer never waits for a websocket or the database: each connection has a bounded
+# outbox, drained by its own sender task, and chat messages are logged by background tasks.
+# One slow connection or insert therefore delays only its own messages.
 
+import asyncio
 import json
 import os
 import time
@@ -36,10 +44,7 @@ import time
 # Third-party imports
 # -------------------
 from datetime import datetime
-from typing import Dict, Optional, Any
-from multi_await import multi_await  # type: ignore
-
-import aioredis
+from typing import Dict, Optional, Any, Set
 
 # Local application imports
 # -------------------------
@@ -48,13 +53,16 @@ from fastapi import (
     Cookie,
     Query,
     WebSocket,  # Depends,; noqa F401
+    WebSocketDisconnect,
     status,
 )
 from fastapi.templating import Jinja2Templates
 
 from ..applogger import rslogger
 from ..config import settings
-from ..crud import create_useinfo_entry
+from ..crud import fetch_user
+from ..internal.ingest import ingest_pipeline
+from ..internal.redis_client import get_redis
 from ..models import UseinfoValidation
 from ..schemas import PeerMessage
 
@@ -71,16 +79,61 @@ router = APIRouter(
 templates = Jinja2Templates(directory=f"{settings._book_server_path}/templates/discuss")
 
 
+# The most messages waiting to be sent to one connection. A connection which falls this far behind misses the messages which don't fit.
+OUTBOX_SIZE = 100
+
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
-
-    async def connect(self, user: str, websocket: WebSocket):
+        # The current course of each connected user, or None if it's unknown.
+        self.courses: Dict[str, Optional[str]] = {}
+        # The messages waiting to be sent to each connection, and the task which sends them.
+        self.outboxes: Dict[str, asyncio.Queue] = {}
+        self.senders: Dict[str, asyncio.Task] = {}
+
+    async def connect(
+        self, user: str, websocket: WebSocket, course_name: Optional[str] = None
+    ):
         await websocket.accept()
+        # A user who reconnects (for example, from another tab) replaces their old connection.
+        self.disconnect(user)
+        outbox: asyncio.Queue = asyncio.Queue(OUTBOX_SIZE)
         self.active_connections[user] = websocket
+        self.courses[user] = course_name
+        self.outboxes[user] = outbox
+        self.senders[user] = asyncio.create_task(self._send(user, websocket, outbox))
+
+    # Forget a user's connection. If ``websocket`` is given, only forget it if it's still the user's current connection (the user may have reconnected from another tab).
+    def disconnect(self, sockid: str, websocket: Optional[WebSocket] = None):
+        if websocket is None or self.active_connections.get(sockid) is websocket:
+            self.active_connections.pop(sockid, None)
+            self.courses.pop(sockid, None)
+            self.outboxes.pop(sockid, None)
+            sender = self.senders.pop(sockid, None)
+            if sender is not None and sender is not asyncio.current_task():
+                sender.cancel()
+
+    # Send the messages in a connection's outbox, in order, until sending fails.
+    async def _send(self, user: str, websocket: WebSocket, outbox: asyncio.Queue):
+        while True:
+            message = await outbox.get()
+            try:
+                rslogger.debug(f"{os.getpid()}: sending {message} to {user}")
+                await websocket.send_json(message)
+            except Exception as e:
+                rslogger.error(f"{os.getpid()}: Error sending to {user} is {e}")
+                self.disconnect(user, websocket)
+                return
 
-    def disconnect(self, sockid: str):
-        del self.active_connections[sockid]
+    # Queue ``message`` for ``receiver`` without waiting for it to be sent.
+    def _post(self, receiver: str, message: Dict[str, Any]) -> None:
+        try:
+            self.outboxes[receiver].put_nowait(message)
+        except asyncio.QueueFull:
+            rslogger.error(
+                f"{os.getpid()}: Dropped a message to {receiver}, who is {OUTBOX_SIZE} messages behind"
+            )
 
     async def send_personal_message(
         self,
@@ -88,32 +141,21 @@ class ConnectionManager:
         message: Dict[str, Any],
     ):
         to = receiver
-        if to in self.active_connections:
-            try:
-                rslogger.debug(
-                    f"{os.getpid()}: sending {message} to {to} on {self.active_connections[to]}"
-                )
-                await self.active_connections[to].send_json(message)
-            except Exception as e:
-                rslogger.error(f"{os.getpid()}: Error sending to {to} is {e}")
-                del self.active_connections[to]
+        if to in self.outboxes:
+            self._post(to, message)
         else:
             rslogger.error(
                 f"{os.getpid()}: {to} is not connected here {self.active_connections}"
             )
 
-    async def broadcast(self, message: str) -> None:
+    # Send ``message`` to every connection, or only to the users in ``course_name`` if it's given.
+    async def broadcast(
+        self, message: Dict[str, Any], course_name: Optional[str] = None
+    ) -> None:
         rslogger.debug(f"{os.getpid()}: {self.active_connections=} {message=}")
-        to_remove = []
-        for key, connection in self.active_connections.items():
-            rslogger.debug(f"{os.getpid()}: sending to {key}@{connection}")
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                rslogger.debug(f"{os.getpid()}: Failed to send {e}")
-                to_remove.append(key)
-        for key in to_remove:
-            del self.active_connections[key]
+        for key in list(self.outboxes):
+            if course_name is None or self.courses.get(key) == course_name:
+                self._post(key, message)
 
 
 # this is good for prototyping, but we will need to integrate with
@@ -133,6 +175,133 @@ async def get_cookie_or_token(
     return access_token or user
 
 
+# Fan-out
+# =======
+# Each worker runs a single subscriber task (started when the first websocket connects) which receives every message published to the "peermessages" channel and routes it to the recipients connected to this worker. This means a worker holds one pubsub connection and decodes each message once, no matter how many websockets it serves.
+_listener: Optional[asyncio.Task] = None
+
+
+def _start_listener() -> None:
+    global _listener
+    if _listener is None or _listener.done():
+        _listener = asyncio.create_task(_listen())
+
+
+# Stop the subscriber and sender tasks; `../main.py` calls this on shutdown.
+async def stop_chat_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        _listener = None
+    for user in list(manager.active_connections):
+        manager.disconnect(user)
+    # Finish logging messages while the ingest pipeline still runs.
+    await asyncio.gather(*_log_tasks)
+
+
+async def _listen() -> None:
+    while True:
+        try:
+            subscriber = get_redis().pubsub()
+            await subscriber.subscribe("peermessages")
+            try:
+                async for pmess in subscriber.listen():
+                    rslogger.debug(f"{os.getpid()}: {pmess=}")
+                    if pmess["type"] != "message":
+                        continue
+                    try:
+                        # This is a message sent into the channel, our stuff is in
+                        # the ``data`` field of the redis message
+                        await _dispatch(json.loads(pmess["data"]))
+                    except Exception as e:
+                        rslogger.error(
+                            f"{os.getpid()}: Unable to dispatch {pmess}: {e}"
+                        )
+            finally:
+                await subscriber.reset()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Most likely, the connection to Redis was lost. Try again after a pause.
+            rslogger.error(f"{os.getpid()}: peermessages subscriber failed: {e}")
+            await asyncio.sleep(1)
+
+
+# Send a message to the recipients connected to this worker.
+async def _dispatch(data: Dict[str, Any]) -> None:
+    if data["broadcast"]:
+        await manager.broadcast(data, data.get("course_name"))
+        return
+
+    # The instructor enables chat for one student at a time.
+    if data["message"] == "enableChat":
+        to = data.get("to")
+        if to in manager.active_connections:
+            await manager.send_personal_message(to, data)
+        return
+
+    # Other messages go to the sender's partners.
+    mess_from = data["from"]
+    partner_list = await get_redis().hget(f"partnerdb_{data['course_name']}", mess_from)
+    if not partner_list:
+        rslogger.error(f"{os.getpid()}: Failed to find a partner for {mess_from}")
+        if mess_from in manager.active_connections:
+            try:
+                mess = {
+                    "type": "text",
+                    "from": mess_from,
+                    "message": "Could not find a partner for you",
+                    "time": time.time(),
+                    "broadcast": False,
+                    "course_name": data["course_name"],
+                    "div_id": data["div_id"],
+                }
+                await manager.send_personal_message(mess_from, mess)
+            except KeyError:
+                rslogger.error(f"Not enough data to construct a message: {data}")
+        return
+
+    for partner in json.loads(partner_list):
+        if partner not in manager.active_connections:
+            continue
+        await manager.send_personal_message(partner, data)
+        # log the message
+        # todo - we should not log messages that are 'control' messages
+        # These individual control messages update partner and answer
+        if data["type"] != "control":
+            _log_message(
+                UseinfoValidation(
+                    event="sendmessage",
+                    act=f"to:{partner}:{data['message']}",
+                    div_id=data["div_id"],
+                    course_id=data["course_name"],
+                    sid=mess_from,
+                    timestamp=datetime.utcnow(),
+                )
+            )
+
+
+# The tasks logging chat messages; holding a reference keeps each from being garbage collected before it finishes.
+_log_tasks: Set[asyncio.Task] = set()
+
+
+# Log a chat message through the `ingest pipeline <../internal/ingest.py>`, in the background, so that the subscriber doesn't wait for the database.
+def _log_message(useinfo_entry: UseinfoValidation) -> None:
+    async def log() -> None:
+        try:
+            await ingest_pipeline.add_useinfo(useinfo_entry)
+        except Exception as e:
+            rslogger.error(f"{os.getpid()}: Unable to log {useinfo_entry}: {e}")
+
+    task = asyncio.create_task(log())
+    _log_tasks.add(task)
+    task.add_done_callback(_log_tasks.discard)
+
+
 # It seems that ``@router.websocket`` is much better than the documented
 # ``websocket_route``
 @router.websocket("/chat/{uname}/ws")
@@ -142,131 +311,36 @@ async def websocket_endpoint(websocket: WebSocket, uname: str):
     The browser and the server.  The websocket is persistent as long
     as the process that runs this endpoint is alive.
 
-    Note: This function must return which means it must be throroughly async
-    Using a non async library like plain redis-py will not work as the subscriber
-    will block
+    Messages for this user are delivered by this worker's subscriber task;
+    this endpoint only registers the websocket, then waits for it to close.
     """
     rslogger.debug(f"{os.getpid()}: IN WEBSOCKET {uname=}")
     username = uname
     # local_users is a global/module variable shared by all  requests served
     # by the same worker process.
     local_users.add(username)
-    await manager.connect(username, websocket)
-    r = aioredis.from_url(settings.redis_uri)
-    subscriber = r.pubsub()
-
-    async def my_get_message():
-        return await subscriber.get_message(timeout=1.0, ignore_subscribe_messages=True)
-
-    await subscriber.subscribe("peermessages")
-
-    # multi_await `Docs and links here <http://www.hydrogen18.com/blog/python-await-multiple.html>`_ acts like
-    # the generic sockets select statement, returning a result from get as soon
-    # as ANY of our async functions have a result available.
-    async with multi_await() as mawait:
-        mawait.add(my_get_message)
-        mawait.add(websocket.receive_text)
-
+    # Record the user's current course, so that broadcasts to a course reach only its students.
+    try:
+        course_name = (await fetch_user(username)).course_name
+    except Exception as e:
+        rslogger.debug(f"{os.getpid()}: Unable to find the course of {username}: {e}")
+        course_name = None
+    await manager.connect(username, websocket, course_name)
+    _start_listener()
+
+    try:
         while True:
-            # Wait for something to happen
-            # get returns two lists one of completions and one of failures
-            complete, failures = await mawait.get()
-            # i == 0 --> pubsub message
-            # i == 1 --> websocket message
-            pmess, wsres = complete
-            psfail, wsfail = failures
-
-            if wsfail is not None:
-                rslogger.error(wsfail)
-                # The fail is more than likely a runtime error from a page close or refresh
-                # RuntimeError('Cannot call "receive" once a disconnect message has been received.')
-                manager.disconnect(username)
-                return
-
-            if psfail is not None:
-                rslogger.error(psfail)
-                # probably do not want to return
-
-            # handle message from the pubsub queue
-            if pmess is not None:
-                rslogger.debug(f"{os.getpid()}: {pmess=}")
-                if pmess["type"] == "message":
-                    # This is a message sent into the channel, our stuff is in
-                    # the ``data`` field of the redis message
-                    data = json.loads(pmess["data"])
-                else:
-                    rslogger.error(
-                        f"{os.getpid()}: unknown message type {pmess['type']}"
-                    )
-                    continue
-                if data["broadcast"]:
-                    await manager.broadcast(data)
-                else:
-                    # because **every** connection runs this same loop
-                    # we only want to send a non-broadcast message if
-                    # it is to **ourself**. So the to in the message should be username
-                    # check to see
-                    mess_from = data["from"]
-                    partner_list = await r.hget(
-                        f"partnerdb_{data['course_name']}", mess_from
-                    )
-                    if partner_list:
-                        partner_list = json.loads(partner_list)
-                    else:
-                        try:
-                            mess = {
-                                "type": "text",
-                                "from": mess_from,
-                                "message": "Could not find a partner for you",
-                                "time": time.time(),
-                                "broadcast": False,
-                                "course_name": data["course_name"],
-                                "div_id": data["div_id"],
-                            }
-                            await manager.send_personal_message(mess_from, mess)
-                        except KeyError:
-                            rslogger.error(
-                                f"Not enough data to construct a message: {data}"
-                            )
-
-                        rslogger.error(
-                            f"{os.getpid()}: Failed to find a partner for {mess_from}"
-                        )
-                    if (
-                        data["message"] == "enableChat"
-                        and data.get("to", None) == username
-                    ):
-                        await manager.send_personal_message(username, data)
-                    elif data["message"] != "enableChat" and username in partner_list:
-                        await manager.send_personal_message(username, data)
-                        # log the message
-                        # todo - we should not log messages that are 'control' messages
-                        # These individual control messages update partner and answer
-                        if data["type"] != "control":
-                            await create_useinfo_entry(
-                                UseinfoValidation(
-                                    event="sendmessage",
-                                    act=f"to:{username}:{data['message']}",
-                                    div_id=data["div_id"],
-                                    course_id=data["course_name"],
-                                    sid=mess_from,
-                                    timestamp=datetime.utcnow(),
-                                )
-                            )
-                    else:
-                        rslogger.debug(f"{os.getpid()}: {mess_from=} is not {username}")
-
-            if wsres is not None:
-                rslogger.debug(
-                    f"{os.getpid()}: We don't expect in coming websock messages but got: {wsres}"
-                )
-                # TODO: now that we have multi-await working it *may* be more
-                # efficient to go back to sending all peer messages by websocket
-                # and putting them into the subscriber queue here rather than
-                # having a separate endpoint.
+            wsres = await websocket.receive_text()
+            rslogger.debug(
+                f"{os.getpid()}: We don't expect in coming websock messages but got: {wsres}"
+            )
+    except (WebSocketDisconnect, RuntimeError) as e:
+        # The disconnect is more than likely from a page close or refresh.
+        rslogger.debug(f"{os.getpid()}: {username} disconnected: {e!r}")
+    finally:
+        manager.disconnect(username, websocket)
 
 
 @router.post("/send_message")
 async def send_message(packet: PeerMessage):
-    r = await aioredis.from_url(settings.redis_uri)
-    r.publish("peermessages", packet.json())
+    await get_redis().publish("peermessages", packet.json())
@@ -0,0 +1,50 @@
+# *****************************************
+# |docname| - Report metrics for monitoring
+# *****************************************
+# Report the metrics of the worker process which answers the request: its database pool and crud functions (see `../internal/db_metrics.py`), its caches (see `../internal/cache.py`), and its `write-behind ingestion pipeline <../internal/ingest.py>`. Since each worker has its own pool and caches, the response includes the worker's process ID; poll repeatedly to sample every worker.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import os
+
+# Third-party imports
+# -------------------
+from fastapi import APIRouter, Depends, Request, status
+
+# Local application imports
+# -------------------------
+from ..db import engine
+from ..internal.cache import cache_stats
+from ..internal.db_metrics import db_stats
+from ..internal.ingest import ingest_pipeline
+from ..internal.utils import make_json_response
+from ..session import auth_manager, is_instructor
+
+
+# Routing
+# =======
+# See `APIRouter config` for an explanation of this approach.
+router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"],
+)
+
+
+@router.get("/")
+async def get_metrics(request: Request, user=Depends(auth_manager)):
+    if not await is_instructor(request):
+        return make_json_response(
+            status=status.HTTP_401_UNAUTHORIZED, detail="not an instructor"
+        )
+    return make_json_response(
+        detail=dict(
+            pid=os.getpid(),
+            db=db_stats(engine),
+            caches=cache_stats(),
+            ingest=ingest_pipeline.stats(),
+        )
+    )
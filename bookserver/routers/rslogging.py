@@ -10,8 +10,10 @@
 #
 # Standard library
 # ----------------
+import asyncio
 import json
 from datetime import datetime, timedelta
+from functools import lru_cache
 import re
 from typing import Optional
 
@@ -29,15 +31,16 @@ from fastapi import (
     UploadFile,
 )
 import boto3
+from boto3.s3.transfer import TransferConfig
 import botocore
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 
 # Local application imports
 # -------------------------
 from ..applogger import rslogger
 from ..config import settings
 from ..crud import (
-    create_answer_table_entry,
     create_code_entry,
     create_useinfo_entry,
     create_user_chapter_progress_entry,
@@ -47,7 +50,6 @@ from ..crud import (
     EVENT2TABLE,
     delete_one_user_topic_practice,
     fetch_last_page,
-    fetch_chapter_for_subchapter,
     fetch_course,
     fetch_course_practice,
     fetch_one_user_topic_practice,
@@ -59,6 +61,13 @@ from ..crud import (
     update_sub_chapter_progress,
     update_user_state,
 )
+from ..internal.activity import record_interaction
+from ..internal.answer_counts import record_answer
+from ..internal.fitb_top_answers import record_fitb_answer
+from ..internal.poll_tally import record_vote
+from ..internal.book_index import get_book_index
+from ..internal.ingest import ingest_pipeline
+from ..internal.lp_builds import fetch_build_result
 from ..internal.utils import make_json_response
 from ..models import (
     AuthUserValidator,
@@ -126,7 +135,10 @@ async def log_book_event(
     useinfo_dict["act"] = useinfo_dict["act"][:512]
     useinfo_entry = UseinfoValidation(**useinfo_dict)
     rslogger.debug(useinfo_entry)
-    idx = await create_useinfo_entry(useinfo_entry)
+    # Queue the rows for this event, then wait for them together below; see `../internal/ingest.py`.
+    useinfo_stored = await ingest_pipeline.queue_useinfo(useinfo_entry)
+    answer_stored = None
+    valid_table = None
     response_dict = dict(timestamp=entry.timestamp)
     if entry.event in EVENT2TABLE:
         create_answer_table = True
@@ -134,6 +146,8 @@ async def log_book_event(
         if entry.event == "unittest":
             # info we need looks like: "act":"percent:100.0:passed:2:failed:0"
             if not re.match(r"^percent:\d+(\.\d+)?:passed:\d+:failed:\d+$", entry.act):
+                await ingest_pipeline.wait(useinfo_stored)
+                await _record_useinfo(entry, useinfo_entry)
                 return make_json_response(
                     status=status.HTTP_422_UNPROCESSABLE_ENTITY,
                     detail="act is not in the correct format",
@@ -154,18 +168,58 @@ async def log_book_event(
         if create_answer_table:
             valid_table = rcd.validator.from_orm(entry)  # type: ignore
             # Do server-side grading if needed.
-            if feedback := await is_server_feedback(entry.div_id, user.course_name):
+            if feedback := await is_server_feedback(
+                entry.div_id, user.course_name, entry.event
+            ):
                 # The grader should also be defined if there's feedback.
                 assert rcd.grader
                 response_dict.update(await rcd.grader(valid_table, feedback))
 
-            ans_idx = await create_answer_table_entry(valid_table, entry.event)
-            rslogger.debug(ans_idx)
+            answer_stored = await ingest_pipeline.queue_answer(valid_table, entry.event)
 
-    if idx:
-        return make_json_response(status=status.HTTP_201_CREATED, detail=response_dict)
-    else:
-        return make_json_response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    await ingest_pipeline.wait(useinfo_stored, answer_stored)
+    # Update the Redis caches only for rows which were stored; if storing failed, ``wait`` raised above.
+    await _record_useinfo(entry, useinfo_entry)
+    if entry.event == "fillb" and valid_table:
+        await record_fitb_answer(
+            valid_table.course_name, valid_table.div_id, valid_table.answer
+        )
+    return make_json_response(status=status.HTTP_201_CREATED, detail=response_dict)
+
+
+# Update the Redis caches (see `../internal/activity.py`, `../internal/answer_counts.py`, and `../internal/poll_tally.py`) which count a stored ``useinfo`` row.
+async def _record_useinfo(
+    entry: LogItemIncoming, useinfo_entry: UseinfoValidation
+) -> None:
+    await record_interaction(useinfo_entry.course_id, entry.sid, entry.div_id)
+    if entry.event == "mChoice":
+        await record_answer(
+            useinfo_entry.course_id,
+            entry.div_id,
+            useinfo_entry.act,
+            entry.timestamp,
+        )
+    elif entry.event == "poll":
+        await record_vote(
+            useinfo_entry.course_id, entry.div_id, entry.sid, useinfo_entry.act
+        )
+
+
+# lp_build endpoint
+# -----------------
+# When a literate programming build takes too long, `log_book_event <log_book_event endpoint>` returns a ``build_id`` instead of the build's results; see `../internal/lp_builds.py`. The client polls this endpoint, which returns a 202 while the build runs, then the response ``log_book_event`` would have returned.
+@router.get("/lp_build/{build_id}")
+async def get_lp_build(build_id: str, user=Depends(auth_manager)):
+    record = await fetch_build_result(build_id)
+    if not record or record["sid"] != user.username:
+        return make_json_response(
+            status=status.HTTP_404_NOT_FOUND, detail="no such build"
+        )
+    if record["pending"]:
+        return make_json_response(
+            status=status.HTTP_202_ACCEPTED, detail=dict(build_id=build_id)
+        )
+    return make_json_response(detail=record["response"])
 
 
 @router.post("/set_tz_offset")
@@ -227,6 +281,7 @@ async def runlog(request: Request, response: Response, data: LogRunIncoming):
             useinfo_dict["event"] = "activecode"
 
     await create_useinfo_entry(UseinfoValidation(**useinfo_dict))
+    await record_interaction(data.course, data.sid, data.div_id)
 
     # Now add an entry to the code table - in the code table we use the name
     # acid (activecode id) instead of div_id -- just to be difficult
@@ -307,9 +362,8 @@ async def updatelastpage(
         # we can look it up from the chapter and subchapter tables.
         if request_data.is_ptx_book:
             course_row = await fetch_course(user.course_name)
-            chapter = await fetch_chapter_for_subchapter(
-                subchapter, course_row.base_course
-            )
+            book_index = await get_book_index(course_row.base_course)
+            chapter = book_index.chapter_for(subchapter)
             rslogger.debug(
                 f"Got Chapter {chapter} for {subchapter} in {course_row.base_course}"
             )
@@ -396,9 +450,8 @@ async def getCompletionStatus(request: Request, lastPageUrl: str, isPtxBook: boo
         if isPtxBook:
             rslogger.debug(f"completion status for PTX book {lastPageUrl}")
             course_row = await fetch_course(request.state.user.course_name)
-            last_page_chapter = await fetch_chapter_for_subchapter(
-                last_page_subchapter, course_row.base_course
-            )
+            book_index = await get_book_index(course_row.base_course)
+            last_page_chapter = book_index.chapter_for(last_page_subchapter)
         else:
             last_page_chapter = lastPageUrl.split("/")[-2]
         result = await fetch_user_sub_chapter_progress(
@@ -494,33 +547,62 @@ async def getlastpage(request: Request, course: str):
 # The files should be stored in their bucket -- stored in Environment
 # using coursename/student_id/div_id_filename.ext
 # this will allow for easy recovery.
-@router.post("/upload/{div_id:str}")
-async def create_upload_file(request: Request, file: UploadFile, div_id: str):
+#
+# Files larger than ``settings.upload_chunk_size`` are sent as a multipart upload, with up to ``settings.upload_part_concurrency`` parts sent at once.
+_transfer_config = TransferConfig(
+    multipart_threshold=settings.upload_chunk_size,
+    multipart_chunksize=settings.upload_chunk_size,
+    max_concurrency=settings.upload_part_concurrency,
+)
 
-    if not request.state.user:
-        raise HTTPException(401)
 
+# boto3 clients are thread safe and expensive to create, so share one client per process. Its connection pool must hold a connection for every part of every upload which may be in progress at once; otherwise, parts wait for connections.
+@lru_cache(maxsize=1)
+def get_s3_client():
     session = boto3.session.Session()
-    client = session.client(
+    return session.client(
         "s3",
-        config=botocore.config.Config(s3={"addressing_style": "virtual"}),
+        config=botocore.config.Config(
+            s3={"addressing_style": settings.spaces_addressing_style.value},
+            max_pool_connections=settings.upload_concurrency
+            * settings.upload_part_concurrency,
+        ),
         region_name=settings.region,
-        endpoint_url="https://nyc3.digitaloceanspaces.com",
+        endpoint_url=settings.spaces_endpoint_url,
         aws_access_key_id=settings.spaces_key,
         aws_secret_access_key=settings.spaces_secret,
     )
 
-    contents = await file.read()  # these contents are bytes not a string
+
+# boto3 is synchronous, so uploads run in the threadpool. Limit how many run at once, so that uploads can't occupy every thread. This is created on first use, since it must belong to the running event loop.
+_upload_semaphore: Optional[asyncio.Semaphore] = None
+
+
+@router.post("/upload/{div_id:str}")
+async def create_upload_file(request: Request, file: UploadFile, div_id: str):
+    global _upload_semaphore
+
+    if not request.state.user:
+        raise HTTPException(401)
 
     # create the file Key
     fkey = f"{request.state.user.course_name}/{div_id}/{request.state.user.username}/{file.filename}"
     rslogger.debug("file key = {fkey} {settings.spaces_key} {settings.spaces_secret}")
-    client.put_object(
-        Bucket=settings.bucket,
-        Key=fkey,
-        Body=contents,
-        ACL="private",
-        Metadata={"x-amz-meta-my-key": "your-value"},
-    )
+    # Stream the upload from its spool file instead of reading it into memory.
+    await file.seek(0)
+    if _upload_semaphore is None:
+        _upload_semaphore = asyncio.Semaphore(settings.upload_concurrency)
+    async with _upload_semaphore:
+        await run_in_threadpool(
+            get_s3_client().upload_fileobj,
+            file.file,
+            settings.bucket,
+            fkey,
+            ExtraArgs=dict(
+                ACL="private",
+                Metadata={"x-amz-meta-my-key": "your-value"},
+            ),
+            Config=_transfer_config,
+        )
 
     return {"filename": file.filename}
@@ -15,7 +15,7 @@
 #
 # Standard library
 # ----------------
-from typing import Awaitable, Callable, cast
+from typing import Awaitable, Callable, Optional, cast
 
 # Third-party imports
 # -------------------
@@ -28,6 +28,7 @@ from fastapi_login import LoginManager
 from .config import settings
 from .crud import fetch_instructor_courses, fetch_user
 from .applogger import rslogger
+from .internal.cache import AsyncTTLCache, cache_ttl
 from .models import AuthUserValidator
 
 
@@ -49,11 +50,40 @@ async def _load_user(user_id: str) -> AuthUserValidator:
 load_user = cast(Callable[[str], Awaitable[AuthUserValidator]], _load_user)
 
 
+# Instructor status
+# =================
+# Pages and grading endpoints check instructor status on nearly every call. Cache the result per (user id, course id). The web2py server manages the ``course_instructor`` table, so a change there takes effect here once the entry expires, after ``settings.instructor_cache_ttl`` seconds; this includes the instructor-only paths of endpoints such as ``get_history``.
+_instructor_cache: AsyncTTLCache[bool] = AsyncTTLCache(
+    "instructors",
+    cache_ttl(settings.instructor_cache_ttl),
+    settings.instructor_cache_size,
+)
+
+
 async def is_instructor(request: Request) -> bool:
     user = request.state.user
     if user is None:
         raise HTTPException(401)
-    elif len(await fetch_instructor_courses(user.id, user.course_id)) > 0:
-        return True
-    else:
-        return False
+    # Reuse the answer if another dependency already asked during this request.
+    memo = getattr(request.state, "_is_instructor", None)
+    if memo is None:
+        memo = await _instructor_cache.get_or_load(
+            (user.id, user.course_id),
+            lambda: _fetch_is_instructor(user.id, user.course_id),
+        )
+        request.state._is_instructor = memo
+    return memo
+
+
+async def _fetch_is_instructor(user_id: int, course_id: int) -> bool:
+    return len(await fetch_instructor_courses(user_id, course_id)) > 0
+
+
+# Forget the cached status of a user in a course. Omit ``course_id`` to forget the user's status in every course, ``user_id`` to forget every user's status in the course, or both to forget everything. Code in this server which changes ``course_instructor`` must call this. It affects only this process; other workers see the change once their entries expire.
+def invalidate_instructor(
+    user_id: Optional[int] = None, course_id: Optional[int] = None
+) -> None:
+    _instructor_cache.invalidate_where(
+        lambda key, _: (user_id is None or key[0] == user_id)
+        and (course_id is None or key[1] == course_id)
+    )
@@ -0,0 +1,134 @@
+# *************************************
+# |docname| - test the in-process cache
+# *************************************
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import asyncio
+
+# Third-party imports
+# -------------------
+import pytest
+
+# Local application imports
+# -------------------------
+from bookserver.internal.cache import AsyncTTLCache
+from bookserver.session import _instructor_cache, invalidate_instructor
+
+
+# Support
+# =======
+# Return a loader which counts how many times it's called.
+def counting_loader(value, delay=0):
+    calls = []
+
+    async def loader():
+        calls.append(None)
+        await asyncio.sleep(delay)
+        return value
+
+    return loader, calls
+
+
+# Tests
+# =====
+@pytest.mark.asyncio
+async def test_hit_and_miss():
+    cache = AsyncTTLCache("test_hit_and_miss", 60, 10)
+    loader, calls = counting_loader("value")
+    assert await cache.get_or_load("key", loader) == "value"
+    assert await cache.get_or_load("key", loader) == "value"
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    cache = AsyncTTLCache("test_single_flight", 60, 10)
+    loader, calls = counting_loader("value", 0.05)
+    results = await asyncio.gather(
+        *[cache.get_or_load("key", loader) for _ in range(5)]
+    )
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_expiry_and_lru():
+    cache = AsyncTTLCache("test_expiry_and_lru", 0.05, 2)
+    for key in "abc":
+        loader, _ = counting_loader(key)
+        await cache.get_or_load(key, loader)
+    # The least recently used entry was evicted.
+    assert len(cache) == 2
+    loader, calls = counting_loader("a")
+    await cache.get_or_load("a", loader)
+    assert len(calls) == 1
+
+    await asyncio.sleep(0.1)
+    loader, calls = counting_loader("c")
+    await cache.get_or_load("c", loader)
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_invalidate():
+    cache = AsyncTTLCache("test_invalidate", 60, 10)
+    loader, calls = counting_loader("value")
+    await cache.get_or_load("key", loader)
+    cache.invalidate("key")
+    await cache.get_or_load("key", loader)
+    assert len(calls) == 2
+
+    # A load in progress during an invalidation isn't stored.
+    slow_loader, slow_calls = counting_loader("old", 0.05)
+    task = asyncio.create_task(cache.get_or_load("other", slow_loader))
+    await asyncio.sleep(0)
+    cache.invalidate("other")
+    assert await task == "old"
+    loader, calls = counting_loader("new")
+    assert await cache.get_or_load("other", loader) == "new"
+
+
+@pytest.mark.asyncio
+async def test_errors_not_cached():
+    cache = AsyncTTLCache("test_errors_not_cached", 60, 10)
+
+    async def failing_loader():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        await cache.get_or_load("key", failing_loader)
+    loader, calls = counting_loader("value")
+    assert await cache.get_or_load("key", loader) == "value"
+
+
+@pytest.mark.asyncio
+async def test_invalidate_instructor(monkeypatch):
+    # Caches of database rows are disabled when testing; enable this one.
+    monkeypatch.setattr(_instructor_cache, "ttl", 60)
+    monkeypatch.setattr(_instructor_cache, "negative_ttl", 60)
+
+    async def fill():
+        _instructor_cache.clear()
+        for user_id in (1, 2):
+            for course_id in (10, 20):
+                loader, _ = counting_loader(True)
+                await _instructor_cache.get_or_load((user_id, course_id), loader)
+
+    await fill()
+    invalidate_instructor(1, 10)
+    assert sorted(_instructor_cache._data) == [(1, 20), (2, 10), (2, 20)]
+    await fill()
+    invalidate_instructor(1)
+    assert sorted(_instructor_cache._data) == [(2, 10), (2, 20)]
+    await fill()
+    invalidate_instructor(course_id=20)
+    assert sorted(_instructor_cache._data) == [(1, 10), (2, 10)]
+    await fill()
+    invalidate_instructor()
+    assert len(_instructor_cache) == 0
@@ -0,0 +1,161 @@
+# ************************************************
+# |docname| - test the request-scoped unit of work
+# ************************************************
+# These tests send requests through `RequestSessionMiddleware <../bookserver/db.py>` to small apps which write to the test database.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import datetime
+
+# Third-party imports
+# -------------------
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+import httpx
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+# Local application imports
+# -------------------------
+from bookserver import db
+from bookserver.config import DatabaseType, settings
+from bookserver.crud import count_useinfo_for, create_useinfo_entry
+from bookserver.db import RequestSessionMiddleware, db_transaction
+from bookserver.models import Useinfo, UseinfoValidation
+
+
+# Support
+# =======
+def useinfo(course_name, div_id, sid="test_user_1"):
+    return UseinfoValidation(
+        timestamp=datetime.datetime.utcnow(),
+        sid=sid,
+        event="page",
+        act="view",
+        div_id=div_id,
+        course_id=course_name,
+    )
+
+
+# Return the number of ``useinfo`` rows stored for ``div_id``.
+async def count_useinfo(course_name, div_id):
+    rows = await count_useinfo_for(div_id, course_name, datetime.datetime(2000, 1, 1))
+    return sum(count for act, count in rows)
+
+
+# Provide sessions from an engine which supports savepoints. The pysqlite driver (which aiosqlite wraps) starts transactions itself and ignores ``SAVEPOINT``, so, per the SQLAlchemy docs on `serializable isolation / savepoints <https://docs.sqlalchemy.org/en/14/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl>`_, let SQLAlchemy emit ``BEGIN`` instead.
+@pytest.fixture
+async def savepoint_engine(bookserver_session, monkeypatch):
+    engine = create_async_engine(settings.database_url)
+    if settings.database_type == DatabaseType.SQLite:
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def do_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine.sync_engine, "begin")
+        def do_begin(conn):
+            conn.exec_driver_sql("BEGIN")
+
+    monkeypatch.setattr(
+        db,
+        "async_session",
+        sessionmaker(engine, class_=AsyncSession, expire_on_commit=False),
+    )
+    monkeypatch.setattr(settings, "db_request_session", True)
+    yield engine
+    await engine.dispose()
+
+
+# Provide a client for ``app``, wrapped in the middleware.
+def client_for(app):
+    app.add_middleware(RequestSessionMiddleware)
+    return httpx.AsyncClient(app=app, base_url="http://test")
+
+
+# Tests
+# =====
+# A failing ``db_transaction`` block undoes only its own writes; the request's other writes are committed.
+async def test_savepoint_rollback(savepoint_engine, test_course_1):
+    course_name = test_course_1.course_name
+    app = FastAPI()
+
+    @app.post("/log")
+    async def log():
+        await create_useinfo_entry(useinfo(course_name, "savepoint"))
+        with pytest.raises(IntegrityError):
+            async with db_transaction() as session:
+                session.add(Useinfo(**useinfo(course_name, "savepoint").dict()))
+                # A missing ``sid`` violates a constraint.
+                session.add(
+                    Useinfo(**dict(useinfo(course_name, "savepoint").dict(), sid=None))
+                )
+        await create_useinfo_entry(useinfo(course_name, "savepoint"))
+        return "ok"
+
+    async with client_for(app) as client:
+        assert (await client.post("/log")).status_code == 200
+    assert await count_useinfo(course_name, "savepoint") == 2
+
+
+# An error before the response starts rolls back the request's writes. Once the response starts, its writes are committed; an error after this commits nothing more.
+async def test_error_rolls_back(savepoint_engine, test_course_1):
+    course_name = test_course_1.course_name
+    app = FastAPI()
+
+    @app.post("/before")
+    async def before():
+        await create_useinfo_entry(useinfo(course_name, "before"))
+        raise RuntimeError("before the response")
+
+    @app.post("/after")
+    async def after():
+        await create_useinfo_entry(useinfo(course_name, "after"))
+
+        async def body():
+            yield b"partial"
+            async with db_transaction() as session:
+                session.add(Useinfo(**useinfo(course_name, "after").dict()))
+                raise RuntimeError("after the response")
+
+        return StreamingResponse(body())
+
+    async with client_for(app) as client:
+        with pytest.raises(RuntimeError, match="before the response"):
+            await client.post("/before")
+        with pytest.raises(RuntimeError, match="after the response"):
+            await client.post("/after")
+    assert await count_useinfo(course_name, "before") == 0
+    assert await count_useinfo(course_name, "after") == 1
+
+
+# With a read replica, a request which writes marks its client with the ``RS_primary`` cookie; one which only reads doesn't.
+async def test_primary_cookie(savepoint_engine, test_course_1, monkeypatch):
+    course_name = test_course_1.course_name
+    monkeypatch.setattr(db, "replica_engine", savepoint_engine)
+    monkeypatch.setattr(db, "replica_session", db.async_session)
+    app = FastAPI()
+
+    @app.post("/write")
+    async def write():
+        await create_useinfo_entry(useinfo(course_name, "cookie"))
+        return "ok"
+
+    @app.get("/read")
+    async def read():
+        return await count_useinfo(course_name, "cookie")
+
+    async with client_for(app) as client:
+        r = await client.get("/read")
+        assert r.json() == 0
+        assert "RS_primary" not in r.cookies
+        r = await client.post("/write")
+        assert r.cookies["RS_primary"] == "1"
+        assert f"Max-Age={int(settings.replica_max_lag) + 1}" in r.headers["set-cookie"]
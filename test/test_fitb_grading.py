@@ -0,0 +1,62 @@
+# **************************************************
+# |docname| - test grading fill-in-the-blank answers
+# **************************************************
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import json
+
+# Third-party imports
+# -------------------
+import pytest
+
+# Local application imports
+# -------------------------
+from bookserver.internal.feedback import FITBGrader, fitb_feedback, grade_fitb_batch
+
+
+# Support
+# =======
+# Feedback for a question with one blank, whose correct answer is ``x``.
+@pytest.fixture
+def grader():
+    return FITBGrader(
+        [[{"regex": "^x$", "regexFlags": "", "feedback": "ok"}, {"feedback": "no"}]]
+    )
+
+
+class Validator:
+    def __init__(self, answer):
+        self.answer = answer
+        self.correct = None
+        self.percent = None
+
+
+# Tests
+# =====
+def test_grade_batch(grader):
+    assert grade_fitb_batch(grader, [json.dumps(["x"]), json.dumps(["y"]), "x"]) == [
+        dict(correct=True, percent=1.0),
+        dict(correct=False, percent=0.0),
+        # The old, comma-separated format.
+        dict(correct=True, percent=1.0),
+    ]
+
+
+# Older rows may store a NULL answer; regrading must keep its grade instead of failing the whole batch.
+def test_grade_batch_null_answer(grader):
+    assert grade_fitb_batch(grader, [None, json.dumps(["x"])]) == [
+        {},
+        dict(correct=True, percent=1.0),
+    ]
+
+
+async def test_feedback_missing_answer(grader):
+    validator = Validator(None)
+    result = await fitb_feedback(validator, grader)
+    assert (validator.correct, validator.percent) == (False, 0)
+    assert result["correct"] is False
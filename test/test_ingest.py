@@ -0,0 +1,249 @@
+# *************************************************
+# |docname| - test the write-behind ingest pipeline
+# *************************************************
+# These tests drive the real `pipeline <../bookserver/internal/ingest.py>` against the test database.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import asyncio
+import datetime
+import json
+
+# Third-party imports
+# -------------------
+from fastapi import FastAPI
+import httpx
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import text
+
+# Local application imports
+# -------------------------
+from bookserver import db
+from bookserver.config import DatabaseType, IngestAck, settings
+from bookserver.crud import count_fitb_answers, count_useinfo_for, create_many_entries
+from bookserver.db import RequestSessionMiddleware, db_session
+from bookserver.internal import ingest
+from bookserver.internal.ingest import IngestPipeline
+from bookserver.models import FitbAnswers, Useinfo, UseinfoValidation
+
+
+# Support
+# =======
+def useinfo(course_name, div_id, sid="test_user_1"):
+    return UseinfoValidation(
+        timestamp=datetime.datetime.utcnow(),
+        sid=sid,
+        event="page",
+        act="view",
+        div_id=div_id,
+        course_id=course_name,
+    )
+
+
+# Return the number of ``useinfo`` rows stored for ``div_id``.
+async def count_useinfo(course_name, div_id):
+    rows = await count_useinfo_for(div_id, course_name, datetime.datetime(2000, 1, 1))
+    return sum(count for act, count in rows)
+
+
+# Tests
+# =====
+# Each database uses a different form of bulk insert; check both forms on the test database.
+@pytest.mark.parametrize(
+    "database_type", [DatabaseType.SQLite, DatabaseType.PostgreSQL]
+)
+async def test_create_many_entries(
+    bookserver_session, test_course_1, monkeypatch, database_type
+):
+    # ``database_type`` is a property, derived from the database URL.
+    monkeypatch.setattr(
+        type(settings), "database_type", property(lambda self: database_type)
+    )
+    course_name = test_course_1.course_name
+    useinfo_rows = [useinfo(course_name, "bulk", f"sid_{i}").dict() for i in range(5)]
+    for row in useinfo_rows:
+        row.pop("id")
+    fitb_rows = [
+        dict(
+            timestamp=datetime.datetime.utcnow(),
+            div_id="bulk",
+            sid=f"sid_{i}",
+            course_name=course_name,
+            answer=json.dumps([str(i % 2)]),
+            correct=False,
+            percent=0,
+        )
+        for i in range(3)
+    ]
+    await create_many_entries({Useinfo: useinfo_rows, FitbAnswers: fitb_rows})
+
+    assert await count_useinfo(course_name, "bulk") == 5
+    assert sorted(await count_fitb_answers(test_course_1, "bulk")) == [
+        ('["0"]', 2),
+        ('["1"]', 1),
+    ]
+
+
+# Rows queued together are written in batches of at most ``batch_size`` rows.
+async def test_batching(bookserver_session, test_course_1):
+    course_name = test_course_1.course_name
+    pipeline = IngestPipeline(IngestAck.flush, 5, 0.2, 100)
+    pipeline.start()
+    try:
+        futures = [
+            await pipeline.queue_useinfo(useinfo(course_name, "batch", f"sid_{i}"))
+            for i in range(12)
+        ]
+        await asyncio.wait_for(pipeline.wait(*futures), 5)
+        assert (pipeline.batches_written, pipeline.rows_written) == (3, 12)
+    finally:
+        await pipeline.drain()
+    assert await count_useinfo(course_name, "batch") == 12
+
+
+# A bad row fails its batch; the other rows are then written one at a time, and only the bad row's request sees the error.
+async def test_row_by_row_retry(bookserver_session, test_course_1):
+    course_name = test_course_1.course_name
+    pipeline = IngestPipeline(IngestAck.flush, 10, 0.05, 100)
+    pipeline.start()
+    bad_row = UseinfoValidation.construct(
+        **dict(useinfo(course_name, "retry").dict(), sid=None)
+    )
+    try:
+        good_1 = await pipeline.queue_useinfo(useinfo(course_name, "retry"))
+        bad = await pipeline.queue_useinfo(bad_row)
+        good_2 = await pipeline.queue_useinfo(useinfo(course_name, "retry"))
+        await asyncio.wait_for(pipeline.wait(good_1, good_2), 5)
+        with pytest.raises(IntegrityError):
+            await asyncio.wait_for(pipeline.wait(bad), 5)
+        assert (pipeline.rows_written, pipeline.rows_failed) == (2, 1)
+    finally:
+        await pipeline.drain()
+    assert await count_useinfo(course_name, "retry") == 2
+
+
+# An unexpected error in the writer must fail the waiting requests, not leave them waiting forever.
+async def test_writer_error(bookserver_session, test_course_1, monkeypatch):
+    pipeline = IngestPipeline(IngestAck.flush, 10, 0.05, 100)
+
+    async def broken_flush(batch):
+        raise RuntimeError("broken flush")
+
+    monkeypatch.setattr(pipeline, "_flush", broken_flush)
+    pipeline.start()
+    try:
+        future = await pipeline.queue_useinfo(
+            useinfo(test_course_1.course_name, "broken")
+        )
+        with pytest.raises(RuntimeError, match="broken flush"):
+            await asyncio.wait_for(pipeline.wait(future), 5)
+    finally:
+        await pipeline.drain()
+
+
+# Once ``max_queue`` rows are waiting, queueing another row waits for room.
+async def test_backpressure(bookserver_session, test_course_1, monkeypatch):
+    course_name = test_course_1.course_name
+    # Hold the writer in its first flush until released.
+    release = asyncio.Event()
+
+    async def slow_create_many_entries(entries):
+        await release.wait()
+        await create_many_entries(entries)
+
+    monkeypatch.setattr(ingest, "create_many_entries", slow_create_many_entries)
+    pipeline = IngestPipeline(IngestAck.enqueue, 1, 0, 2)
+    pipeline.start()
+    try:
+        # The writer takes this row, then waits.
+        await pipeline.queue_useinfo(useinfo(course_name, "backpressure"))
+        await asyncio.sleep(0.1)
+        # These fill the queue.
+        for _ in range(2):
+            await pipeline.queue_useinfo(useinfo(course_name, "backpressure"))
+        blocked = asyncio.create_task(
+            pipeline.queue_useinfo(useinfo(course_name, "backpressure"))
+        )
+        await asyncio.sleep(0.1)
+        assert not blocked.done()
+
+        release.set()
+        await asyncio.wait_for(blocked, 5)
+    finally:
+        release.set()
+        await pipeline.drain()
+    assert pipeline.rows_written == 4
+    assert await count_useinfo(course_name, "backpressure") == 4
+
+
+# On shutdown, ``drain`` writes every queued row; later rows are written directly.
+async def test_drain(bookserver_session, test_course_1):
+    course_name = test_course_1.course_name
+    pipeline = IngestPipeline(IngestAck.enqueue, 100, 0.2, 100)
+    pipeline.start()
+    for _ in range(3):
+        assert await pipeline.queue_useinfo(useinfo(course_name, "drain")) is None
+    await asyncio.wait_for(pipeline.drain(), 5)
+    assert pipeline.rows_written == 3
+    assert await count_useinfo(course_name, "drain") == 3
+
+    await pipeline.add_useinfo(useinfo(course_name, "drain"))
+    assert pipeline.rows_written == 3
+    assert await count_useinfo(course_name, "drain") == 4
+
+
+# In flush-ack mode, each request waits for the writer to commit its rows. Saturate a small pool with requests which each hold a connection (as the auth lookup does) before logging; the writer must still get a connection, instead of waiting for the pool timeout.
+async def test_flush_ack_pool_saturation(
+    bookserver_session, test_course_1, monkeypatch
+):
+    pool_size, max_overflow, pool_timeout = 2, 1, 10
+    pool_engine = create_async_engine(
+        settings.database_url,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+    )
+    monkeypatch.setattr(
+        db,
+        "async_session",
+        sessionmaker(pool_engine, class_=AsyncSession, expire_on_commit=False),
+    )
+    pipeline = IngestPipeline(IngestAck.flush, 200, 0.05, 100)
+    pipeline.start()
+
+    app = FastAPI()
+    app.add_middleware(RequestSessionMiddleware)
+
+    @app.post("/log")
+    async def log():
+        async with db_session() as session:
+            await session.execute(text("SELECT 1"))
+        await pipeline.add_useinfo(useinfo(test_course_1.course_name, "saturate"))
+        return "ok"
+
+    num_requests = 2 * (pool_size + max_overflow)
+    try:
+        async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+            responses = await asyncio.wait_for(
+                asyncio.gather(*[client.post("/log") for _ in range(num_requests)]),
+                pool_timeout / 2,
+            )
+        assert [r.status_code for r in responses] == [200] * num_requests
+        assert pipeline.rows_failed == 0
+        assert pipeline.rows_written == num_requests
+    finally:
+        await pipeline.drain()
+        await pool_engine.dispose()
+
+    assert await count_useinfo_for(
+        "saturate", test_course_1.course_name, datetime.datetime(2000, 1, 1)
+    ) == [("view", num_requests)]
@@ -0,0 +1,167 @@
+# *****************************************
+# |docname| - test the caches kept in Redis
+# *****************************************
+# These tests use the Redis server at ``settings.redis_uri``, replacing the database queries each cache loads from, so that a load can be paused while answers arrive.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+# Third-party imports
+# -------------------
+import pytest
+
+# Local application imports
+# -------------------------
+from bookserver.config import settings
+from bookserver.internal import answer_counts, fitb_top_answers, poll_tally
+from bookserver.internal.redis_client import close_redis, get_redis
+
+
+# Support
+# =======
+@pytest.fixture
+async def redis_cache(monkeypatch):
+    monkeypatch.setattr(settings, "redis_cache", True)
+    yield get_redis()
+    # The client belongs to this test's event loop.
+    await close_redis()
+
+
+# Return a replacement for a query which returns ``rows`` as of its call, but only after ``release`` is set.
+def paused_query(rows, release):
+    async def query(*args):
+        result = list(rows)
+        await release.wait()
+        return result
+
+    return query
+
+
+# Tests
+# =====
+# Votes which arrive while a tally is built are kept; meanwhile, other readers use the database.
+async def test_poll_tally_rebuild(redis_cache, monkeypatch):
+    course_name, div_id = "test_redis_caches", "poll_1"
+    await redis_cache.delete(*poll_tally._keys(course_name, div_id))
+    release = asyncio.Event()
+    monkeypatch.setattr(
+        poll_tally,
+        "fetch_poll_votes",
+        paused_query([("s1", "0"), ("s2", "1"), ("s3", "1:a comment")], release),
+    )
+
+    async def fetch_poll_summary(div_id, course_name):
+        return [("0", 1)]
+
+    monkeypatch.setattr(poll_tally, "fetch_poll_summary", fetch_poll_summary)
+
+    build = asyncio.create_task(poll_tally.fetch_poll_counts(course_name, div_id))
+    try:
+        await asyncio.sleep(0.1)
+        assert await asyncio.wait_for(
+            poll_tally.fetch_poll_counts(course_name, div_id), 5
+        ) == {0: 1}
+        # These votes are stored after the build read the database.
+        await poll_tally.record_vote(course_name, div_id, "s4", "2")
+        await poll_tally.record_vote(course_name, div_id, "s1", "1")
+    finally:
+        release.set()
+
+    assert await asyncio.wait_for(build, 5) == {1: 3, 2: 1}
+    await poll_tally.record_vote(course_name, div_id, "s2", "2")
+    assert await poll_tally.fetch_poll_counts(course_name, div_id) == {1: 2, 2: 2}
+    assert await poll_tally.fetch_poll_vote(course_name, div_id, "s1") == "1"
+
+
+# Answers which arrive while counts are loaded are kept; meanwhile, other readers use the database.
+async def test_answer_counts_load(redis_cache, monkeypatch):
+    course_name, div_id = "test_redis_caches", "mchoice_1"
+    key = answer_counts._key(course_name, div_id)
+    await redis_cache.delete(key, answer_counts._lock_key(key))
+    today = datetime.date(2023, 1, 2)
+    now = datetime.datetime(2023, 1, 2, 12)
+    release = asyncio.Event()
+    rows = [(today, "answer:0:correct", 2), (today, "answer:1:no", 1)]
+    monkeypatch.setattr(
+        answer_counts, "count_mchoice_acts_by_day", paused_query(rows, release)
+    )
+
+    load = asyncio.create_task(
+        answer_counts.fetch_answer_counts(course_name, div_id, today)
+    )
+    try:
+        await asyncio.sleep(0.1)
+        # The load has read the database; the fallback sums the same query's rows.
+        ready = asyncio.Event()
+        ready.set()
+        monkeypatch.setattr(
+            answer_counts, "count_mchoice_acts_by_day", paused_query(rows, ready)
+        )
+        assert dict(
+            await asyncio.wait_for(
+                answer_counts.fetch_answer_counts(course_name, div_id, today), 5
+            )
+        ) == {"answer:0:correct": 2, "answer:1:no": 1}
+        # This answer is recorded after the load read the database.
+        await answer_counts.record_answer(course_name, div_id, "answer:1:no", now)
+    finally:
+        release.set()
+
+    assert dict(await asyncio.wait_for(load, 5)) == {
+        "answer:0:correct": 2,
+        "answer:1:no": 2,
+    }
+    await answer_counts.record_answer(course_name, div_id, "answer:0:correct", now)
+    assert dict(
+        await answer_counts.fetch_answer_counts(course_name, div_id, today)
+    ) == {"answer:0:correct": 3, "answer:1:no": 2}
+
+
+# Fill-in-the-blank answers which arrive while the counts are loaded are kept; meanwhile, other readers use the database.
+async def test_fitb_top_answers_load(redis_cache, monkeypatch):
+    dbcourse = SimpleNamespace(course_name="test_redis_caches")
+    div_id = "fitb_1"
+    key = fitb_top_answers._key(dbcourse.course_name, div_id)
+    await redis_cache.delete(key, fitb_top_answers._lock_key(key))
+    release = asyncio.Event()
+    monkeypatch.setattr(
+        fitb_top_answers,
+        "count_fitb_answers",
+        paused_query([('["a"]', 4), ('["b"]', 1)], release),
+    )
+
+    async def fetch_top10_fitb(dbcourse, div_id):
+        return [('["a"]', 4)]
+
+    monkeypatch.setattr(fitb_top_answers, "fetch_top10_fitb", fetch_top10_fitb)
+
+    load = asyncio.create_task(
+        fitb_top_answers.fetch_top_fitb_answers(dbcourse, div_id)
+    )
+    try:
+        await asyncio.sleep(0.1)
+        assert await asyncio.wait_for(
+            fitb_top_answers.fetch_top_fitb_answers(dbcourse, div_id), 5
+        ) == [('["a"]', 4)]
+        # These answers are recorded after the load read the database; a missing answer isn't counted.
+        for answer in ['["b"]', '["b"]', '["c"]', None]:
+            await fitb_top_answers.record_fitb_answer(
+                dbcourse.course_name, div_id, answer
+            )
+    finally:
+        release.set()
+
+    assert await asyncio.wait_for(load, 5) == [('["a"]', 4), ('["b"]', 3), ('["c"]', 1)]
+    await fitb_top_answers.record_fitb_answer(dbcourse.course_name, div_id, '["b"]')
+    assert await fitb_top_answers.fetch_top_fitb_answers(dbcourse, div_id) == [
+        ('["b"]', 4),
+        ('["a"]', 4),
+        ('["c"]', 1),
+    ]
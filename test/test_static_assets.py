@@ -0,0 +1,223 @@
+# **************************************
+# |docname| - test serving static assets
+# **************************************
+# These tests request files through `static_file_response <../bookserver/internal/static_assets.py>`, served from a temporary ``book_path``.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8`_.
+#
+# Standard library
+# ----------------
+import os
+
+# Third-party imports
+# -------------------
+from fastapi import FastAPI, Request
+import httpx
+import pytest
+
+# Local application imports
+# -------------------------
+from bookserver.config import settings
+from bookserver.internal.static_assets import static_file_response
+
+
+# Support
+# =======
+CONTENTS = bytes(range(256)) * 4
+
+
+# Provide a client for an app which serves files from ``book_path``, which is ``tmp_path``.
+@pytest.fixture
+async def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "book_path", tmp_path)
+    monkeypatch.setattr(settings, "static_accel_redirect_prefix", None)
+    app = FastAPI()
+
+    @app.get("/books/{filepath:path}")
+    async def serve(request: Request, filepath: str):
+        return await static_file_response(request, str(tmp_path / filepath))
+
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        yield client
+
+
+# Write a file under ``book_path``, returning its path.
+def write(tmp_path, name, contents=CONTENTS, mtime=1_600_000_000):
+    path = tmp_path / name
+    path.write_bytes(contents)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+# Tests
+# =====
+# Only names containing a content hash are cached as immutable.
+@pytest.mark.parametrize(
+    "name, immutable",
+    [
+        ("main.1a2b3c4d.js", True),
+        ("style-1a2b3c4d5e.css", True),
+        ("report-20230115.pdf", False),
+        ("photo.20230115.jpg", False),
+        ("image-deadbeef.png", False),
+        ("main.js", False),
+    ],
+)
+async def test_cache_control(client, tmp_path, name, immutable):
+    write(tmp_path, name)
+    r = await client.get(f"/books/{name}")
+    assert r.status_code == 200
+    assert r.content == CONTENTS
+    assert ("immutable" in r.headers["cache-control"]) == immutable
+
+
+# Only a ``?v=`` query string holding a hash, as Sphinx adds, marks a file as immutable.
+@pytest.mark.parametrize(
+    "query, immutable",
+    [
+        ("v=1a2b3c4d", True),
+        ("v=1a2b3c4d5e6f7a8b", True),
+        ("v=1", False),
+        ("v=20230115", False),
+        ("v=forged", False),
+        ("v=1a2b3c4d&x", True),
+        ("v=1a2b3c4d-forged", False),
+    ],
+)
+async def test_sphinx_version_query(client, tmp_path, query, immutable):
+    write(tmp_path, "main.js")
+    r = await client.get(f"/books/main.js?{query}")
+    assert ("immutable" in r.headers["cache-control"]) == immutable
+
+
+async def test_missing(client):
+    assert (await client.get("/books/missing.js")).status_code == 404
+
+
+async def test_not_modified(client, tmp_path):
+    write(tmp_path, "main.js")
+    r = await client.get("/books/main.js")
+    etag, last_modified = r.headers["etag"], r.headers["last-modified"]
+
+    r = await client.get("/books/main.js", headers={"if-none-match": etag})
+    assert r.status_code == 304
+    assert r.content == b""
+    assert r.headers["etag"] == etag
+    r = await client.get("/books/main.js", headers={"if-none-match": f"W/{etag}"})
+    assert r.status_code == 304
+    r = await client.get("/books/main.js", headers={"if-modified-since": last_modified})
+    assert r.status_code == 304
+
+    # A changed file gets a new ETag.
+    write(tmp_path, "main.js", mtime=1_700_000_000)
+    r = await client.get("/books/main.js", headers={"if-none-match": etag})
+    assert r.status_code == 200
+    assert r.headers["etag"] != etag
+    r = await client.get("/books/main.js", headers={"if-modified-since": last_modified})
+    assert r.status_code == 200
+
+
+async def test_range(client, tmp_path):
+    write(tmp_path, "video.mp4")
+    size = len(CONTENTS)
+
+    r = await client.get("/books/video.mp4", headers={"range": "bytes=10-19"})
+    assert r.status_code == 206
+    assert r.content == CONTENTS[10:20]
+    assert r.headers["content-range"] == f"bytes 10-19/{size}"
+    assert r.headers["content-length"] == "10"
+
+    r = await client.get("/books/video.mp4", headers={"range": "bytes=1000-"})
+    assert r.content == CONTENTS[1000:]
+    r = await client.get("/books/video.mp4", headers={"range": "bytes=-5"})
+    assert r.content == CONTENTS[-5:]
+    r = await client.get("/books/video.mp4", headers={"range": f"bytes={size}-"})
+    assert r.status_code == 416
+    assert r.headers["content-range"] == f"bytes */{size}"
+
+    # Multiple ranges aren't supported; send the whole file.
+    r = await client.get("/books/video.mp4", headers={"range": "bytes=0-1,5-6"})
+    assert r.status_code == 200
+    assert r.content == CONTENTS
+
+    # ``If-Range`` sends the range only if the file is unchanged.
+    etag = r.headers["etag"]
+    r = await client.get(
+        "/books/video.mp4", headers={"range": "bytes=0-9", "if-range": etag}
+    )
+    assert r.status_code == 206
+    r = await client.get(
+        "/books/video.mp4", headers={"range": "bytes=0-9", "if-range": '"stale"'}
+    )
+    assert r.status_code == 200
+    assert r.content == CONTENTS
+
+
+async def test_precompressed(client, tmp_path):
+    write(tmp_path, "main.js")
+    write(tmp_path, "main.js.br", b"brotli")
+    write(tmp_path, "main.js.gz", b"gzip")
+    # Read the raw bytes, without decoding them.
+
+    async def raw(accept_encoding, **headers):
+        async with client.stream(
+            "GET",
+            "/books/main.js",
+            headers={"accept-encoding": accept_encoding, **headers},
+        ) as r:
+            return r, b"".join([chunk async for chunk in r.aiter_raw()])
+
+    r, body = await raw("gzip, br")
+    assert (r.headers["content-encoding"], body) == ("br", b"brotli")
+    assert r.headers["vary"] == "Accept-Encoding"
+    assert r.headers["content-type"].startswith(
+        ("application/javascript", "text/javascript")
+    )
+    br_etag = r.headers["etag"]
+
+    r, body = await raw("gzip, br;q=0")
+    assert (r.headers["content-encoding"], body) == ("gzip", b"gzip")
+    assert r.headers["etag"] != br_etag
+
+    r, body = await raw("identity")
+    assert "content-encoding" not in r.headers
+    assert body == CONTENTS
+
+    # Each encoding has its own ETag.
+    r = await client.get(
+        "/books/main.js", headers={"accept-encoding": "br", "if-none-match": br_etag}
+    )
+    assert r.status_code == 304
+
+    # Ranges apply to the uncompressed file.
+    r, body = await raw("br", range="bytes=0-3")
+    assert r.status_code == 206
+    assert "content-encoding" not in r.headers
+    assert body == CONTENTS[:4]
+
+    # A variant older than its file is out of date, so it's ignored.
+    write(tmp_path, "main.js", mtime=1_700_000_000)
+    r, body = await raw("gzip, br")
+    assert "content-encoding" not in r.headers
+    assert body == CONTENTS
+
+
+async def test_accel_redirect(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "static_accel_redirect_prefix", "/protected_books/")
+    (tmp_path / "a book").mkdir()
+    write(tmp_path, "a book/main.js")
+    write(tmp_path, "a book/main.js.gz", b"gzip")
+
+    r = await client.get(
+        "/books/a book/main.js", headers={"accept-encoding": "identity"}
+    )
+    assert r.status_code == 200
+    assert r.content == b""
+    assert r.headers["x-accel-redirect"] == "/protected_books/a%20book/main.js"
+    assert "etag" in r.headers
+
+    r = await client.get("/books/a book/main.js", headers={"accept-encoding": "gzip"})
+    assert r.headers["x-accel-redirect"] == "/protected_books/a%20book/main.js.gz"
+    assert r.headers["content-encoding"] == "gzip"